@@ -1,182 +1,747 @@
+import sys
+import time
+import random
+from os import fstat
+from stat import S_ISREG
+from mmap import mmap, ACCESS_READ
 from cStringIO import StringIO
 
+# The panoramix and consensus_client packages keep identical copies of
+# this module, apart from the package name in imports.
 
-def to_canonical(obj, out=None):
-    toplevel = 0
-    if out is None:
-        toplevel = 1
-        out = StringIO()
+
+FLAT_LIST_BATCH = 4096
+WRITE_BATCH = 4096
+
+
+def encode_string(obj):
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    x = "%x" % len(obj)
+    return "%02x%s_" % (len(x), x) + obj
+
+
+def encode_int(obj):
+    s = "%x" % obj
+    x = "%x" % len(s)
+    return "%02x%s0%s" % (len(x), x, s)
+
+
+def encode_int_pair(pair):
+    a, b = pair
+    return "[\x0a%s,\x0a%s]\x0a" % (encode_int(a), encode_int(b))
+
+
+def encode_null(obj):
+    return 'null'
+
+
+SCALAR_ENCODERS = {
+    str: encode_string,
+    unicode: encode_string,
+    int: encode_int,
+    long: encode_int,
+    bool: encode_int,
+    type(None): encode_null,
+}
+
+INT_TYPES = (int, long)
+LIST_TYPES = (list, tuple)
+
+KIND_LIST = 1
+KIND_DICT = 2
+
+CONTAINER_KINDS = {
+    list: KIND_LIST,
+    tuple: KIND_LIST,
+    dict: KIND_DICT,
+}
+
+
+def classify(obj):
     if isinstance(obj, basestring):
-        if isinstance(obj, unicode):
-            obj = obj.encode('utf-8')
-        z = len(obj)
-        x = "%x" % z
-        w = ("%02x" % len(x))[:2]
-        out.write("%s%s_" % (w, x))
-        out.write(obj)
-    elif isinstance(obj, int) or isinstance(obj, long):
-        s = "%x" % obj
-        z = len(s)
-        x = "%x" % z
-        w = ("%02x" % len(x))[:2]
-        out.write("%s%s0%s" % (w, x, s))
-    elif isinstance(obj, dict):
-        out.write('{\x0a')
-        cobj = {}
-        for k, v in obj.iteritems():
-            if not isinstance(k, str):
-                if isinstance(k, unicode):
-                    k = k.encode('utf-8')
-                elif isinstance(k, int) or isinstance(k, long):
-                    k = str(k)
-                else:
-                    m = "Unsupported dict key type '%s'" % (type(k),)
-            cobj[k] = v
-        del obj
-        keys = cobj.keys()
-        keys.sort()
-        prev = None
-        for k in keys:
-            if prev is not None:
-                out.write(',\x0a')
-            if k == prev:
-                tail = '...' if len(k) > 64 else ''
-                m = "duplicate key '%s' in dict" % (k[:64] + tail,)
-                raise AssertionError(m)
-            to_canonical(k, out=out)
-            out.write(': ')
-            to_canonical(cobj[k], out=out)
-            prev = k
-        out.write('}\x0a')
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        out.write('[\x0a')
-        iterobj = iter(obj)
-        for o in iterobj:
-            to_canonical(o, out=out)
+        return encode_string, None
+    if isinstance(obj, int) or isinstance(obj, long):
+        return encode_int, None
+    if isinstance(obj, dict):
+        return None, KIND_DICT
+    if isinstance(obj, list) or isinstance(obj, tuple):
+        return None, KIND_LIST
+    m = "to_canonical: invalid object type '%s'" % (type(obj),)
+    raise AssertionError(m)
+
+
+def flat_list_encoder(obj):
+    """Return an item encoder if obj holds only integers or integer pairs"""
+    t = type(obj[0])
+    if t in INT_TYPES:
+        for item in obj:
+            if type(item) not in INT_TYPES:
+                return None
+        return encode_int
+
+    if t in LIST_TYPES:
+        for item in obj:
+            if type(item) not in LIST_TYPES or len(item) != 2:
+                return None
+            a, b = item
+            if type(a) not in INT_TYPES or type(b) not in INT_TYPES:
+                return None
+        return encode_int_pair
+
+    return None
+
+
+def sorted_items(obj):
+    keys = obj.keys()
+    for k in keys:
+        if type(k) is not str:
             break
-        for o in iterobj:
-            out.write(',\x0a')
-            to_canonical(o, out=out)
-        out.write(']\x0a')
-    elif obj is None:
-        out.write('null')
     else:
-        m = "to_canonical: invalid object type '%s'" % (type(obj),)
-        raise AssertionError(m)
+        keys.sort()
+        return [(k, obj[k]) for k in keys]
 
-    if toplevel:
-        out.seek(0)
-        return out.read()
+    cobj = {}
+    for k, v in obj.iteritems():
+        if not isinstance(k, str):
+            if isinstance(k, unicode):
+                k = k.encode('utf-8')
+            elif isinstance(k, int) or isinstance(k, long):
+                k = str(k)
+        cobj[k] = v
+    keys = cobj.keys()
+    keys.sort()
+    return [(k, cobj[k]) for k in keys]
 
 
-def from_canonical(inp, unicode_strings=0, s=''):
-    if isinstance(inp, str):
-        inp = StringIO(inp)
+def encode_key(k):
+    if type(k) is str:
+        return encode_string(k)
+    return to_canonical(k)
 
-    read = inp.read
-    if not s:
-        s = read(2)
 
-    if s == 'nu':
-        s += read(2)
-        if s == 'null':
-            return None
+def write_canonical(obj, write):
+    """Encode obj canonically, passing the output in pieces to write.
+
+    Containers are kept on an explicit stack instead of recursing, and
+    lists of integers or integer pairs, like ciphers, are encoded in
+    batches. Small tokens are gathered and written together, so the
+    largest piece written is bounded by the batch sizes and not by the
+    size of obj.
+    """
+    pieces = []
+    emit = pieces.append
+    stack = []
+    while 1:
+        t = type(obj)
+        encode = SCALAR_ENCODERS.get(t)
+        kind = CONTAINER_KINDS.get(t)
+        if encode is None and kind is None:
+            encode, kind = classify(obj)
+
+        if encode is not None:
+            emit(encode(obj))
+
+        elif kind == KIND_LIST:
+            encode = flat_list_encoder(obj) if obj else None
+            if encode is not None:
+                emit('[\x0a')
+                write(''.join(pieces))
+                del pieces[:]
+                for i in xrange(0, len(obj), FLAT_LIST_BATCH):
+                    sep = '' if i == 0 else ',\x0a'
+                    write(sep + ',\x0a'.join(
+                        map(encode, obj[i:i+FLAT_LIST_BATCH])))
+                emit(']\x0a')
+            elif obj:
+                it = iter(obj)
+                obj = next(it)
+                emit('[\x0a')
+                stack.append((it, KIND_LIST))
+                continue
+            else:
+                emit('[\x0a]\x0a')
+
         else:
-            m = ("byte %d: invalid token '%s' instead of 'null'"
-                % (inp.tell(), s))
-            raise ValueError(m)
+            items = sorted_items(obj)
+            if items:
+                it = iter(items)
+                k, obj = next(it)
+                emit('{\x0a' + encode_key(k) + ': ')
+                stack.append((it, KIND_DICT))
+                continue
+            emit('{\x0a}\x0a')
 
-    if s == '[\x0a':
-        obj = []
-        append = obj.append
-        while 1:
-            s = read(2)
-            if not s:
-                m = "byte %d: eof within a list" % inp.tell()
-                raise ValueError(m)
+        if len(pieces) >= WRITE_BATCH:
+            write(''.join(pieces))
+            del pieces[:]
+
+        while stack:
+            it, kind = stack[-1]
+            for obj in it:
+                break
+            else:
+                stack.pop()
+                emit(']\x0a' if kind == KIND_LIST else '}\x0a')
+                continue
+
+            if kind == KIND_LIST:
+                emit(',\x0a')
+            else:
+                k, obj = obj
+                emit(',\x0a' + encode_key(k) + ': ')
+            break
+        else:
+            write(''.join(pieces))
+            return
 
-            if s == ']\x0a':
-                return obj
 
-            item = from_canonical(inp, unicode_strings=unicode_strings, s=s)
-            append(item)
+def to_canonical(obj, out=None):
+    if out is not None:
+        write_canonical(obj, out.write)
+        return
 
-            s = read(2)
-            if s == ']\x0a':
-                return obj
+    pieces = []
+    write_canonical(obj, pieces.append)
+    return ''.join(pieces)
 
-            if s != ',\x0a':
-                m = ("byte %d: in list: illegal token '%s' instead of ',\\n'"
-                    % (inp.tell(), s))
-                raise ValueError(m)
 
-    if s == '{\x0a':
-        obj = {}
-        while 1:
-            s = read(2)
-            if not s:
-                m = "byte %d: eof within dict" % inp.tell()
-                raise ValueError(m)
+READ_CHUNK_SIZE = 1 << 20
 
-            if s == '}\x0a':
-                return obj
+LIST_START = '[\x0a'
+LIST_END = ']\x0a'
+DICT_START = '{\x0a'
+DICT_END = '}\x0a'
+ITEM_SEPARATOR = ',\x0a'
+KEY_SEPARATOR = ': '
 
-            key = from_canonical(inp, unicode_strings=unicode_strings, s=s)
-            s = read(2)
-            if s != ': ':
-                m = ("byte %d: invalid token '%s' instead of ': '"
-                    % (inp.tell(), s))
-                raise ValueError(m)
+# Decoding events: (kind, value, byte offset where the value starts)
+EVENT_VALUE = 0
+EVENT_LIST = 1
+EVENT_DICT = 2
+EVENT_KEY = 3
+EVENT_END = 4
 
-            value = from_canonical(inp, unicode_strings=unicode_strings)
-            obj[key] = value  # allow key TypeError rise through
 
-            s = read(2)
-            if not s:
-                m = "byte %d: eof inside dict" % inp.tell()
-                raise ValueError(m)
+class CanonicalReader(object):
+    """Read a canonical stream in large chunks, keeping track of the offset"""
 
-            if s == '}\x0a':
-                return obj
+    def __init__(self, inp, chunk_size=READ_CHUNK_SIZE):
+        self.inp = inp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+        try:
+            self.base = inp.tell()
+        except (AttributeError, IOError):
+            self.base = 0
 
-            if s != ',\x0a':
-                m = ("byte %d: illegal token '%s' in dict instead of ',\\n'"
-                    % (inp.tell(), s))
-                raise ValueError(m)
+    def tell(self):
+        return self.base + self.pos
+
+    def fill(self, n):
+        buf = self.buf[self.pos:]
+        self.base += self.pos
+        self.pos = 0
+        buf += self.inp.read(max(n - len(buf), self.chunk_size))
+        self.buf = buf
+        self.size = len(buf)
+
+    def read(self, n):
+        pos = self.pos
+        end = pos + n
+        if end > self.size:
+            self.fill(n)
+            pos = 0
+            end = min(n, self.size)
+        self.pos = end
+        return self.buf[pos:end]
+
+    def seek(self, offset):
+        if self.base <= offset <= self.base + self.size:
+            self.pos = offset - self.base
+            return
+        self.inp.seek(offset)
+        self.base = offset
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+
+    def release(self):
+        """Leave the underlying stream right after the bytes consumed"""
+        if self.pos != self.size:
+            self.inp.seek(self.tell())
+            self.base = self.tell()
+            self.buf = ''
+            self.pos = 0
+            self.size = 0
+
+
+def get_reader(inp):
+    """Return a reader over inp with read(), tell() and seek().
+
+    Regular files are memory mapped so that the kernel pages them in and
+    out as they are decoded. Other streams are read in large chunks.
+    """
+    if isinstance(inp, str):
+        return StringIO(inp)
+    if isinstance(inp, CanonicalReader) or not hasattr(inp, 'fileno'):
+        return inp
+    try:
+        fileno = inp.fileno()
+        offset = inp.tell()
+        st = fstat(fileno)
+    except (IOError, OSError, ValueError):
+        return CanonicalReader(inp)
+    if not S_ISREG(st.st_mode) or st.st_size == 0:
+        return CanonicalReader(inp)
+    reader = mmap(fileno, 0, access=ACCESS_READ)
+    reader.seek(offset)
+    return reader
+
+
+def release_reader(inp, reader):
+    if reader is inp or isinstance(inp, str):
+        return
+    if isinstance(reader, CanonicalReader):
+        reader.release()
+        return
+    inp.seek(reader.tell())
+    reader.close()
+
+
+def read_scalar(reader, s, unicode_strings=0, decode=True):
+    read = reader.read
+    if s == 'nu':
+        s += read(2)
+        if s == 'null':
+            return None
+        else:
+            m = ("byte %d: invalid token '%s' instead of 'null'"
+                % (reader.tell(), s))
+            raise ValueError(m)
+
+    if len(s) != 2:
+        m = "byte %d: eof while reading object" % reader.tell()
+        raise ValueError(m)
 
     w = int(s, 16)
     s = read(w)
     if len(s) != w:
-        m = "byte %d: eof while reading header size %d" % (inp.tell(), w)
+        m = "byte %d: eof while reading header size %d" % (reader.tell(), w)
         raise ValueError(m)
 
     z = int(s, 16)
     c = read(1)
     if not c:
-        m = "byte %d: eof while reading object tag" % inp.tell()
+        m = "byte %d: eof while reading object tag" % reader.tell()
         raise ValueError(m)
 
     s = read(z)
     if len(s) != z:
-        m = "byte %d: eof while reading object size %d" % (inp.tell(), z)
+        m = "byte %d: eof while reading object size %d" % (reader.tell(), z)
         raise ValueError(m)
 
     if c == '_':
-        if unicode_strings:
+        if unicode_strings and decode:
             try:
                 s = s.decode('utf-8')
             except UnicodeDecodeError:
                 pass
         return s
     elif c == '0':
-        num = int(s, 16)
-        return num
+        return int(s, 16) if decode else None
     else:
-        m = "byte %d: invalid object tag '%d'" % (inp.tell()-z, c)
+        m = "byte %d: invalid object tag '%s'" % (reader.tell()-z, c)
         raise ValueError(m)
 
 
+def read_key(reader, s, unicode_strings=0):
+    if not s:
+        m = "byte %d: eof within dict" % reader.tell()
+        raise ValueError(m)
+
+    key = read_scalar(reader, s, unicode_strings=unicode_strings)
+    s = reader.read(2)
+    if s != KEY_SEPARATOR:
+        m = ("byte %d: invalid token '%s' instead of ': '"
+            % (reader.tell(), s))
+        raise ValueError(m)
+    return key
+
+
+def read_canonical(reader, unicode_strings=0, s=''):
+    """Decode the canonical value at the current position of reader.
+
+    Containers are kept on an explicit stack, so nesting depth is not
+    limited by Python recursion.
+    """
+    read = reader.read
+    if not s:
+        s = read(2)
+
+    stack = []
+    obj = None
+    key = None
+    while 1:
+        if s == LIST_START:
+            s = read(2)
+            if s != LIST_END:
+                if not s:
+                    m = "byte %d: eof within a list" % reader.tell()
+                    raise ValueError(m)
+                stack.append((obj, key))
+                obj = []
+                key = None
+                continue
+            value = []
+
+        elif s == DICT_START:
+            s = read(2)
+            if s != DICT_END:
+                stack.append((obj, key))
+                obj = {}
+                key = read_key(reader, s, unicode_strings=unicode_strings)
+                s = read(2)
+                continue
+            value = {}
+
+        elif s == 'nu' or len(s) != 2:
+            value = read_scalar(reader, s)
+
+        else:
+            w = int(s, 16)
+            s = read(w)
+            if len(s) != w:
+                m = ("byte %d: eof while reading header size %d"
+                    % (reader.tell(), w))
+                raise ValueError(m)
+            z = int(s, 16)
+            c = read(1)
+            value = read(z)
+            if len(value) != z:
+                m = ("byte %d: eof while reading object size %d"
+                    % (reader.tell(), z))
+                raise ValueError(m)
+            if c == '0':
+                value = int(value, 16)
+            elif c == '_':
+                if unicode_strings:
+                    try:
+                        value = value.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            elif not c:
+                m = "byte %d: eof while reading object tag" % reader.tell()
+                raise ValueError(m)
+            else:
+                m = ("byte %d: invalid object tag '%s'"
+                    % (reader.tell()-z, c))
+                raise ValueError(m)
+
+        while 1:
+            if obj is None:
+                return value
+            if type(obj) is list:
+                obj.append(value)
+                end = LIST_END
+            else:
+                obj[key] = value  # allow key TypeError rise through
+                end = DICT_END
+
+            s = read(2)
+            if s == ITEM_SEPARATOR:
+                if end == DICT_END:
+                    key = read_key(reader, read(2),
+                                   unicode_strings=unicode_strings)
+                s = read(2)
+                break
+
+            if s == end:
+                value = obj
+                obj, key = stack.pop()
+                continue
+
+            if not s:
+                m = "byte %d: eof inside %s" % (
+                    reader.tell(), 'list' if end == LIST_END else 'dict')
+            else:
+                m = ("byte %d: illegal token '%s' instead of ',\\n'"
+                    % (reader.tell(), s))
+            raise ValueError(m)
+
+
+def from_canonical(inp, unicode_strings=0):
+    reader = get_reader(inp)
+    try:
+        return read_canonical(reader, unicode_strings=unicode_strings)
+    finally:
+        release_reader(inp, reader)
+
+
+def iter_canonical_events(inp, unicode_strings=0, decode=True):
+    """Decode one canonical value into a flat stream of events.
+
+    With decode=False scalar values are only skipped over and reported
+    as None, which is enough to index the layout of a document.
+    """
+    reader = get_reader(inp)
+    read = reader.read
+    tell = reader.tell
+    stack = []
+
+    s = read(2)
+    while 1:
+        start = tell() - len(s)
+        if s == LIST_START:
+            yield EVENT_LIST, None, start
+            s = read(2)
+            if not s:
+                m = "byte %d: eof within a list" % tell()
+                raise ValueError(m)
+            if s != LIST_END:
+                stack.append(LIST_END)
+                continue
+            yield EVENT_END, None, start
+
+        elif s == DICT_START:
+            yield EVENT_DICT, None, start
+            s = read(2)
+            if s != DICT_END:
+                stack.append(DICT_END)
+                key = read_key(reader, s, unicode_strings=unicode_strings)
+                yield EVENT_KEY, key, tell()
+                s = read(2)
+                continue
+            yield EVENT_END, None, start
+
+        else:
+            value = read_scalar(reader, s, unicode_strings=unicode_strings,
+                                decode=decode)
+            yield EVENT_VALUE, value, start
+
+        while stack:
+            end = stack[-1]
+            s = read(2)
+            if s == ITEM_SEPARATOR:
+                if end == DICT_END:
+                    key = read_key(reader, read(2),
+                                   unicode_strings=unicode_strings)
+                    yield EVENT_KEY, key, tell()
+                s = read(2)
+                break
+
+            if s == end:
+                stack.pop()
+                yield EVENT_END, None, tell()
+                continue
+
+            if not s:
+                m = "byte %d: eof inside %s" % (
+                    tell(), 'list' if end == LIST_END else 'dict')
+            else:
+                m = ("byte %d: illegal token '%s' instead of ',\\n'"
+                    % (tell(), s))
+            raise ValueError(m)
+        else:
+            return
+
+
+def skip_events(events, event):
+    """Consume the events of the value that starts with event"""
+    kind = event[0]
+    if kind == EVENT_VALUE:
+        return
+    depth = 1
+    for kind, value, start in events:
+        if kind == EVENT_END:
+            depth -= 1
+            if not depth:
+                return
+        elif kind == EVENT_LIST or kind == EVENT_DICT:
+            depth += 1
+
+
+def iter_canonical_items(inp, unicode_strings=0):
+    """Decode the items of a canonical list one at a time"""
+    reader = get_reader(inp)
+    read = reader.read
+    s = read(2)
+    if s != LIST_START:
+        m = "byte %d: canonical value is not a list" % reader.tell()
+        raise ValueError(m)
+
+    s = read(2)
+    if s == LIST_END:
+        return
+    while 1:
+        yield read_canonical(reader, unicode_strings=unicode_strings, s=s)
+        s = read(2)
+        if s == LIST_END:
+            return
+        if s != ITEM_SEPARATOR:
+            m = ("byte %d: in list: illegal token '%s' instead of ',\\n'"
+                % (reader.tell(), s))
+            raise ValueError(m)
+        s = read(2)
+
+
+def decode_at(reader, offset, unicode_strings=0):
+    reader.seek(offset)
+    return read_canonical(reader, unicode_strings=unicode_strings)
+
+
+LAZY_CACHE_SIZE = 2
+
+
+class LazyList(object):
+    """A canonical list whose items are decoded from the file on access.
+
+    The most recently decoded items are kept, so that consecutive steps
+    working on neighbouring items get the very same objects.
+    """
+
+    def __init__(self, reader, offsets, unicode_strings=0,
+                 cache_size=LAZY_CACHE_SIZE):
+        self.reader = reader
+        self.offsets = offsets
+        self.unicode_strings = unicode_strings
+        self.cache_size = cache_size
+        self.cache = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def item(self, i):
+        if i < 0:
+            i += len(self.offsets)
+        for j, item in self.cache:
+            if j == i:
+                return item
+        item = decode_at(self.reader, self.offsets[i],
+                         unicode_strings=self.unicode_strings)
+        self.cache.append((i, item))
+        del self.cache[:-self.cache_size]
+        return item
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.item(j) for j in xrange(*i.indices(len(self)))]
+        return self.item(i)
+
+    def __iter__(self):
+        for i in xrange(len(self.offsets)):
+            yield self.item(i)
+
+    def tolist(self):
+        return list(self)
+
+
+class LazyDocument(object):
+    """A canonical dict indexed by key and decoded one value at a time.
+
+    Values are cached once decoded, except for the lists under lazy_keys
+    which only keep the offset of each item, so that e.g. one mix at a
+    time is held in memory out of a large election document.
+    """
+
+    def __init__(self, inp, lazy_keys=(), unicode_strings=0):
+        self.reader = get_reader(inp)
+        self.unicode_strings = unicode_strings
+        self.offsets = {}
+        self.values = {}
+        self.index(lazy_keys)
+
+    def index(self, lazy_keys):
+        events = iter_canonical_events(self.reader, decode=False,
+                                       unicode_strings=self.unicode_strings)
+        kind, value, start = next(events)
+        if kind != EVENT_DICT:
+            m = "byte %d: canonical document is not a dict" % start
+            raise ValueError(m)
+
+        for kind, key, start in events:
+            if kind == EVENT_END:
+                break
+            event = next(events)
+            if key not in lazy_keys or event[0] != EVENT_LIST:
+                self.offsets[key] = event[2]
+                skip_events(events, event)
+                continue
+
+            offsets = []
+            for event in events:
+                if event[0] == EVENT_END:
+                    break
+                offsets.append(event[2])
+                skip_events(events, event)
+            self.values[key] = LazyList(self.reader, offsets,
+                                        unicode_strings=self.unicode_strings)
+
+    def __getitem__(self, key):
+        values = self.values
+        if key not in values:
+            values[key] = decode_at(self.reader, self.offsets[key],
+                                    unicode_strings=self.unicode_strings)
+        return values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __contains__(self, key):
+        return key in self.values or key in self.offsets
+
+    def keys(self):
+        return list(set(self.offsets).union(self.values))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+def load_lazy_document(path, lazy_keys=(), unicode_strings=0):
+    return LazyDocument(open(path, 'rb'), lazy_keys=lazy_keys,
+                        unicode_strings=unicode_strings)
+
+
 def from_unicode_canonical(inp):
     if isinstance(inp, unicode):
         inp = inp.encode('utf-8')
     return from_canonical(inp, unicode_strings=True)
+
+
+ENCODE_BENCHMARK_SIZES = [1000, 10000, 100000]
+
+
+def benchmark_to_canonical(sizes=ENCODE_BENCHMARK_SIZES, nr_bits=2048,
+                           outstream=sys.stdout):
+    """Time to_canonical on mixes of random ciphers of nr_bits each"""
+    getrandbits = random.SystemRandom().getrandbits
+    timings = {}
+    for nr_ciphers in sizes:
+        mix = {
+            'original_ciphers': [[getrandbits(nr_bits), getrandbits(nr_bits)]
+                                 for _ in xrange(nr_ciphers)],
+            'mixed_ciphers': [[getrandbits(nr_bits), getrandbits(nr_bits)]
+                              for _ in xrange(nr_ciphers)],
+        }
+        t0 = time.time()
+        size = len(to_canonical(mix))
+        elapsed = time.time() - t0
+        del mix
+        timings[nr_ciphers] = elapsed
+        outstream.write("%9d ciphers %10.3fs %8.1fMB/s\n"
+                        % (nr_ciphers, elapsed, size / elapsed / 1e6))
+        outstream.flush()
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_to_canonical([int(arg) for arg in sys.argv[1:]] or
+                           ENCODE_BENCHMARK_SIZES)
@@ -2,16 +2,33 @@ import requests
 from consensus_client import utils
 
 
+# The service caps long polls at WAIT_TIMEOUT_MAX seconds; allow some
+# more for the response to arrive
+LONG_POLL_TIMEOUT_MAX = 120
+LONG_POLL_MARGIN = 10
+
+
 def normalize(s):
     return s.rstrip('/') + '/'
 
 
+def get_error_details(response):
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    return body.get('details')
+
+
 class Client(object):
-    def __init__(self, endpoint, crypto_client=None):
+    def __init__(self, endpoint, crypto_client=None, long_poll_timeout=None):
         self.endpoint = normalize(endpoint)
         self.negotiations = self.endpoint + 'negotiations/'
         self.consensus = self.endpoint + 'consensus/'
         self.crypto_client = crypto_client
+        self.long_poll_timeout = long_poll_timeout
 
     def register_crypto(self, crypto_client):
         self.crypto_client = crypto_client
@@ -28,6 +45,30 @@ class Client(object):
         assert response.status_code == 200
         return response.json()
 
+    def negotiation_wait(self, negotiation_id, timeout=None):
+        """Long poll until the negotiation closes or timeout expires.
+
+        Returns None if the service does not support waiting.
+        """
+        if timeout is None:
+            timeout = self.long_poll_timeout
+        request_timeout = LONG_POLL_TIMEOUT_MAX
+        if timeout is not None:
+            request_timeout = min(max(timeout, 0), request_timeout)
+        path = '%s%s/wait/' % (self.negotiations, negotiation_id)
+        response = requests.get(path, params={'timeout': timeout},
+                                timeout=request_timeout + LONG_POLL_MARGIN)
+        if response.status_code == 405:
+            return None
+        if response.status_code == 404:
+            # Only the wait view answers with error details
+            details = get_error_details(response)
+            if details is None:
+                return None
+            raise ValueError(details)
+        assert response.status_code == 200
+        return response.json()
+
     def contribution_create(self, negotiation_id, body, accept):
         text = utils.prepare_text(body, accept)
         signature = self.crypto_client.sign(text)
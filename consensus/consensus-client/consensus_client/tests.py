@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import time
+import tempfile
+import weakref
+import threading
+from random import Random
+import pytest
+from cStringIO import StringIO
+from consensus_client import canonical, client, utils, watch
+
+# Modules kept in sync with the panoramix package
+SHARED_MODULES = ['canonical.py', 'binary.py']
+PANORAMIX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', '..', 'panoramix', 'panoramix')
+
+SEED = 5
+NR_SAMPLES = 3000
+MAX_DEPTH = 5
+
+
+def reference_to_canonical(obj, out=None):
+    # The original recursive encoder, kept to check that the optimized one
+    # produces byte-identical output.
+    toplevel = 0
+    if out is None:
+        toplevel = 1
+        out = StringIO()
+    if isinstance(obj, basestring):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        z = len(obj)
+        x = "%x" % z
+        w = ("%02x" % len(x))[:2]
+        out.write("%s%s_" % (w, x))
+        out.write(obj)
+    elif isinstance(obj, int) or isinstance(obj, long):
+        s = "%x" % obj
+        z = len(s)
+        x = "%x" % z
+        w = ("%02x" % len(x))[:2]
+        out.write("%s%s0%s" % (w, x, s))
+    elif isinstance(obj, dict):
+        out.write('{\x0a')
+        cobj = {}
+        for k, v in obj.iteritems():
+            if not isinstance(k, str):
+                if isinstance(k, unicode):
+                    k = k.encode('utf-8')
+                elif isinstance(k, int) or isinstance(k, long):
+                    k = str(k)
+            cobj[k] = v
+        keys = cobj.keys()
+        keys.sort()
+        prev = None
+        for k in keys:
+            if prev is not None:
+                out.write(',\x0a')
+            reference_to_canonical(k, out=out)
+            out.write(': ')
+            reference_to_canonical(cobj[k], out=out)
+            prev = k
+        out.write('}\x0a')
+    elif isinstance(obj, list) or isinstance(obj, tuple):
+        out.write('[\x0a')
+        iterobj = iter(obj)
+        for o in iterobj:
+            reference_to_canonical(o, out=out)
+            break
+        for o in iterobj:
+            out.write(',\x0a')
+            reference_to_canonical(o, out=out)
+        out.write(']\x0a')
+    elif obj is None:
+        out.write('null')
+    else:
+        m = "to_canonical: invalid object type '%s'" % (type(obj),)
+        raise AssertionError(m)
+
+    if toplevel:
+        out.seek(0)
+        return out.read()
+
+
+def random_scalar(rnd):
+    return rnd.choice([
+        None, True, False, -rnd.getrandbits(16), 0,
+        rnd.getrandbits(rnd.randint(1, 4096)),
+        long(rnd.getrandbits(8)),
+        'x' * rnd.randint(0, 300),
+        u'αβ' * rnd.randint(0, 3),
+    ])
+
+
+def random_key(rnd):
+    return rnd.choice([
+        'k%d' % rnd.randint(0, 99),
+        u'uα%d' % rnd.randint(0, 9),
+        rnd.randint(0, 9),
+    ])
+
+
+def random_ciphers(rnd):
+    ciphers = [[rnd.getrandbits(2048), rnd.getrandbits(2048)]
+               for _ in xrange(rnd.randint(0, 20))]
+    # sometimes break the pattern so that the generic path is taken
+    ciphers.extend(rnd.choice([[], [(1, 2)], [[1, True]], [[1]], [None]]))
+    return ciphers
+
+
+def random_object(rnd, depth=0):
+    r = rnd.random()
+    if depth >= MAX_DEPTH or r < 0.4:
+        return random_scalar(rnd)
+    if r < 0.5:
+        return random_ciphers(rnd)
+    if r < 0.6:
+        return [rnd.getrandbits(64) for _ in xrange(rnd.randint(1, 8))]
+    if r < 0.75:
+        items = [random_object(rnd, depth + 1)
+                 for _ in xrange(rnd.randint(0, 5))]
+        return items if rnd.random() < 0.5 else tuple(items)
+    return dict((random_key(rnd), random_object(rnd, depth + 1))
+                for _ in xrange(rnd.randint(0, 5)))
+
+
+def test_to_canonical_matches_reference():
+    rnd = Random(SEED)
+    for _ in xrange(NR_SAMPLES):
+        obj = random_object(rnd)
+        assert canonical.to_canonical(obj) == reference_to_canonical(obj)
+
+
+def test_to_canonical_out():
+    rnd = Random(SEED)
+    obj = random_object(rnd)
+    out = StringIO()
+    assert canonical.to_canonical(obj, out=out) is None
+    assert out.getvalue() == reference_to_canonical(obj)
+
+
+def test_to_canonical_large_cipher_list():
+    rnd = Random(SEED)
+    nr_ciphers = 3 * canonical.FLAT_LIST_BATCH + 1
+    mix = {'mixed_ciphers': [[rnd.getrandbits(2048), rnd.getrandbits(2048)]
+                             for _ in xrange(nr_ciphers)]}
+    assert canonical.to_canonical(mix) == reference_to_canonical(mix)
+
+
+def test_to_canonical_invalid_type():
+    for obj in [1.5, {'a': set()}, [object()]]:
+        try:
+            canonical.to_canonical(obj)
+        except AssertionError:
+            pass
+        else:
+            assert False, obj
+
+
+def test_canonical_deep_nesting():
+    obj = []
+    for _ in xrange(100000):
+        obj = [obj]
+    text = canonical.to_canonical(obj)
+    assert text == '[\x0a' * 100000 + '[\x0a]\x0a' + ']\x0a' * 100000
+    assert canonical.to_canonical(canonical.from_canonical(text)) == text
+
+
+def test_canonical_roundtrip():
+    rnd = Random(SEED)
+    for _ in xrange(NR_SAMPLES):
+        obj = random_object(rnd)
+        text = canonical.to_canonical(obj)
+        assert canonical.to_canonical(canonical.from_canonical(text)) == text
+
+
+def test_hash_with_canonical_matches_hash_string():
+    rnd = Random(SEED)
+    nr_ciphers = 2 * canonical.FLAT_LIST_BATCH + 3
+    objects = [
+        {'a': {'b': {'c': [1, {'d': None}]}}, 2: u'αβγ', u'κ': 'v'},
+        [[rnd.getrandbits(2048), rnd.getrandbits(2048)]
+         for _ in xrange(nr_ciphers)],
+        [[1, 2], (3, 4), [5, 6]],
+        {'mixed_ciphers': [], 'original_ciphers': [[]], 'empty': {}},
+        [[], [[]], ()],
+        u'unicode αβ',
+    ]
+    objects.extend(random_object(rnd) for _ in xrange(NR_SAMPLES // 10))
+    for obj in objects:
+        expected = utils.hash_string(canonical.to_canonical(obj))
+        assert utils.hash_with_canonical(obj) == expected
+
+
+def check_lazy_document(path, lazy_keys, unicode_strings):
+    with open(path, 'rb') as f:
+        eager = canonical.from_canonical(f.read(),
+                                         unicode_strings=unicode_strings)
+    doc = canonical.load_lazy_document(path, lazy_keys=lazy_keys,
+                                       unicode_strings=unicode_strings)
+    assert sorted(doc.keys()) == sorted(eager.keys())
+    assert len(doc) == len(eager)
+    assert isinstance(doc['mixes'], canonical.LazyList)
+    for key, value in eager.iteritems():
+        assert key in doc
+        lazy = doc[key]
+        if isinstance(lazy, canonical.LazyList):
+            assert key in lazy_keys
+            assert len(lazy) == len(value)
+            assert lazy.tolist() == value
+            assert list(lazy) == value
+            assert lazy[1:-1] == value[1:-1]
+            if value:
+                assert lazy[-1] == value[-1]
+                # Recently decoded items are the very same objects
+                assert lazy[0] is lazy[0]
+        else:
+            assert lazy == value
+    assert 'missing' not in doc
+    assert doc.get('missing', 5) == 5
+    doc['added'] = [1]
+    assert doc['added'] == [1] and 'added' in doc
+
+
+def test_lazy_document_matches_eager_loading():
+    rnd = Random(SEED)
+    lazy_keys = ('mixes', 'empty', 'scalar')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'doc')
+        for _ in xrange(50):
+            obj = dict((random_key(rnd), random_object(rnd))
+                       for _ in xrange(rnd.randint(0, 6)))
+            obj['mixes'] = [random_object(rnd)
+                            for _ in xrange(rnd.randint(0, 5))]
+            obj['empty'] = []
+            obj['scalar'] = random_scalar(rnd)
+            with open(path, 'wb') as f:
+                canonical.to_canonical(obj, out=f)
+            for unicode_strings in (0, 1):
+                check_lazy_document(path, lazy_keys, unicode_strings)
+
+        with open(path, 'wb') as f:
+            canonical.to_canonical([1, 2], out=f)
+        try:
+            canonical.load_lazy_document(path)
+        except ValueError:
+            pass
+        else:
+            assert False, "a list loaded as a document"
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_hash_cache():
+    calls = []
+
+    def hash_function(obj):
+        calls.append(obj)
+        return utils.hash_with_canonical(obj)
+
+    cache = utils.HashCache(hash_function=hash_function, size=3)
+    objects = [[n, [n]] for n in xrange(4)]
+    digests = [utils.hash_with_canonical(obj) for obj in objects]
+
+    # Hits return the same digest without hashing again
+    for _ in xrange(2):
+        for obj, digest in zip(objects[:3], digests):
+            assert cache(obj) == digest
+    assert len(calls) == 3
+
+    # The least recently used entry is evicted
+    cache(objects[0])
+    assert cache(objects[3]) == digests[3]
+    assert len(calls) == 4
+    assert len(cache.entries) == 3
+    assert cache(objects[1]) == digests[1]
+    assert len(calls) == 5
+    assert cache(objects[0]) == digests[0]
+    assert len(calls) == 5
+
+    # Equal contents in another object are hashed on their own
+    copy = list(objects[0])
+    assert cache(copy) == digests[0]
+    assert len(calls) == 6
+
+    # Modified objects are hashed again only once invalidated
+    objects[0].append(5)
+    assert cache(objects[0]) == digests[0]
+    cache.invalidate(objects[0])
+    assert cache(objects[0]) == utils.hash_with_canonical(objects[0])
+    cache.invalidate()
+    assert not cache.entries
+
+    # Scalars are not cached
+    assert cache('text') == utils.hash_with_canonical('text')
+    assert not cache.entries
+
+
+class Mix(dict):
+    # Plain dicts cannot be weakly referenced
+    pass
+
+
+def test_hash_cache_releases_mixes():
+    cache = utils.HashCache(size=2)
+    first, second = [Mix(mixed_ciphers=[[n, n + 1]]) for n in xrange(2)]
+    first_ref, second_ref = weakref.ref(first), weakref.ref(second)
+    first_digest = utils.hash_with_canonical(first)
+
+    # Hashed under its origin, a mix is not held by the cache
+    assert cache(first, key=('mixes', 0)) == first_digest
+    del first
+    assert first_ref() is None
+    assert cache(Mix(), key=('mixes', 0)) == first_digest
+
+    # Hashed by identity, a mix is held until it is evicted
+    cache(second)
+    del second
+    assert second_ref() is not None
+    cache([1], key=('mixes', 1))
+    cache([2], key=('mixes', 2))
+    assert second_ref() is None
+    cache.invalidate(key=('mixes', 2))
+    assert cache([3], key=('mixes', 2)) == utils.hash_with_canonical([3])
+
+
+class Verdict(object):
+    def __init__(self, error=None):
+        self.error = error
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+
+
+def test_check_prefetched():
+    zeus_events = pytest.importorskip('consensus_client.zeus_events')
+    checked = []
+
+    def verify():
+        checked.append(1)
+
+    zeus_events.prefetched[('mixing', 0)] = Verdict()
+    zeus_events.prefetched[('mixing', 1)] = Verdict(AssertionError('bad'))
+    try:
+        zeus_events.check_prefetched(('mixing', 0), verify)
+        assert not checked
+        try:
+            zeus_events.check_prefetched(('mixing', 1), verify)
+        except AssertionError:
+            pass
+        else:
+            assert False, "a failed prefetched check passed"
+        assert not checked
+        # Checks that were not prefetched run on the spot
+        zeus_events.check_prefetched(('decryption', 0), verify)
+        assert checked == [1]
+    finally:
+        zeus_events.stop_prefetch()
+    assert not zeus_events.prefetched
+    zeus_events.check_prefetched(('mixing', 1), verify)
+    assert checked == [1, 1]
+
+
+class FakeZeusSk(object):
+    @staticmethod
+    def verify_cipher_mix(mix):
+        pass
+
+
+def test_prefetch_verify_finds_bad_factors(monkeypatch):
+    zeus_events = pytest.importorskip('consensus_client.zeus_events')
+    from panoramix.backends import zeus_crypto
+    # Workers are forked, so they see the patched mix verifier too
+    monkeypatch.setattr(zeus_events, 'zeus_sk', FakeZeusSk)
+
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    ciphers = [zeus_crypto.encrypt(n, p, g, q, zeus_crypto.y)[:2]
+               for n in xrange(8)]
+    trustee_factors = []
+    for secret in (3, 5):
+        factors = zeus_crypto.compute_decryption_factors(
+            p, g, q, secret, ciphers, nr_parallel=0)
+        trustee_factors.append({'trustee_public': pow(g, secret, p),
+                                'decryption_factors': factors})
+    bad = trustee_factors[1]['decryption_factors']
+    bad[4][0] = (bad[4][0] * g) % p
+    doc = {'cryptosystem': [p, g, q],
+           'mixes': [{'mixed_ciphers': ciphers}],
+           'trustee_factors': trustee_factors}
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        docfile = os.path.join(tmpdir, 'election')
+        with open(docfile, 'wb') as f:
+            canonical.to_canonical(doc, out=f)
+        doc = zeus_events.load_document(docfile)
+        zeus_events.prefetch_verify(docfile, doc, nr_parallel=2)
+        assert sorted(zeus_events.prefetched) == [
+            ('decryption', 0), ('decryption', 1), ('mixing', 0)]
+
+        def verify():
+            assert False, "prefetched check run again"
+
+        zeus_events.check_prefetched(('mixing', 0), verify)
+        zeus_events.check_prefetched(('decryption', 0), verify)
+        try:
+            zeus_events.check_prefetched(('decryption', 1), verify)
+        except AssertionError as e:
+            assert 'decryption factors' in str(e)
+        else:
+            assert False, "bad decryption factors passed"
+    finally:
+        zeus_events.stop_prefetch()
+        shutil.rmtree(tmpdir)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        if self.body is None:
+            raise ValueError("No JSON object could be decoded")
+        return self.body
+
+
+def test_negotiation_wait_fallback(monkeypatch):
+    responses = []
+    timeouts = []
+
+    def get(path, params=None, timeout=None):
+        timeouts.append(timeout)
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.requests, 'get', get)
+    api = client.Client('http://localhost/', long_poll_timeout=30)
+
+    # Services without the wait view answer with a plain 404 or a 405
+    responses.append(FakeResponse(404))
+    assert api.negotiation_wait('neg') is None
+    responses.append(FakeResponse(405))
+    assert api.negotiation_wait('neg') is None
+
+    responses.append(FakeResponse(404, {'details': 'not found'}))
+    try:
+        api.negotiation_wait('neg')
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown negotiation treated as unsupported"
+
+    body = {'id': 'neg', 'status': 'DONE', 'consensus_id': 'cons'}
+    responses.append(FakeResponse(200, body))
+    assert api.negotiation_wait('neg', timeout=1000) == body
+    assert timeouts == [40, 40, 40, 130]
+
+
+class EarlyAnsweringClient(object):
+    """Answers every long poll at once, with a consensus on the last"""
+
+    long_poll_timeout = 30
+
+    def __init__(self, nr_empty):
+        self.nr_empty = nr_empty
+
+    def negotiation_wait(self, negotiation_id):
+        if self.nr_empty:
+            self.nr_empty -= 1
+            return {'consensus_id': None}
+        return {'consensus_id': 'cons'}
+
+
+def test_wait_negotiation_spaces_long_polls(monkeypatch):
+    zeus_events = pytest.importorskip('consensus_client.zeus_events')
+    sleeps = []
+    monkeypatch.setattr(zeus_events.time, 'sleep', sleeps.append)
+    api = EarlyAnsweringClient(3)
+    assert zeus_events.wait_negotiation(api, 'neg', min_interval=5) == 'cons'
+    assert len(sleeps) == 3
+    assert all(4 < delay <= 5 for delay in sleeps)
+
+
+def append_later(path, delay):
+    def append():
+        time.sleep(delay)
+        with open(path, 'a') as f:
+            f.write('more')
+    thread = threading.Thread(target=append)
+    thread.start()
+    return thread
+
+
+def check_file_watcher(path):
+    with watch.FileWatcher(path, poll_interval=0.01) as watcher:
+        assert not watcher.wait(timeout=0.05)
+        thread = append_later(path, 0.05)
+        assert watcher.wait(timeout=5)
+        thread.join()
+
+
+def test_file_watcher(monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'pad')
+        with open(path, 'w') as f:
+            f.write('data')
+        check_file_watcher(path)
+
+        # Without inotify the file is polled
+        monkeypatch.setattr(watch, 'inotify_watch', lambda directory: None)
+        with watch.FileWatcher(path) as watcher:
+            assert watcher.fd is None
+        check_file_watcher(path)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_shared_modules_match_panoramix():
+    # Only possible from a source checkout
+    if not os.path.isdir(PANORAMIX_DIR):
+        return
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in SHARED_MODULES:
+        with open(os.path.join(PANORAMIX_DIR, name)) as f:
+            source = f.read()
+        with open(os.path.join(here, name)) as f:
+            copy = f.read()
+        source = source.replace('from panoramix import',
+                                'from consensus_client import')
+        assert copy == source, name
@@ -1,5 +1,6 @@
 import base64
 import hashlib
+from collections import OrderedDict
 import ecdsa
 from consensus_client import canonical
 
@@ -9,7 +10,60 @@ def hash_string(s):
 
 
 def hash_with_canonical(obj):
-    return hash_string(canonical.to_canonical(obj))
+    # Feed the encoding to the hasher as it is produced, so that hashing
+    # a large document does not first build its canonical string.
+    hasher = hashlib.sha256()
+    canonical.write_canonical(obj, hasher.update)
+    return hasher.hexdigest()
+
+
+HASH_CACHE_SIZE = 16
+
+
+class HashCache(object):
+    """Canonical hashes of containers, keyed by origin or object identity.
+
+    A value hashed with a key, naming where it comes from such as
+    ('mixes', 2), is cached under that key and is not kept alive by the
+    cache. The key must name the same contents until it is invalidated.
+
+    Without a key, each entry keeps a reference to its object, so that
+    the id cannot be reused by another object while the entry is cached.
+    Only the most recently used entries are kept. An object that is
+    modified after it has been hashed must be invalidated.
+    """
+
+    def __init__(self, hash_function=hash_with_canonical,
+                 size=HASH_CACHE_SIZE):
+        self.hash_function = hash_function
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __call__(self, obj, key=None):
+        if key is not None:
+            held = None
+        elif isinstance(obj, (list, tuple, dict)):
+            key = id(obj)
+            held = obj
+        else:
+            return self.hash_function(obj)
+
+        entries = self.entries
+        entry = entries.pop(key, None)
+        if entry is None or entry[0] is not held:
+            entry = (held, self.hash_function(obj))
+        entries[key] = entry
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+        return entry[1]
+
+    def invalidate(self, obj=None, key=None):
+        if key is not None:
+            self.entries.pop(key, None)
+        elif obj is not None:
+            self.entries.pop(id(obj), None)
+        else:
+            self.entries.clear()
 
 
 def prepare_text(body, accept):
@@ -0,0 +1,127 @@
+import os
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+from select import select
+
+POLL_INTERVAL = 0.1
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+# Only complete writes: a file is seen once closed or renamed into place
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+_libc = None
+
+
+def get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def inotify_watch(directory):
+    """Return an inotify descriptor watching directory, or None"""
+    try:
+        libc = get_libc()
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    fd = init(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if add_watch(fd, directory, WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def iter_event_names(data):
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        yield data[offset:offset+size].rstrip('\0')
+        offset += size
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_size
+
+
+class FileWatcher(object):
+    """Wait for a file to be rewritten.
+
+    The containing directory is watched with inotify, so that writes
+    through a new file and rename are seen too. Where inotify is not
+    available the file is polled with stat() instead. Changes made after
+    the watcher is created are never missed, even if they happen while
+    nobody is waiting.
+    """
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        self.poll_interval = poll_interval
+        self.stamp = file_stamp(self.path)
+        self.fd = inotify_watch(os.path.dirname(self.path))
+
+    def wait(self, timeout=None):
+        """Return True once the file has changed, False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        if self.fd is not None:
+            return self.wait_inotify(deadline)
+        return self.wait_poll(deadline)
+
+    def wait_inotify(self, deadline):
+        while 1:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            readable, _, _ = select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            try:
+                data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            if self.name in iter_event_names(data):
+                return True
+
+    def wait_poll(self, deadline):
+        while 1:
+            stamp = file_stamp(self.path)
+            if stamp != self.stamp:
+                self.stamp = stamp
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
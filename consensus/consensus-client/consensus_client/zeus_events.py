@@ -1,11 +1,27 @@
 import time
 import sys
-from consensus_client import client, utils, canonical
+from multiprocessing import Pool, cpu_count
+from consensus_client import client, utils, canonical, binary, watch
 from consensus_client.config import Config
 from zeus import core, zeus_sk
+# Needs the zeus extra: pip install consensus-client[zeus]
+from panoramix.backends import zeus_crypto
 from pprint import pprint
 
-hash_object = utils.hash_with_canonical
+# Mixes are hashed again by the next round and by the decryption step
+hash_object = utils.HashCache()
+
+
+def hash_doc(doc, *path):
+    """Hash of the value at path in doc, cached under that path.
+
+    The cache does not keep the value alive, so a lazily loaded mix is
+    released once the step using it is over.
+    """
+    value = doc
+    for step in path:
+        value = value[step]
+    return hash_object(value, key=path)
 
 
 def contribute(negotiation_id, event):
@@ -16,13 +32,32 @@ def get_negotiation_consensus(negotiation_id):
     return 'cons_%s' % negotiation_id
 
 
-def wait_negotiation(client, negotiation_id, wait=2):
+# A server may answer a long poll early without a consensus, so long
+# polls are spaced at least this many seconds apart
+LONG_POLL_MIN_INTERVAL = 1
+
+
+def wait_negotiation(client, negotiation_id, wait=2,
+                     min_interval=LONG_POLL_MIN_INTERVAL):
     while True:
-        negotiation = client.negotiation_retrieve(negotiation_id)
+        started = time.time()
+        if client.long_poll_timeout:
+            negotiation = client.negotiation_wait(negotiation_id)
+            if negotiation is None:
+                print "Consensus service cannot long poll, polling instead"
+                client.long_poll_timeout = None
+                continue
+        else:
+            negotiation = client.negotiation_retrieve(negotiation_id)
         consensus_id = negotiation['consensus_id']
         if consensus_id:
             return consensus_id
-        time.sleep(wait)
+        if client.long_poll_timeout:
+            delay = min_interval - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            time.sleep(wait)
 
 
 def accept_negotiation(client, negotiation_id, event):
@@ -55,12 +90,10 @@ def announce_event(key, event, neg_id, pad):
 
 
 def create_authority_event(identifier, doc, state, do_trustee_checks=True):
-    trustees = doc['trustees']
-
     return {
         'type': 'authority',
-        'signing_cryptosystem': hash_object(doc['cryptosystem']),
-        'trustees': hash_object(trustees),
+        'signing_cryptosystem': hash_doc(doc, 'cryptosystem'),
+        'trustees': hash_doc(doc, 'trustees'),
     }
 
 
@@ -71,13 +104,12 @@ def verify_create_authority_event(event, identifier, doc, state):
 
 def configuration_event(identifier, doc, state, do_trustee_checks=True):
     authority = state.get_value('authority')
-    trustees = doc['trustees']
 
     return {
         'type': 'configuration',
         'authority_consensus_id': authority,
-        'election_cryptosystem': hash_object(doc['cryptosystem']),
-        'key_holders': hash_object(trustees),
+        'election_cryptosystem': hash_doc(doc, 'cryptosystem'),
+        'key_holders': hash_doc(doc, 'trustees'),
         'election_name': 'election_name',
         'election_admin': 'election_admin',
     }
@@ -98,9 +130,9 @@ def activation_event(identifier, doc, state, do_trustee_checks=True):
         'poll_type': 'poll_type',
         'opens_at': 'timestamp',
         'closes_at': 'timestamp',
-        'candidates': hash_object(doc['candidates']),
-        'voters_hash': hash_object(doc['voters']),
-        'excluded_voters_hash': hash_object(doc['excluded_voters']),
+        'candidates': hash_doc(doc, 'candidates'),
+        'voters_hash': hash_doc(doc, 'voters'),
+        'excluded_voters_hash': hash_doc(doc, 'excluded_voters'),
     }
 
 
@@ -127,13 +159,13 @@ def closing_event(identifier, doc, state, do_trustee_checks=True):
     activation_id = state.get_value('activation')
     activation_consensus = state.get_value('consensus')[activation_id]
     activation_event = get_event_of_consensus(activation_consensus)
-    assert activation_event['voters_hash'] == hash_object(doc['voters'])
-    assert activation_event['excluded_voters_hash'] == hash_object(
-        doc['excluded_voters'])
+    assert activation_event['voters_hash'] == hash_doc(doc, 'voters')
+    assert activation_event['excluded_voters_hash'] == hash_doc(
+        doc, 'excluded_voters')
 
-    votes_hash = hash_object(doc['votes'])
+    votes_hash = hash_doc(doc, 'votes')
     votes_for_mixing = doc['votes_for_mixing']
-    votes_for_mixing_hash = hash_object(votes_for_mixing)
+    votes_for_mixing_hash = hash_doc(doc, 'votes_for_mixing')
 
     if do_trustee_checks:
         assert votes_for_mixing == extract_votes_for_mixing(doc)
@@ -156,6 +188,67 @@ def notify_voters(doc):
     pass
 
 
+# Verdicts of checks started ahead of their events, see prefetch_verify
+prefetched = {}
+prefetch_pool = None
+_prefetch_doc = None
+
+
+def init_prefetch_worker(docfile):
+    global _prefetch_doc
+    _prefetch_doc = load_document(docfile)
+
+
+def prefetch_mix(mix_round):
+    zeus_sk.verify_cipher_mix(_prefetch_doc['mixes'][mix_round])
+
+
+def prefetch_factors(index):
+    doc = _prefetch_doc
+    mixed_ciphers = doc['mixes'][-1]['mixed_ciphers']
+    verify_decryption_factors(doc['cryptosystem'], mixed_ciphers,
+                              doc['trustee_factors'][index])
+
+
+def prefetch_verify(docfile, doc, nr_parallel=None):
+    """Verify all mixes and decryption factors of doc in a process pool.
+
+    The event verifiers then wait for these verdicts instead of checking
+    on the spot once each event is announced.
+    """
+    global prefetch_pool
+    if nr_parallel is None:
+        nr_parallel = cpu_count()
+    prefetch_pool = Pool(nr_parallel, initializer=init_prefetch_worker,
+                         initargs=(docfile,))
+    # The last mix feeds decryption, so verify it first
+    for mix_round in reversed(xrange(len(doc['mixes']))):
+        prefetched[('mixing', mix_round)] = prefetch_pool.apply_async(
+            prefetch_mix, (mix_round,))
+    for index in xrange(len(doc['trustee_factors'])):
+        prefetched[('decryption', index)] = prefetch_pool.apply_async(
+            prefetch_factors, (index,))
+    prefetch_pool.close()
+
+
+def stop_prefetch():
+    global prefetch_pool
+    if prefetch_pool is not None:
+        prefetch_pool.terminate()
+        prefetch_pool.join()
+        prefetch_pool = None
+    prefetched.clear()
+
+
+def check_prefetched(key, verify):
+    verdict = prefetched.get(key)
+    if verdict is None:
+        verify()
+    else:
+        # Reraises any error from the worker
+        verdict.get()
+
+
 def mixing_event(mix_round, doc, state, do_trustee_checks=True):
     if mix_round is None:
         mix_round = len(state.get('mixing') or [])
@@ -163,25 +256,24 @@ def mixing_event(mix_round, doc, state, do_trustee_checks=True):
     print "Checking mix_round %s." % mix_round
 
     mix = doc['mixes'][mix_round]
-    mix_data_hash = hash_object(mix)
+    mix_data_hash = hash_doc(doc, 'mixes', mix_round)
 
     if do_trustee_checks:
-        zeus_sk.verify_cipher_mix(mix)
+        check_prefetched(('mixing', mix_round),
+                         lambda: zeus_sk.verify_cipher_mix(mix))
 
-    mix_input = mix['original_ciphers']
-    mix_input_hash = hash_object(mix_input)
+    mix_input_hash = hash_doc(doc, 'mixes', mix_round, 'original_ciphers')
 
     prev_consensus_id = state.get_value('mixing')[-1] if mix_round \
                         else state.get_value('closing')
-    prev_mix_data = doc['mixes'][mix_round - 1] if mix_round \
-                    else doc['votes_for_mixing']
-    prev_mix_data_hash = hash_object(prev_mix_data)
+    prev_path = ('mixes', mix_round - 1) if mix_round \
+                else ('votes_for_mixing',)
+    prev_mix_data_hash = hash_doc(doc, *prev_path)
     prev_consensus = state.get_value('consensus')[prev_consensus_id]
     prev_event = get_event_of_consensus(prev_consensus)
     assert prev_event['mix_data_hash'] == prev_mix_data_hash
 
-    prev_output = prev_mix_data['mixed_ciphers']
-    prev_output_hash = hash_object(prev_output)
+    prev_output_hash = hash_doc(doc, *(prev_path + ('mixed_ciphers',)))
     assert prev_output_hash == mix_input_hash
 
     return {
@@ -197,6 +289,17 @@ def verify_mixing_event(event, mix_round, doc, state):
     # also check event signatures
 
 
+def verify_decryption_factors(cryptosystem, mixed_ciphers, trustee_factors):
+    # Proofs are checked in batches, falling back to one by one on failure
+    modulus, generator, order = cryptosystem
+    if not zeus_crypto.verify_decryption_factors(
+            modulus, generator, order, trustee_factors['trustee_public'],
+            mixed_ciphers, trustee_factors['decryption_factors'],
+            nr_parallel=0):
+        m = "Invalid decryption factors"
+        raise AssertionError(m)
+
+
 def decryption_event(identifier, doc, state, do_trustee_checks=True):
     mix_consensus_ids = state.get_value('mixing')
     last_mix_consensus_id = mix_consensus_ids[-1]
@@ -206,21 +309,20 @@ def decryption_event(identifier, doc, state, do_trustee_checks=True):
 
     mix_data_hash = last_mix_event['mix_data_hash']
 
-    last_mix = doc['mixes'][-1]
-    assert hash_object(last_mix) == mix_data_hash
+    last_mix_round = len(doc['mixes']) - 1
+    last_mix = doc['mixes'][last_mix_round]
+    assert hash_doc(doc, 'mixes', last_mix_round) == mix_data_hash
 
     mixed_ciphers = last_mix['mixed_ciphers']
-    modulus, generator, order = doc['cryptosystem']
+    cryptosystem = doc['cryptosystem']
     factors_hashes = []
-    for trustee_factors in doc['trustee_factors']:
+    for index, trustee_factors in enumerate(doc['trustee_factors']):
         # Must check if public keys right
-        trustee_public = trustee_factors['trustee_public']
-        decryption_factors = trustee_factors['decryption_factors']
-        core.verify_decryption_factors(
-            modulus, generator, order,
-            trustee_public, mixed_ciphers, decryption_factors)
+        check_prefetched(('decryption', index),
+                         lambda: verify_decryption_factors(
+                             cryptosystem, mixed_ciphers, trustee_factors))
         factors_hashes.append(
-            hash_object(trustee_factors))
+            hash_doc(doc, 'trustee_factors', index))
 
     return {
         'type': 'decryption',
@@ -273,14 +375,18 @@ VERIFIERS = {
 
 
 def wait_event_message(event_key, pad, wait=2):
-    while True:
-        print 'Trustee waiting event: %s' % event_key
-        negotiations = pad.get_value('negotiations', {})
-        try:
-            return negotiations[event_key]
-        except KeyError:
-            pad.reload()
-            time.sleep(wait)
+    # The watcher is created before the first read, so that an update
+    # landing between a read and the wait still wakes us up. wait now
+    # only bounds how long to go without rereading the pad.
+    with watch.FileWatcher(pad.config_file) as watcher:
+        while True:
+            print 'Trustee waiting event: %s' % event_key
+            negotiations = pad.get_value('negotiations', {})
+            try:
+                return negotiations[event_key]
+            except KeyError:
+                watcher.wait(wait)
+                pad.reload()
 
 
 def trustee_do(event_type, identifier, doc, state, pad, client):
@@ -305,11 +411,14 @@ def get_client(cfg):
     secret_pem = cfg.get_value('SECRET_KEY')
     crypto = utils.ECDSAClient(secret_pem)
     endpoint = cfg.get_value('ENDPOINT')
-    return client.Client(endpoint, crypto)
+    long_poll_timeout = cfg.get_value('LONG_POLL_TIMEOUT')
+    return client.Client(endpoint, crypto,
+                         long_poll_timeout=long_poll_timeout)
 
 
 def run_admin(doc, cfg, pad):
     client = get_client(cfg)
+    hash_object.invalidate()
     doc['votes_for_mixing'] = extract_votes_for_mixing(doc)
     admin_do('authority', None, doc, cfg, pad, client)
     admin_do('configuration', None, doc, cfg, pad, client)
@@ -322,6 +431,7 @@ def run_admin(doc, cfg, pad):
 
 def run_trustee(doc, cfg, pad):
     client = get_client(cfg)
+    hash_object.invalidate()
     doc['votes_for_mixing'] = extract_votes_for_mixing(doc)
     trustee_do('authority', None, doc, cfg, pad, client)
     trustee_do('configuration', None, doc, cfg, pad, client)
@@ -332,9 +442,18 @@ def run_trustee(doc, cfg, pad):
     trustee_do('decryption', None, doc, cfg, pad, client)
 
 
+# Mixes dominate large election documents; keep only one in memory at a time
+LAZY_DOCUMENT_KEYS = ('mixes',)
+
+
 def load_document(filename):
-    with open(filename) as f:
-        return canonical.from_canonical(f)
+    with open(filename, 'rb') as f:
+        is_binary = binary.is_binary(f.read(len(binary.MAGIC)))
+    if not is_binary:
+        return canonical.load_lazy_document(filename,
+                                            lazy_keys=LAZY_DOCUMENT_KEYS)
+    # Documents are hashed canonically, so decode every section eagerly
+    return binary.load(filename, lazy=False)
 
 
 RUNNERS = {
@@ -350,7 +469,12 @@ def main(cfg_file, pad_file, docfile):
 
     pad = Config(pad_file)
     doc = load_document(docfile)
-    run(doc, cfg, pad)
+    if role == 'TRUSTEE' and cfg.get_value('PREFETCH_VERIFY', False):
+        prefetch_verify(docfile, doc, cfg.get_value('PREFETCH_PARALLEL'))
+    try:
+        run(doc, cfg, pad)
+    finally:
+        stop_prefetch()
 
 
 if __name__ == '__main__':
@@ -3,8 +3,9 @@ from setuptools import setup, find_packages
 
 CURPATH = os.path.dirname(os.path.realpath(__file__))
 
-def get_requirements():
-    req_file = os.path.join(CURPATH, "requirements.txt")
+def get_requirements(extra=None):
+    suffix = "_%s" % extra if extra else ""
+    req_file = os.path.join(CURPATH, "requirements%s.txt" % suffix)
     with open(req_file) as f:
         return [
             x.strip('\n')
@@ -17,6 +18,8 @@ with open(version_file) as f:
     version = f.read().strip()
 
 package_name = 'consensus-client'
+# zeus_events verifies decryption factors with panoramix's zeus backend
+extras = ['zeus']
 description = 'Panoramix negotiation and consensus service client'
 
 setup(
@@ -27,5 +30,6 @@ setup(
     author_email='panoramix@dev.grnet.gr',
     description=description,
     packages=find_packages(),
-    install_requires=get_requirements()
+    install_requires=get_requirements(),
+    extras_require={extra: get_requirements(extra) for extra in extras}
 )
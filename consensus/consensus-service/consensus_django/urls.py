@@ -18,6 +18,7 @@ from django.contrib import admin
 
 from apimas_django import provider
 from consensus_django.spec import APP_CONFIG, DEPLOY_CONFIG
+from consensus_service import views
 
 app_spec = provider.configure_apimas_app(APP_CONFIG)
 deployment_spec = provider.configure_spec(app_spec, DEPLOY_CONFIG)
@@ -26,5 +27,7 @@ api_urls = provider.construct_views(deployment_spec)
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^consensus/negotiations/(?P<negotiation_id>[^/]+)/wait/$',
+        views.wait_negotiation),
 ]
 urlpatterns.extend(api_urls)
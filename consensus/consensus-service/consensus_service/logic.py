@@ -1,6 +1,8 @@
 import os
 import base64
 import datetime
+import threading
+from django.db import transaction
 from apimas import errors
 from consensus_service import models
 from consensus_client import utils
@@ -14,6 +16,21 @@ crypto_client_class = import_object(client_path) if client_path \
 crypto_client = crypto_client_class()
 
 
+# Woken whenever a negotiation closes in this process; waiters in other
+# processes notice on their next recheck of the database.
+negotiation_closed = threading.Condition()
+
+
+def notify_negotiation_closed():
+    with negotiation_closed:
+        negotiation_closed.notify_all()
+
+
+def wait_negotiation_closed(timeout):
+    with negotiation_closed:
+        negotiation_closed.wait(timeout)
+
+
 def generate_random_key():
     s = os.urandom(32)
     return base64.urlsafe_b64encode(s).rstrip('=')
@@ -67,6 +84,7 @@ def check_close_negotiation(negotiation):
         negotiation.consensus_id = consensus_id
         negotiation.status = models.NegotiationStatus.DONE
         negotiation.save()
+        transaction.on_commit(notify_negotiation_closed)
 
 
 def contribute(request_data, negotiation_id, context):
@@ -147,3 +147,37 @@ def test_two_users(client):
     assert len(signings) == 2
     assert any(sign['signature'] == signature21 for sign in signings)
     assert any(sign['signature'] == signature12 for sign in signings)
+
+
+def test_wait_negotiation(client):
+    api = client.copy(prefix='/consensus/')
+    crypto = init_crypto()
+
+    r = api.post('negotiations')
+    neg_id = r.json()['id']
+    neg_path = 'negotiations/%s' % neg_id
+    wait_path = '/consensus/negotiations/%s/wait/' % neg_id
+
+    r = client.get(wait_path, {'timeout': 0})
+    assert r.status_code == 200
+    body = r.json()
+    assert body['status'] == 'OPEN'
+    assert body['consensus_id'] is None
+
+    text = utils.prepare_text('a text', accept=True)
+    data = {
+        'text': text,
+        'signature': crypto.sign(text),
+    }
+    r = api.post('%s/contributions' % neg_path, data)
+    assert r.status_code == 201
+
+    r = client.get(wait_path, {'timeout': 10})
+    assert r.status_code == 200
+    body = r.json()
+    assert body['status'] == 'DONE'
+    assert body['consensus_id'] is not None
+
+    r = client.get('/consensus/negotiations/missing/wait/', {'timeout': 0})
+    assert r.status_code == 404
+    assert 'details' in r.json()
@@ -1,6 +1,53 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import time
 
-from django.shortcuts import render
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from consensus_service import models, logic
+
+WAIT_TIMEOUT = 30
+WAIT_TIMEOUT_MAX = 120
+WAIT_RECHECK_INTERVAL = 1
+
+
+def get_timeout(request):
+    try:
+        timeout = float(request.GET.get('timeout', WAIT_TIMEOUT))
+    except ValueError:
+        return None
+    return min(max(timeout, 0), WAIT_TIMEOUT_MAX)
+
+
+@require_GET
+def wait_negotiation(request, negotiation_id):
+    """Long poll: respond when the negotiation closes or ?timeout= expires.
+
+    This holds a request open, so it needs a threaded or multi-process
+    server.
+    """
+    timeout = get_timeout(request)
+    if timeout is None:
+        return JsonResponse({'details': 'Invalid timeout'}, status=400)
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            negotiation = models.Negotiation.objects.get(id=negotiation_id)
+        except models.Negotiation.DoesNotExist:
+            # A JSON body tells clients this view exists, unlike a
+            # plain 404 from a service that cannot long poll
+            details = "Negotiation '%s' not found." % negotiation_id
+            return JsonResponse({'details': details}, status=404)
+        remaining = deadline - time.time()
+        if negotiation.status != models.NegotiationStatus.OPEN or \
+           remaining <= 0:
+            break
+        logic.wait_negotiation_closed(min(remaining, WAIT_RECHECK_INTERVAL))
+
+    return JsonResponse({
+        'id': negotiation.id,
+        'status': negotiation.status,
+        'consensus_id': negotiation.consensus_id,
+    })
@@ -1,15 +1,19 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 
 from panoramix.config import cfg
 from panoramix.common import SphinxmixClient
+from panoramix.agent.outbox import Outbox, WORKER_SETTINGS, BATCH_SIZE, \
+    FLUSH_INTERVAL
 
 app = Flask(__name__)
 
 client = SphinxmixClient()
+outbox = None
 
 
 @app.route("/send", methods=["POST"])
 def send_message():
+    """Send one message right away and return its id on the gateway"""
     recipient = request.form["recipient"]
     text = request.form["message"]
     message = client.message_send(cfg.get('ENDPOINT_ID'),
@@ -20,10 +24,61 @@ def send_message():
     return str(message['id'])
 
 
+@app.route("/queue", methods=["POST"])
+def queue_message():
+    """Queue one message for a bulk upload and return its local id"""
+    recipient = request.form["recipient"]
+    text = request.form["message"]
+    [local_id] = outbox.submit([(recipient, text)])
+    return local_id
+
+
+@app.route("/queue-batch", methods=["POST"])
+def queue_batch():
+    """Queue a JSON array of {"recipient": ..., "message": ...} objects"""
+    messages = request.get_json(force=True, silent=True)
+    if not isinstance(messages, list):
+        abort(400)
+    try:
+        items = [(message["recipient"], message["message"])
+                 for message in messages]
+    except (TypeError, KeyError):
+        abort(400)
+    return jsonify({'ids': outbox.submit(items)})
+
+
+@app.route("/status/<local_id>", methods=["GET"])
+def message_status(local_id):
+    status = outbox.status(local_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+def make_outbox():
+    config = dict((name, cfg.get(name)) for name in WORKER_SETTINGS)
+    return Outbox(
+        client,
+        cfg.get('ENDPOINT_ID'),
+        cfg.get('MIXNET_ID'),
+        cfg.get('MIXERS'),
+        config=config,
+        nr_parallel=cfg.get('AGENT_NR_PARALLEL', 0),
+        batch_size=cfg.get('AGENT_BATCH_SIZE', BATCH_SIZE),
+        flush_interval=cfg.get('AGENT_FLUSH_INTERVAL', FLUSH_INTERVAL))
+
+
 def main():
+    global outbox
     client.register_catalog_url(cfg.get('CATALOG_URL'))
     client.register_crypto_client(cfg)
-    app.run()
+    # Worker processes are forked before any thread is started
+    outbox = make_outbox()
+    outbox.start()
+    try:
+        app.run(threaded=True)
+    finally:
+        outbox.close()
 
 if __name__ == "__main__":
     main()
@@ -6,9 +6,11 @@ import argparse
 
 AGENT_ADDRESS = "http://127.0.0.1:5000"
 SEND_ADDRESS = requests.compat.urljoin(AGENT_ADDRESS, "send")
+QUEUE_ADDRESS = requests.compat.urljoin(AGENT_ADDRESS, "queue")
+STATUS_ADDRESS = requests.compat.urljoin(AGENT_ADDRESS, "status/")
 
 
-def send_message(text=None, recipient=None):
+def post_message(address, text=None, recipient=None):
     if recipient is None:
         recipient = ui.ask_value("recipient", "Message recipient")
     if text is None:
@@ -16,11 +18,29 @@ def send_message(text=None, recipient=None):
 
     payload = {"recipient": recipient,
                "message": text}
-    r = requests.post(SEND_ADDRESS, data=payload)
+    r = requests.post(address, data=payload)
+    if r.status_code != requests.codes.ok:
+        ui.inform("Failed with code: %s" % r.status_code)
+        exit()
+    return r.content
+
+
+def send_message(text=None, recipient=None):
+    message_id = post_message(SEND_ADDRESS, text=text, recipient=recipient)
+    ui.inform("Sent message with id %s" % message_id)
+
+
+def queue_message(text=None, recipient=None):
+    local_id = post_message(QUEUE_ADDRESS, text=text, recipient=recipient)
+    ui.inform("Queued message with id %s" % local_id)
+
+
+def message_status(local_id):
+    r = requests.get(requests.compat.urljoin(STATUS_ADDRESS, local_id))
     if r.status_code != requests.codes.ok:
         ui.inform("Failed with code: %s" % r.status_code)
         exit()
-    ui.inform("Sent message with id %s" % r.content)
+    ui.inform(r.json())
 
 
 def output_cycle(cycle):
@@ -44,6 +64,10 @@ parser.add_argument('--output', metavar='CYCLE', type=int,
                     help='Print output of CYCLE')
 parser.add_argument('--ack', metavar='CYCLE', type=int,
                     help='Acknowledge output of CYCLE')
+parser.add_argument('--queue', action='store_true',
+                    help='Queue the message for a bulk upload')
+parser.add_argument('--status', metavar='ID',
+                    help='Print status of queued message ID')
 
 
 def main():
@@ -51,9 +75,14 @@ def main():
     ui.inform("Configuration file is: %s" % config_file)
     ui.inform("Set PANORAMIX_CONFIG environment variable to override")
     args = parser.parse_args()
-    if args.output is None and args.ack is None:
-        send_message()
+    if args.output is None and args.ack is None and args.status is None:
+        if args.queue:
+            queue_message()
+        else:
+            send_message()
         return
+    if args.status is not None:
+        message_status(args.status)
     if args.output is not None:
         output_cycle(args.output)
     if args.ack is not None:
@@ -0,0 +1,168 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from panoramix.backends import sphinxmix_backend
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+ENCRYPT_CHUNKS_PER_WORKER = 4
+ENCRYPT_MIN_CHUNK = 16
+STATUS_KEEP = 100000
+
+QUEUED = 'QUEUED'
+SENT = 'SENT'
+FAILED = 'FAILED'
+
+# Settings a worker needs to build its own crypto client
+WORKER_SETTINGS = ["CRYPTO_PARAMS", "KEY", "BINARY_PACKETS"]
+
+_worker_client = None
+
+
+def init_encrypt_worker(config):
+    global _worker_client
+    _worker_client = sphinxmix_backend.get_client(config)
+
+
+def encrypt_chunk(args):
+    mixnet_peer, mixers, items = args
+    prepare = _worker_client.prepare_message
+    return [prepare(mixnet_peer, mixers, recipient, text)
+            for recipient, text in items]
+
+
+class Outbox(object):
+    """Queue of messages sent to the gateway in bulk.
+
+    Messages get a local id as soon as they are queued. A flusher thread
+    encrypts the queue and uploads it to the current gateway cycle once
+    batch_size messages are waiting or the oldest has waited for
+    flush_interval seconds. The outcome is kept under the local id.
+    """
+
+    def __init__(self, client, endpoint_id, mixnet_peer, mixers,
+                 config=None, nr_parallel=0, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.client = client
+        self.endpoint_id = endpoint_id
+        self.mixnet_peer = mixnet_peer
+        self.mixers = mixers
+        self.nr_parallel = nr_parallel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.cond = threading.Condition()
+        self.pending = []
+        self.first_queued = None
+        self.statuses = OrderedDict()
+        self.closed = False
+
+        self.pool = None
+        if nr_parallel > 0:
+            self.pool = Pool(nr_parallel, initializer=init_encrypt_worker,
+                             initargs=(config,))
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def set_status(self, local_id, status):
+        statuses = self.statuses
+        statuses.pop(local_id, None)
+        statuses[local_id] = status
+        if len(statuses) > STATUS_KEEP:
+            statuses.popitem(last=False)
+
+    def status(self, local_id):
+        with self.cond:
+            status = self.statuses.get(local_id)
+            return None if status is None else dict(status, id=local_id)
+
+    def submit(self, items):
+        """Queue (recipient, text) pairs and return their local ids"""
+        with self.cond:
+            if self.closed:
+                raise ValueError("Outbox is closed")
+            ids = []
+            for recipient, text in items:
+                local_id = uuid.uuid4().hex
+                self.pending.append((local_id, recipient, text))
+                self.set_status(local_id, {'state': QUEUED})
+                ids.append(local_id)
+            if ids and self.first_queued is None:
+                self.first_queued = time.time()
+                self.cond.notify()
+            elif len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return ids
+
+    def take_batch(self):
+        with self.cond:
+            while 1:
+                if not self.pending:
+                    if self.closed:
+                        return None
+                    self.cond.wait()
+                    continue
+                if self.closed or len(self.pending) >= self.batch_size:
+                    break
+                remaining = self.first_queued + self.flush_interval - \
+                    time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            self.first_queued = time.time() if self.pending else None
+            return batch
+
+    def encrypt(self, items):
+        if self.pool is None:
+            prepare = self.client.crypto_client.prepare_message
+            return [prepare(self.mixnet_peer, self.mixers, recipient, text)
+                    for recipient, text in items]
+
+        size = len(items) // (self.nr_parallel * ENCRYPT_CHUNKS_PER_WORKER)
+        size = max(size, ENCRYPT_MIN_CHUNK)
+        chunks = [(self.mixnet_peer, self.mixers, items[i:i+size])
+                  for i in xrange(0, len(items), size)]
+        results = self.pool.map(encrypt_chunk, chunks)
+        return [message for chunk in results for message in chunk]
+
+    def flush(self, batch):
+        items = [(recipient, text) for _, recipient, text in batch]
+        try:
+            messages = self.encrypt(items)
+            cycle = self.client.message_send_bulk(self.endpoint_id, messages)
+        except Exception as e:
+            status = {'state': FAILED, 'error': str(e)}
+        else:
+            status = {'state': SENT, 'cycle': cycle}
+
+        with self.cond:
+            for local_id, _, _ in batch:
+                self.set_status(local_id, dict(status))
+
+    def run(self):
+        while 1:
+            batch = self.take_batch()
+            if batch is None:
+                return
+            self.flush(batch)
+
+    def close(self):
+        """Send whatever is still queued and stop"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+outbox_module = pytest.importorskip('panoramix.agent.outbox')
+Outbox = outbox_module.Outbox
+
+
+class FakeCryptoClient(object):
+    def prepare_message(self, mixnet_peer, mixers, recipient, message):
+        return {'recipient': mixnet_peer, 'text': recipient + ':' + message}
+
+
+class FakeClient(object):
+    """Records bulk sends; fails the ones whose text is in fail_on"""
+
+    def __init__(self, fail_on=()):
+        self.crypto_client = FakeCryptoClient()
+        self.fail_on = fail_on
+        self.batches = []
+
+    def message_send_bulk(self, endpoint_id, messages):
+        texts = [message['text'] for message in messages]
+        self.batches.append(texts)
+        if set(texts) & set(self.fail_on):
+            raise Exception("Upload failed")
+        return len(self.batches)
+
+
+def make_outbox(client, **kwargs):
+    outbox = Outbox(client, 'gateway', 'mixnet', ['mixer'], **kwargs)
+    outbox.start()
+    return outbox
+
+
+def wait_until_flushed(outbox, local_id):
+    deadline = time.time() + 5
+    while outbox.status(local_id)['state'] == outbox_module.QUEUED:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_outbox_flushes_full_batch():
+    client = FakeClient()
+    outbox = make_outbox(client, batch_size=3, flush_interval=60)
+    try:
+        items = [('r', str(n)) for n in range(4)]
+        ids = outbox.submit(items)
+        wait_until_flushed(outbox, ids[0])
+        assert client.batches == [['r:0', 'r:1', 'r:2']]
+        assert [outbox.status(i)['state'] for i in ids] == \
+            ['SENT', 'SENT', 'SENT', 'QUEUED']
+        assert outbox.status(ids[0]) == {'id': ids[0], 'state': 'SENT',
+                                         'cycle': 1}
+    finally:
+        outbox.close()
+    # Closing sends what is left
+    assert client.batches == [['r:0', 'r:1', 'r:2'], ['r:3']]
+    assert outbox.status(ids[3])['state'] == 'SENT'
+
+
+def test_outbox_flushes_after_interval():
+    client = FakeClient()
+    outbox = make_outbox(client, batch_size=100, flush_interval=0.2)
+    try:
+        start = time.time()
+        ids = outbox.submit([('r', 'a'), ('r', 'b')])
+        assert outbox.status(ids[0])['state'] == 'QUEUED'
+        wait_until_flushed(outbox, ids[0])
+        assert time.time() - start >= 0.2
+        assert client.batches == [['r:a', 'r:b']]
+        assert outbox.status(ids[1])['state'] == 'SENT'
+    finally:
+        outbox.close()
+
+
+def test_outbox_records_failed_batch():
+    client = FakeClient(fail_on=['r:bad'])
+    outbox = make_outbox(client, batch_size=2, flush_interval=60)
+    try:
+        failed = outbox.submit([('r', 'ok'), ('r', 'bad')])
+        wait_until_flushed(outbox, failed[0])
+        sent = outbox.submit([('r', 'next'), ('r', 'one')])
+        wait_until_flushed(outbox, sent[0])
+    finally:
+        outbox.close()
+    for local_id in failed:
+        assert outbox.status(local_id) == {'id': local_id, 'state': 'FAILED',
+                                           'error': "Upload failed"}
+    assert outbox.status(sent[0])['state'] == 'SENT'
+    assert outbox.status('unknown') is None
+    with pytest.raises(ValueError):
+        outbox.submit([('r', 'late')])
@@ -1,14 +1,24 @@
 from binascii import unhexlify
 import base64
+import struct
+import threading
 from hashlib import sha256
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from petlib import ecdsa, ec, bn
 from sphinxmix import SphinxParams, SphinxClient, SphinxNode
 
-from panoramix import canonical, utils, interface
+from panoramix import canonical, utils, interface, replay
 
 BACKEND_NAME = "SPHINXMIX"
 
+# Text prefix of packets in the binary wire format
+BINARY_PREFIX = "sbin:"
+PACKET_VERSION = 1
+# version, then the lengths of alpha, beta, gamma and delta
+PACKET_HEADER = struct.Struct('>BHHHI')
+
 
 ENDPOINT_TYPES = [
     "SPHINXMIX_GATEWAY",
@@ -88,13 +98,23 @@ def make_description(mixnet_name, combined_peer_id, owners, admin, size_min):
 REQUIRED_PARAMS = {}
 
 
+# SphinxParams are only read after construction, so one instance per
+# set of crypto params is shared by the whole process.
+_sphinxmix_params = {}
+
+
 def make_sphinxmix_params(crypto_params):
     GROUP = crypto_params["GROUP"]
     HEADER_LEN = crypto_params["HEADER_LEN"]
     BODY_LEN = crypto_params["BODY_LEN"]
-    group = SphinxParams.Group_ECC(GROUP)
-    return SphinxParams.SphinxParams(
-        group=group, header_len=HEADER_LEN, body_len=BODY_LEN)
+    key = (GROUP, HEADER_LEN, BODY_LEN)
+    params = _sphinxmix_params.get(key)
+    if params is None:
+        group = SphinxParams.Group_ECC(GROUP)
+        params = SphinxParams.SphinxParams(
+            group=group, header_len=HEADER_LEN, body_len=BODY_LEN)
+        _sphinxmix_params[key] = params
+    return params
 
 
 def mk_EcPt(hexvalue, params):
@@ -174,44 +194,254 @@ def decode_message(message):
     return canonical.from_unicode_canonical(message)
 
 
-def encrypt(data, recipients, params):
-    dest = recipients[-1]
-    routers = recipients[:-1]
+def pack_packet(header, delta):
+    alpha, beta, gamma = header
+    alpha = alpha.export()
+    lengths = PACKET_HEADER.pack(
+        PACKET_VERSION, len(alpha), len(beta), len(gamma), len(delta))
+    return ''.join((lengths, alpha, beta, gamma, delta))
+
+
+def unpack_packet_fields(data):
+    """Split a binary packet into its raw alpha, beta, gamma and delta"""
+    if len(data) < PACKET_HEADER.size:
+        raise ValueError("Truncated packet")
+    version, alpha_len, beta_len, gamma_len, delta_len = \
+        PACKET_HEADER.unpack_from(data)
+    if version != PACKET_VERSION:
+        m = "Unsupported packet version %d" % version
+        raise ValueError(m)
+    start = PACKET_HEADER.size
+    end = start + alpha_len + beta_len + gamma_len + delta_len
+    if len(data) != end:
+        m = "Packet length %d does not match its header" % len(data)
+        raise ValueError(m)
+    fields = []
+    for length in (alpha_len, beta_len, gamma_len, delta_len):
+        fields.append(data[start:start+length])
+        start += length
+    return fields
+
+
+def import_packet(fields, params):
+    alpha, beta, gamma, delta = fields
+    point = ec.EcPt.from_binary(alpha, params.group.G)
+    # Replay tags are taken over these bytes, so a point is only
+    # accepted in the one encoding that export() produces
+    if point.export() != alpha:
+        raise ValueError("Packet point is not in canonical form")
+    return (point, beta, gamma), delta
+
+
+def unpack_packet(data, params):
+    return import_packet(unpack_packet_fields(data), params)
+
+
+def encode_packet(header, delta, use_binary=False):
+    if use_binary:
+        return BINARY_PREFIX + base64.b64encode(pack_packet(header, delta))
+    return encode_message(mk_message(header, delta))
+
+
+def is_binary_packet(message):
+    return message.startswith(BINARY_PREFIX)
+
+
+def read_packet(message):
+    """Return the raw fields of a packet in either wire format"""
+    if is_binary_packet(message):
+        data = base64.b64decode(message[len(BINARY_PREFIX):])
+        return unpack_packet_fields(data)
+    message = decode_message(message)
+    alpha, beta, gamma = message["header"]
+    return [unhexlify(alpha), base64.b64decode(beta),
+            base64.b64decode(gamma), decode_delta(message["delta"])]
+
+
+def decode_packet(message, params):
+    """Return header and delta of a packet in either wire format"""
+    return import_packet(read_packet(message), params)
+
+
+def make_route(routers, params):
     nodes_routing = [SphinxClient.Nenc(router) for router in routers]
     router_keys = [mk_EcPt(router, params) for router in routers]
+    return nodes_routing, router_keys
+
+
+ROUTE_CACHE_SIZE = 64
+
+
+class RouteCache(object):
+    """Encoded node ids and decoded keys of recently used mixer lists.
+
+    The agent encrypts from request threads and its outbox thread at
+    once, so the entries are only touched under a lock.
+    """
+
+    def __init__(self, params, size=ROUTE_CACHE_SIZE):
+        self.params = params
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, routers):
+        key = tuple(routers)
+        with self.lock:
+            route = self.entries.pop(key, None)
+            if route is not None:
+                self.entries[key] = route
+                return route
+        route = make_route(routers, self.params)
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+            self.entries[key] = route
+        return route
+
+
+def encrypt(data, recipients, params, use_binary=False, route=None):
+    dest = recipients[-1]
+    if route is None:
+        route = make_route(recipients[:-1], params)
+    nodes_routing, router_keys = route
     header, delta = SphinxClient.create_forward_message(
         params, nodes_routing, router_keys, dest, data)
-    message = mk_message(header, delta)
-    return encode_message(message)
+    return encode_packet(header, delta, use_binary=use_binary)
 
 
 def process_message(message, params, secret):
-    header, delta = unpack_message(message, params)
+    header, delta = decode_packet(message, params)
     return SphinxNode.sphinx_process(params, secret, header, delta)
 
 
-def route_message(info, header, delta, mac_key, params):
+def route_message(info, header, delta, mac_key, params, use_binary=False):
     routing = SphinxClient.PFdecode(params, info)
     flag = routing[0]
     if flag == SphinxClient.Relay_flag:
         recipient = routing[1]
-        return recipient, encode_message(mk_message(header, delta))
+        return recipient, encode_packet(header, delta, use_binary=use_binary)
     elif flag == SphinxClient.Dest_flag:
         return tuple(SphinxClient.receive_forward(params, mac_key, delta))
     raise ValueError("Unrecognized flag")
 
 
-def process_sphinxmix(enc_messages, params, secret):
-    enc_messages = [m["text"] for m in enc_messages]
-    utils.secure_shuffle(enc_messages)
+def packet_tag(fields):
+    """Replay tag of a packet, computed before peeling it.
+
+    The Sphinx tag is derived from the shared secret, secret * alpha, so
+    under one node key it is determined by alpha alone. import_packet
+    only accepts alpha in canonical form, so hashing its raw bytes lets
+    replays be dropped before any point arithmetic.
+    """
+    return sha256(fields[0]).digest()
+
+
+def filter_replays(packets, replay_filter):
+    """Drop packets already processed or repeated within the batch.
+
+    The filter is only read here; the tags of the fresh packets are
+    returned so that they are recorded once processing has succeeded.
+    """
+    fresh = []
+    tags = set()
+    for packet in packets:
+        tag = packet_tag(packet[0])
+        if tag in tags or replay_filter.seen(tag):
+            continue
+        tags.add(tag)
+        fresh.append(packet)
+    return fresh, tags
+
+
+def record_replays(tags, replay_filter):
+    for tag in tags:
+        replay_filter.record(tag)
+    # Tags must be on disk before any output leaves the node
+    replay_filter.sync()
+
+
+def get_key_epoch(public):
+    return sha256(public).hexdigest()[:16]
+
+
+def read_sphinx_packet(message):
+    return read_packet(message), is_binary_packet(message)
+
+
+def process_sphinx_packet(packet, params, secret):
+    fields, use_binary = packet
+    header, delta = import_packet(fields, params)
+    (tag, info, (header, delta), mac_key) = SphinxNode.sphinx_process(
+        params, secret, header, delta)
+    # Packets are relayed in the wire format they arrived in
+    return route_message(info, header, delta, mac_key, params,
+                         use_binary=use_binary)
+
+
+PROCESS_CHUNKS_PER_WORKER = 4
+PROCESS_MIN_CHUNK = 16
+
+_worker_params = None
+_worker_secret = None
+
+
+def init_process_worker(crypto_params, secret):
+    # SphinxParams and petlib numbers are rebuilt here rather than pickled
+    global _worker_params, _worker_secret
+    _worker_params = make_sphinxmix_params(crypto_params)
+    _worker_secret = bn_decode(secret)
+
+
+def process_sphinx_chunk(packets):
+    return [process_sphinx_packet(packet, _worker_params, _worker_secret)
+            for packet in packets]
+
+
+def get_chunks(items, nr_parallel):
+    size = len(items) // (nr_parallel * PROCESS_CHUNKS_PER_WORKER)
+    size = max(size, PROCESS_MIN_CHUNK)
+    return [items[i:i+size] for i in xrange(0, len(items), size)]
+
+
+def process_sphinxmix_parallel(packets, crypto_params, secret, nr_parallel):
+    pool = Pool(nr_parallel, initializer=init_process_worker,
+                initargs=(crypto_params, bn_encode(secret)))
+    try:
+        # map returns the chunks in order, so the shuffle is kept
+        results = pool.map(process_sphinx_chunk,
+                           get_chunks(packets, nr_parallel))
+    finally:
+        pool.terminate()
+        pool.join()
+    return [processed for chunk in results for processed in chunk]
+
+
+def read_sphinx_packets(enc_messages):
+    # Each packet is parsed once here; its point is imported where
+    # it is processed
+    return [read_sphinx_packet(m["text"]) for m in enc_messages]
+
+
+def process_sphinx_packets(packets, params, secret,
+                           crypto_params=None, nr_parallel=0):
+    utils.secure_shuffle(packets)
+    if nr_parallel > 0 and crypto_params is not None and \
+       len(packets) > PROCESS_MIN_CHUNK:
+        return process_sphinxmix_parallel(
+            packets, crypto_params, secret, nr_parallel)
+
     processed = []
-    for message in enc_messages:
-        decoded = decode_message(message)
-        (tag, info, (header, delta), mac_key) = process_message(
-            decoded, params, secret)
-        recipient, processed_message = route_message(
-            info, header, delta, mac_key, params)
-        processed.append((recipient, processed_message))
+    for packet in packets:
+        processed.append(process_sphinx_packet(packet, params, secret))
+    return processed
+
+
+def process_sphinxmix(enc_messages, params, secret,
+                      crypto_params=None, nr_parallel=0):
+    processed = process_sphinx_packets(
+        read_sphinx_packets(enc_messages), params, secret,
+        crypto_params=crypto_params, nr_parallel=nr_parallel)
     return processed, None
 
 
@@ -254,12 +484,29 @@ key_type = 18
 
 
 class Client(object):
-    def __init__(self, crypto_params, public, secret):
+    def __init__(self, crypto_params, public, secret, nr_parallel=0,
+                 replay_dir=None, binary_packets=False):
         self._crypto_params = crypto_params
         self.params = make_sphinxmix_params(crypto_params)
         self.public = public
         self.secret = bn_decode(secret)
         self.key_id = public
+        self.nr_parallel = nr_parallel
+        self.replay_dir = replay_dir
+        self.replay_filter = None
+        self.processed_tags = set()
+        self.binary_packets = binary_packets
+        self.routes = RouteCache(self.params)
+
+    def get_replay_filter(self):
+        if self.replay_dir is None:
+            return None
+        epoch = get_key_epoch(self.public)
+        if self.replay_filter is None:
+            self.replay_filter = replay.ReplayFilter(self.replay_dir, epoch)
+        else:
+            self.replay_filter.rotate(epoch)
+        return self.replay_filter
 
     def get_key_data(self):
         return self.public
@@ -296,7 +543,9 @@ class Client(object):
         return str(result)
 
     def encrypt(self, data, recipients):
-        return encrypt(data, recipients, self.params)
+        route = self.routes.get(recipients[:-1])
+        return encrypt(data, recipients, self.params,
+                       use_binary=self.binary_packets, route=route)
 
     def decide_route(self, mixers, recipient):
         return mixers + [recipient]
@@ -310,20 +559,44 @@ class Client(object):
     def process(self, endpoint, messages):
         endpoint_type = endpoint["endpoint_type"]
         if endpoint_type == "SPHINXMIX":
-            return process_sphinxmix(messages, self.params, self.secret)
+            packets = read_sphinx_packets(messages)
+            replay_filter = self.get_replay_filter()
+            tags = set()
+            if replay_filter is not None:
+                packets, tags = filter_replays(packets, replay_filter)
+            processed = process_sphinx_packets(
+                packets, self.params, self.secret,
+                crypto_params=self._crypto_params,
+                nr_parallel=self.nr_parallel)
+            self.processed_tags = tags
+            return processed, None
         if endpoint_type == "SPHINXMIX_GATEWAY":
             raise utils.NoProcessing(endpoint_type)
         if endpoint_type == "SPHINXMIX_OUTPUT":
             raise utils.NoProcessing(endpoint_type)
         raise ValueError("Unsupported endpoint type")
 
+    def record_processed(self):
+        """Mark the packets of the last processed batch as seen.
+
+        Call this just before their output leaves the node. Until then a
+        batch that failed, in processing or afterwards, can be retried.
+        """
+        if self.replay_filter is not None and self.processed_tags:
+            record_replays(self.processed_tags, self.replay_filter)
+        self.processed_tags = set()
+
 
 def get_client(config):
     crypto_params = config.get("CRYPTO_PARAMS")
     key_settings = config.get("KEY", {})
     public = key_settings.get("PUBLIC")
     secret = key_settings.get("SECRET")
-    return Client(crypto_params, public, secret)
+    nr_parallel = config.get("NR_PARALLEL", 0)
+    replay_dir = config.get("REPLAY_LOG_DIR")
+    binary_packets = config.get("BINARY_PACKETS", False)
+    return Client(crypto_params, public, secret, nr_parallel=nr_parallel,
+                  replay_dir=replay_dir, binary_packets=binary_packets)
 
 
 def get_default_crypto_params():
@@ -1,12 +1,22 @@
 import os
+import sys
 import json
-from collections import namedtuple
+import stat
+import time
+import base64
+import random
+import logging
+import tempfile
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 from panoramix.backends import zeus_crypto as core
 from panoramix import utils
 from panoramix import canonical
+from panoramix import binary
 
 BACKEND_NAME = "ZEUS"
+BINARY_PREFIX = "zbin:"
 
 ZeusParams = namedtuple("ZeusParams", ["modulus", "generator", "order"])
 
@@ -61,10 +71,26 @@ def sign(body, params, secret, public):
 
 
 class Registry(object):
+    """Key registry stored as JSON in registry_path.
+
+    The key map is kept in memory and read again only when the file's
+    inode, mtime or size change. Writes replace the file atomically,
+    keeping its permissions.
+    """
+
     def __init__(self, registry_path):
         self.registry_path = registry_path
+        self._registry = {}
+        self._stamp = None
 
-    def _get_registry(self):
+    def _get_stamp(self):
+        try:
+            st = os.stat(self.registry_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _read(self):
         s = None
         if os.path.isfile(self.registry_path):
             with open(self.registry_path, "r") as f:
@@ -73,17 +99,48 @@ class Registry(object):
             return {}
         return json.loads(s)
 
+    def _get_registry(self):
+        stamp = self._get_stamp()
+        if stamp is None:
+            self._registry = {}
+        elif stamp != self._stamp:
+            self._registry = self._read()
+        self._stamp = stamp
+        return self._registry
+
+    def _get_mode(self):
+        try:
+            return stat.S_IMODE(os.stat(self.registry_path).st_mode)
+        except OSError:
+            # A new file gets the mode open() would have given it
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0666 & ~umask
+
     def _write(self, registry):
-        with open(self.registry_path, "w") as f:
-            json.dump(registry, f)
+        dirname = os.path.dirname(os.path.abspath(self.registry_path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".registry")
+        try:
+            # mkstemp creates the file readable by its owner only
+            os.fchmod(fd, self._get_mode())
+            with os.fdopen(fd, "w") as f:
+                json.dump(registry, f)
+            os.rename(tmp_path, self.registry_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        self._registry = registry
+        self._stamp = self._get_stamp()
 
     def get_key(self, key_id):
-        registry = self._get_registry()
-        return registry[key_id]
+        return self._get_registry()[key_id]
 
     def register_key(self, public_key):
         registry = self._get_registry()
         key_id = get_key_id_from_key_data(public_key)
+        if registry.get(key_id) == public_key:
+            return
+        registry = dict(registry)
         registry[key_id] = public_key
         self._write(registry)
 
@@ -107,6 +164,14 @@ def encrypt(data, recipient_key, params):
     return encode_message([alpha, beta, commitment, challenge, response])
 
 
+def encrypt_many(values, recipient_key, params, nr_parallel=0):
+    messages = [int(value) for value in values]
+    encrypted = core.encrypt_and_prove_many(
+        params.modulus, params.generator, params.order, recipient_key,
+        messages, nr_parallel=nr_parallel)
+    return [encode_message(enc) for enc in encrypted]
+
+
 def get_mixing_input(enc_tuples, params, public):
     mixing_input = {}
     mixing_input['modulus'] = params.modulus
@@ -119,11 +184,17 @@ def get_mixing_input(enc_tuples, params, public):
     return mixing_input
 
 
-def encode_message(message):
+def encode_message(message, use_binary=False, params=None):
+    if use_binary:
+        data = binary.dumps(message, params=params)
+        return BINARY_PREFIX + base64.b64encode(data)
     return canonical.to_canonical(message)
 
 
 def decode_message(message):
+    if message.startswith(BINARY_PREFIX):
+        data = base64.b64decode(message[len(BINARY_PREFIX):])
+        return binary.loads(data, unicode_strings=True)
     return canonical.from_unicode_canonical(message)
 
 
@@ -135,6 +206,33 @@ def extract_proof(mixing_output):
     return {key: mixing_output[key] for key in keys}
 
 
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class StageTimer(object):
+    """Wall-clock time per stage of an operation, reported to the log.
+
+    Timings are kept out of the proofs, which must be deterministic.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.time() - start
+
+    def report(self):
+        stages = ', '.join('%s %.3fs' % item for item in self.timings.items())
+        log.info("%s timings: %s", self.operation, stages)
+
+
 def get_unique_recipient(messages):
     recipients = set(m["recipient"] for m in messages)
     if len(recipients) != 1:
@@ -142,7 +240,8 @@ def get_unique_recipient(messages):
     return recipients.pop()
 
 
-def process_sk_mix(endpoint, messages, params):
+def process_sk_mix(endpoint, messages, params, factors_path=None,
+                   nr_parallel=0):
     endpoint_params = canonical.from_unicode_canonical(
         endpoint["endpoint_params"])
     election_public = utils.unicode_to_int(
@@ -150,17 +249,46 @@ def process_sk_mix(endpoint, messages, params):
 
     message_texts = [m["text"] for m in messages]
     recipient = get_unique_recipient(messages)
-    mixed_messages, proof = mix(message_texts, params, election_public)
+    mixed_messages, proof = mix(message_texts, params, election_public,
+                                factors_path=factors_path,
+                                nr_parallel=nr_parallel)
     return utils.with_recipient(mixed_messages, recipient), proof
 
 
-def mix(enc_messages, params, election_public):
-    enc_tuples = [decode_message(m) for m in enc_messages]
-    mixing_input = get_mixing_input(enc_tuples, params, election_public)
-    mixing_output = core.mix_ciphers(mixing_input)
+def precompute_factors(path, params, election_public, nr_factors,
+                       nr_parallel=0):
+    core.precompute_reencryption_factors(
+        path, params.modulus, params.generator, params.order,
+        election_public, nr_factors, nr_parallel=nr_parallel)
+
+
+def open_factors(path, params, election_public):
+    if path is None or not os.path.exists(path):
+        return None
+    return core.PrecomputedFactors(
+        path, params.modulus, params.generator, params.order,
+        election_public)
+
+
+def mix(enc_messages, params, election_public, factors_path=None,
+        nr_parallel=0):
+    timer = StageTimer("mix")
+    with timer.stage("decode"):
+        enc_tuples = [decode_message(m) for m in enc_messages]
+        mixing_input = get_mixing_input(enc_tuples, params, election_public)
+    factors = open_factors(factors_path, params, election_public)
+    try:
+        with timer.stage("mix"):
+            mixing_output = core.mix_ciphers(
+                mixing_input, nr_parallel=nr_parallel, factors=factors)
+    finally:
+        if factors is not None:
+            factors.close()
     mixed_messages = mixing_output.pop('mixed_ciphers')
     proof = extract_proof(mixing_output)
-    encoded_mixed_messages = [encode_message(m) for m in mixed_messages]
+    with timer.stage("encode"):
+        encoded_mixed_messages = [encode_message(m) for m in mixed_messages]
+    timer.report()
     return encoded_mixed_messages, proof
 
 
@@ -175,37 +303,57 @@ def decrypt_one(message, params, secret):
     return str(decr), None
 
 
-def process_sk_decrypt(messages, params, secret):
+def process_sk_decrypt(messages, params, secret, nr_parallel=0):
     message_texts = [m["text"] for m in messages]
     recipient = get_unique_recipient(messages)
-    decrypted, proof = decrypt(message_texts, params, secret)
+    decrypted, proof = decrypt(message_texts, params, secret,
+                               nr_parallel=nr_parallel)
     return utils.with_recipient(decrypted, recipient), proof
 
 
-def decrypt(messages, params, secret):
-    cleartexts_with_proofs = [
-        decrypt_one(message, params, secret) for message in messages]
-    decrypted, proof = utils.unzip(cleartexts_with_proofs)
-    return decrypted, proof
+def decrypt(messages, params, secret, nr_parallel=0):
+    timer = StageTimer("decrypt")
+    with timer.stage("decode"):
+        ciphers = [decode_message(m)[:2] for m in messages]
+    with timer.stage("decrypt"):
+        decrypted = core.decrypt_ciphers(
+            params.modulus, params.generator, params.order, secret,
+            ciphers, nr_parallel=nr_parallel)
+    decrypted = [str(decr) for decr in decrypted]
+    timer.report()
+    # There is no decryption proof: one None per message, as decrypt_one
+    return decrypted, [None] * len(decrypted)
 
 
-def process_sk_partial_decrypt(messages, params, secret):
+def process_sk_partial_decrypt(messages, params, secret, use_binary=False,
+                               nr_parallel=0):
     message_texts = [m["text"] for m in messages]
     recipient = get_unique_recipient(messages)
-    decr_messages, proof = partial_decrypt(message_texts, params, secret)
+    decr_messages, proof = partial_decrypt(
+        message_texts, params, secret, use_binary=use_binary,
+        nr_parallel=nr_parallel)
     return utils.with_recipient(decr_messages, recipient), proof
 
 
-def partial_decrypt(messages, params, secret):
+def partial_decrypt(messages, params, secret, use_binary=False,
+                    nr_parallel=0):
     modulus = params.modulus
     generator = params.generator
     order = params.order
-    ciphers = [decode_message(m) for m in messages]
-    factors = core.compute_decryption_factors(
-        modulus, generator, order, secret, ciphers, nr_parallel=0)
-    betas = [beta for (_, beta) in ciphers]
-    result = zip(factors, betas)
-    return [encode_message(result)], None
+    timer = StageTimer("partial_decrypt")
+    with timer.stage("decode"):
+        ciphers = [decode_message(m) for m in messages]
+    with timer.stage("compute_factors"):
+        factors = core.compute_decryption_factors(
+            modulus, generator, order, secret, ciphers,
+            nr_parallel=nr_parallel)
+    with timer.stage("encode"):
+        betas = [beta for (_, beta) in ciphers]
+        result = zip(factors, betas)
+        encoded = encode_message(result, use_binary=use_binary,
+                                 params=params._asdict())
+    timer.report()
+    return [encoded], None
 
 
 def process_sk_combine(messages, params):
@@ -215,29 +363,33 @@ def process_sk_combine(messages, params):
     return utils.with_recipient(combined_messages, recipient), proof
 
 
-def combine(messages, params):
+def iter_combine(messages, params):
     modulus = params.modulus
     generator = params.generator
     order = params.order
-    factors_collection_with_betas = [decode_message(m) for m in messages]
     factors_collection = []
     common_betas = None
-    for factors_with_betas in factors_collection_with_betas:
-        factors, betas = utils.unzip(factors_with_betas)
+    for message in messages:
+        factors, betas = utils.unzip(decode_message(message))
         factors_collection.append(factors)
         if common_betas is None:
             common_betas = betas
         else:
             if common_betas != betas:
                 raise AssertionError("different betas")
+    if not factors_collection:
+        return
     combined_factors = core.combine_decryption_factors(
         modulus, factors_collection)
-    results = []
-    for combined_factor, beta in zip(combined_factors, common_betas):
-        results.append(core.decrypt_with_decryptor(
-            modulus, generator, order, beta, combined_factor))
-        encoded_results = [encode_message(m) for m in results]
-    return encoded_results, None
+    del factors_collection
+    results = core.iter_decrypt_with_decryptors(
+        modulus, generator, order, common_betas, combined_factors)
+    for result in results:
+        yield encode_message(result)
+
+
+def combine(messages, params):
+    return list(iter_combine(messages, params)), None
 
 
 class Server(object):
@@ -257,12 +409,16 @@ def get_server(config):
 
 
 class Client(object):
-    def __init__(self, crypto_params, registry_path, public, secret):
+    def __init__(self, crypto_params, registry_path, public, secret,
+                 binary_messages=False, factors_path=None, nr_parallel=0):
         self._crypto_params = crypto_params
         self.params = make_zeus_params(crypto_params)
         self.registry = Registry(registry_path)
         self.public = public
         self.secret = secret
+        self.binary_messages = binary_messages
+        self.factors_path = factors_path
+        self.nr_parallel = nr_parallel
         self.key_id = get_key_id_from_key_data(self.get_key_data())
 
     def get_key_data(self):
@@ -303,17 +459,28 @@ class Client(object):
         recipient_key = utils.unicode_to_int(self.registry.get_key(key_id))
         return encrypt(data, recipient_key, self.params)
 
+    def encrypt_many(self, values, recipient):
+        recipient_key = utils.unicode_to_int(self.registry.get_key(recipient))
+        encrypted = encrypt_many(values, recipient_key, self.params,
+                                 nr_parallel=self.nr_parallel)
+        return utils.with_recipient(encrypted, recipient)
+
     def process(self, endpoint, messages):
         endpoint_type = endpoint["endpoint_type"]
         if endpoint_type == "ZEUS_BOOTH":
             raise utils.NoProcessing(endpoint_type)
         if endpoint_type == "ZEUS_SK_MIX":
-            return process_sk_mix(endpoint, messages, self.params)
+            return process_sk_mix(endpoint, messages, self.params,
+                                  factors_path=self.factors_path,
+                                  nr_parallel=self.nr_parallel)
         if endpoint_type == "ZEUS_SK_PARTIAL_DECRYPT":
             return process_sk_partial_decrypt(
-                messages, self.params, self.secret)
+                messages, self.params, self.secret,
+                use_binary=self.binary_messages,
+                nr_parallel=self.nr_parallel)
         if endpoint_type == "ZEUS_SK_DECRYPT":
-            return process_sk_decrypt(messages, self.params, self.secret)
+            return process_sk_decrypt(messages, self.params, self.secret,
+                                      nr_parallel=self.nr_parallel)
         if endpoint_type == "ZEUS_SK_COMBINE":
             return process_sk_combine(messages, self.params)
         raise ValueError("Unsupported endpoint type")
@@ -349,7 +516,13 @@ def get_client(config):
     registry_path = config.get("REGISTRY_PATH")
     if registry_path is None:
         registry_path = mk_default_registry_path(public)
-    return Client(crypto_params, registry_path, public, secret)
+    binary_messages = config.get("BINARY_MESSAGES", False)
+    factors_path = config.get("PRECOMPUTED_FACTORS_PATH")
+    nr_parallel = config.get("NR_PARALLEL", 0)
+    return Client(crypto_params, registry_path, public, secret,
+                  binary_messages=binary_messages,
+                  factors_path=factors_path,
+                  nr_parallel=nr_parallel)
 
 
 def create_key(params, secret=None):
@@ -370,3 +543,44 @@ def create_key_settings(crypto_params):
     params = make_zeus_params(crypto_params)
     secret, public = create_key(params)
     return {"SECRET": secret, "PUBLIC": public}
+
+
+COMBINE_BENCHMARK_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def benchmark_combine(sizes=COMBINE_BENCHMARK_SIZES, nr_trustees=2,
+                      crypto_params=None, outstream=sys.stdout):
+    """Time combine() on random factors, to check it scales linearly.
+
+    combine does not verify the factor proofs, so they are left zero.
+    """
+    if crypto_params is None:
+        crypto_params = get_default_crypto_params()
+    params = make_zeus_params(crypto_params)
+    modulus = params.modulus
+    getrandbits = random.SystemRandom().getrandbits
+    nr_bits = modulus.bit_length() - 1
+    timings = {}
+    for nr_messages in sizes:
+        betas = [getrandbits(nr_bits) for _ in xrange(nr_messages)]
+        messages = []
+        for _ in xrange(nr_trustees):
+            factors = [[getrandbits(nr_bits), [0, 0, 0, 0]]
+                       for _ in xrange(nr_messages)]
+            messages.append(encode_message(zip(factors, betas)))
+            del factors
+        t0 = time.time()
+        results, _ = combine(messages, params)
+        elapsed = time.time() - t0
+        del messages, results
+        timings[nr_messages] = elapsed
+        outstream.write("%9d messages %10.3fs %8.1fus/message\n"
+                        % (nr_messages, elapsed,
+                           elapsed * 1e6 / nr_messages))
+        outstream.flush()
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_combine([int(arg) for arg in sys.argv[1:]] or
+                      COMBINE_BENCHMARK_SIZES)
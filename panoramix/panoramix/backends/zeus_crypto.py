@@ -7,41 +7,67 @@ import sys
 PYTHON_MAJOR = sys.version_info[0]
 from datetime import datetime
 from random import randint, shuffle, choice
-from collections import deque
 from hashlib import sha256, sha1
+from array import array
 from itertools import izip, cycle, chain, repeat
 from functools import partial
 from math import log
 from bisect import bisect_right
 import Crypto.Util.number as number
 inverse = number.inverse
-from Crypto import Random
 from operator import mul as mul_operator
-from os import (fork, kill, getpid, waitpid, ftruncate, lseek, fstat,
-                read, write, unlink, open as os_open, close,
-                O_CREAT, O_RDWR, O_APPEND, SEEK_CUR, SEEK_SET)
-from fcntl import flock, LOCK_EX, LOCK_UN
-from multiprocessing import Semaphore, Queue as mpQueue
-from Queue import Empty, Full
+from multiprocessing import Process, Pipe
+from os import makedirs, getpid, urandom, rename, fstat, fchmod, fdopen
+from os import open as os_open, close as os_close
+from os import O_WRONLY, O_CREAT, O_TRUNC, O_APPEND
+from os.path import isdir, exists, join as path_join
+from threading import Lock
+from marshal import load as marshal_load, dump as marshal_dump
+from pickle import PicklingError
 from select import select
-from signal import SIGKILL
-from errno import ESRCH
+from stat import S_ISREG
+from mmap import mmap, ACCESS_READ
 from cStringIO import StringIO
-from marshal import loads as marshal_loads, dumps as marshal_dumps
 from json import load as json_load
 from binascii import hexlify
-import inspect
 import re
-from time import time, sleep
+from time import time
 
 try:
-    from gmpy import mpz
+    from gmpy import mpz, jacobi, invert
     _pow = pow
 
     def pow(b, e, m):
         return int(_pow(mpz(b), e, m))
+
+    def mod_inverse(a, m):
+        # invert() returns 0 when there is no inverse
+        a_inverse = int(invert(mpz(a), m))
+        if not a_inverse:
+            raise ValueError("mod_inverse: element not invertible")
+        return a_inverse
 except ImportError:
     print "Warning: Could not import gmpy. Falling back to SLOW crypto."
+    mpz = long
+
+    def mod_inverse(a, m):
+        if not a % m:
+            raise ValueError("mod_inverse: element not invertible")
+        return inverse(a, m)
+
+    def jacobi(a, n):
+        a %= n
+        result = 1
+        while a:
+            while not a & 1:
+                a >>= 1
+                if n & 7 in (3, 5):
+                    result = -result
+            a, n = n, a
+            if a & 3 == 3 and n & 3 == 3:
+                result = -result
+            a %= n
+        return result if n == 1 else 0
 
 bit_length = lambda num: num.bit_length()
 if sys.version_info < (2, 7):
@@ -85,7 +111,43 @@ V_CHALLENGE     =   'CHALLENGE: '
 V_RESPONSE      =   'RESPONSE: '
 V_COMMENTS      =   'COMMENTS: '
 
-_random_generator_file = Random.new()
+RANDOM_BLOCK_SIZE = 65536
+
+class RandomPool(object):
+    """
+    Random bytes served from large blocks read from the OS generator.
+
+    The pool is emptied in a forked child before first use,
+    so that a child never hands out bytes already seen by its parent.
+    """
+
+    def __init__(self, block_size=RANDOM_BLOCK_SIZE):
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        self.pid = getpid()
+        self.lock = Lock()
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, nr_bytes):
+        if self.pid != getpid():
+            self.reset()
+        with self.lock:
+            buf = self.buffer
+            offset = self.offset
+            end = offset + nr_bytes
+            if end > len(buf):
+                buf = buf[offset:]
+                buf += urandom(max(self.block_size, nr_bytes - len(buf)))
+                self.buffer = buf
+                offset = 0
+                end = nr_bytes
+            self.offset = end
+            return buf[offset:end]
+
+_random_pool = RandomPool()
 
 
 def c2048():
@@ -170,638 +232,635 @@ def sk_from_args(p, g, q, x, y, t, c, f):
 def get_timestamp():
     return datetime.strftime(datetime.utcnow(), "%Y-%m-%dT%H:%M:%S.%fZ")
 
-def to_canonical(obj, out=None):
-    toplevel = 0
-    if out is None:
-        toplevel = 1
-        out = StringIO()
+FLAT_LIST_BATCH = 4096
+WRITE_BATCH = 4096
+
+
+def encode_string(obj):
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    x = "%x" % len(obj)
+    return "%02x%s_" % (len(x), x) + obj
+
+
+def encode_int(obj):
+    s = "%x" % obj
+    x = "%x" % len(s)
+    return "%02x%s0%s" % (len(x), x, s)
+
+
+def encode_int_pair(pair):
+    a, b = pair
+    return "[\x0a%s,\x0a%s]\x0a" % (encode_int(a), encode_int(b))
+
+
+def encode_null(obj):
+    return 'null'
+
+
+SCALAR_ENCODERS = {
+    str: encode_string,
+    unicode: encode_string,
+    int: encode_int,
+    long: encode_int,
+    bool: encode_int,
+    type(None): encode_null,
+}
+
+INT_TYPES = (int, long)
+LIST_TYPES = (list, tuple)
+
+KIND_LIST = 1
+KIND_DICT = 2
+
+CONTAINER_KINDS = {
+    list: KIND_LIST,
+    tuple: KIND_LIST,
+    dict: KIND_DICT,
+}
+
+
+def classify(obj):
     if isinstance(obj, basestring):
-        if isinstance(obj, unicode):
-            obj = obj.encode('utf-8')
-        z = len(obj)
-        x = "%x" % z
-        w = ("%02x" % len(x))[:2]
-        out.write("%s%s_" % (w, x))
-        out.write(obj)
-    elif isinstance(obj, int) or isinstance(obj, long):
-        s = "%x" % obj
-        z = len(s)
-        x = "%x" % z
-        w = ("%02x" % len(x))[:2]
-        out.write("%s%s0%s" % (w, x, s))
-    elif isinstance(obj, dict):
-        out.write('{\x0a')
-        cobj = {}
-        for k, v in obj.iteritems():
-            if not isinstance(k, str):
-                if isinstance(k, unicode):
-                    k = k.encode('utf-8')
-                elif isinstance(k, int) or isinstance(k, long):
-                    k = str(k)
-                else:
-                    m = "Unsupported dict key type '%s'" % (type(k),)
-            cobj[k] = v
-        del obj
-        keys = cobj.keys()
-        keys.sort()
-        prev = None
-        for k in keys:
-            if prev is not None:
-                out.write(',\x0a')
-            if k == prev:
-                tail = '...' if len(k) > 64 else ''
-                m = "duplicate key '%s' in dict" % (k[:64] + tail,)
-                raise AssertionError(m)
-            to_canonical(k, out=out)
-            out.write(': ')
-            to_canonical(cobj[k], out=out)
-            prev = k
-        out.write('}\x0a')
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        out.write('[\x0a')
-        iterobj = iter(obj)
-        for o in iterobj:
-            to_canonical(o, out=out)
+        return encode_string, None
+    if isinstance(obj, int) or isinstance(obj, long):
+        return encode_int, None
+    if isinstance(obj, dict):
+        return None, KIND_DICT
+    if isinstance(obj, list) or isinstance(obj, tuple):
+        return None, KIND_LIST
+    m = "to_canonical: invalid object type '%s'" % (type(obj),)
+    raise AssertionError(m)
+
+
+def flat_list_encoder(obj):
+    """Return an item encoder if obj holds only integers or integer pairs"""
+    t = type(obj[0])
+    if t in INT_TYPES:
+        for item in obj:
+            if type(item) not in INT_TYPES:
+                return None
+        return encode_int
+
+    if t in LIST_TYPES:
+        for item in obj:
+            if type(item) not in LIST_TYPES or len(item) != 2:
+                return None
+            a, b = item
+            if type(a) not in INT_TYPES or type(b) not in INT_TYPES:
+                return None
+        return encode_int_pair
+
+    return None
+
+
+def sorted_items(obj):
+    keys = obj.keys()
+    for k in keys:
+        if type(k) is not str:
             break
-        for o in iterobj:
-            out.write(',\x0a')
-            to_canonical(o, out=out)
-        out.write(']\x0a')
-    elif obj is None:
-        out.write('null')
     else:
-        m = "to_canonical: invalid object type '%s'" % (type(obj),)
-        raise AssertionError(m)
+        keys.sort()
+        return [(k, obj[k]) for k in keys]
+
+    cobj = {}
+    for k, v in obj.iteritems():
+        if not isinstance(k, str):
+            if isinstance(k, unicode):
+                k = k.encode('utf-8')
+            elif isinstance(k, int) or isinstance(k, long):
+                k = str(k)
+        cobj[k] = v
+    keys = cobj.keys()
+    keys.sort()
+    return [(k, cobj[k]) for k in keys]
+
+
+def encode_key(k):
+    if type(k) is str:
+        return encode_string(k)
+    return to_canonical(k)
+
+
+def write_canonical(obj, write):
+    """Encode obj canonically, passing the output in pieces to write.
+
+    Containers are kept on an explicit stack instead of recursing, and
+    lists of integers or integer pairs, like ciphers, are encoded in
+    batches. Small tokens are gathered and written together, so the
+    largest piece written is bounded by the batch sizes and not by the
+    size of obj.
+    """
+    pieces = []
+    emit = pieces.append
+    stack = []
+    while 1:
+        t = type(obj)
+        encode = SCALAR_ENCODERS.get(t)
+        kind = CONTAINER_KINDS.get(t)
+        if encode is None and kind is None:
+            encode, kind = classify(obj)
+
+        if encode is not None:
+            emit(encode(obj))
+
+        elif kind == KIND_LIST:
+            encode = flat_list_encoder(obj) if obj else None
+            if encode is not None:
+                emit('[\x0a')
+                write(''.join(pieces))
+                del pieces[:]
+                for i in xrange(0, len(obj), FLAT_LIST_BATCH):
+                    sep = '' if i == 0 else ',\x0a'
+                    write(sep + ',\x0a'.join(
+                        map(encode, obj[i:i+FLAT_LIST_BATCH])))
+                emit(']\x0a')
+            elif obj:
+                it = iter(obj)
+                obj = next(it)
+                emit('[\x0a')
+                stack.append((it, KIND_LIST))
+                continue
+            else:
+                emit('[\x0a]\x0a')
 
-    if toplevel:
-        out.seek(0)
-        return out.read()
+        else:
+            items = sorted_items(obj)
+            if items:
+                it = iter(items)
+                k, obj = next(it)
+                emit('{\x0a' + encode_key(k) + ': ')
+                stack.append((it, KIND_DICT))
+                continue
+            emit('{\x0a}\x0a')
 
-def from_canonical(inp, unicode_strings=0, s=''):
-    if isinstance(inp, str):
-        inp = StringIO(inp)
+        if len(pieces) >= WRITE_BATCH:
+            write(''.join(pieces))
+            del pieces[:]
 
-    read = inp.read
-    if not s:
-        s = read(2)
+        while stack:
+            it, kind = stack[-1]
+            for obj in it:
+                break
+            else:
+                stack.pop()
+                emit(']\x0a' if kind == KIND_LIST else '}\x0a')
+                continue
 
-    if s == 'nu':
-        s += read(2)
-        if s == 'null':
-            return None
+            if kind == KIND_LIST:
+                emit(',\x0a')
+            else:
+                k, obj = obj
+                emit(',\x0a' + encode_key(k) + ': ')
+            break
         else:
-            m = ("byte %d: invalid token '%s' instead of 'null'"
-                % (inp.tell(), s))
-            raise ValueError(m)
+            write(''.join(pieces))
+            return
 
-    if s == '[\x0a':
-        obj = []
-        append = obj.append
-        while 1:
-            s = read(2)
-            if not s:
-                m = "byte %d: eof within a list" % inp.tell()
-                raise ValueError(m)
 
-            if s == ']\x0a':
-                return obj
+def to_canonical(obj, out=None):
+    if out is not None:
+        write_canonical(obj, out.write)
+        return
 
-            item = from_canonical(inp, unicode_strings=unicode_strings, s=s)
-            append(item)
+    pieces = []
+    write_canonical(obj, pieces.append)
+    return ''.join(pieces)
 
-            s = read(2)
-            if s == ']\x0a':
-                return obj
 
-            if s != ',\x0a':
-                m = ("byte %d: in list: illegal token '%s' instead of ',\\n'"
-                    % (inp.tell(), s))
-                raise ValueError(m)
+def hash_canonical(obj):
+    hasher = sha256()
+    write_canonical(obj, hasher.update)
+    return hasher.hexdigest()
 
-    if s == '{\x0a':
-        obj = {}
-        while 1:
-            s = read(2)
-            if not s:
-                m = "byte %d: eof within dict" % inp.tell()
-                raise ValueError(m)
 
-            if s == '}\x0a':
-                return obj
+READ_CHUNK_SIZE = 1 << 20
 
-            key = from_canonical(inp, unicode_strings=unicode_strings, s=s)
-            s = read(2)
-            if s != ': ':
-                m = ("byte %d: invalid token '%s' instead of ': '"
-                    % (inp.tell(), s))
-                raise ValueError(m)
+LIST_START = '[\x0a'
+LIST_END = ']\x0a'
+DICT_START = '{\x0a'
+DICT_END = '}\x0a'
+ITEM_SEPARATOR = ',\x0a'
+KEY_SEPARATOR = ': '
 
-            value = from_canonical(inp, unicode_strings=unicode_strings)
-            obj[key] = value  # allow key TypeError rise through
+class CanonicalReader(object):
+    """Read a canonical stream in large chunks, keeping track of the offset"""
 
-            s = read(2)
-            if not s:
-                m = "byte %d: eof inside dict" % inp.tell()
-                raise ValueError(m)
+    def __init__(self, inp, chunk_size=READ_CHUNK_SIZE):
+        self.inp = inp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+        try:
+            self.base = inp.tell()
+        except (AttributeError, IOError):
+            self.base = 0
+
+    def tell(self):
+        return self.base + self.pos
+
+    def fill(self, n):
+        buf = self.buf[self.pos:]
+        self.base += self.pos
+        self.pos = 0
+        buf += self.inp.read(max(n - len(buf), self.chunk_size))
+        self.buf = buf
+        self.size = len(buf)
+
+    def read(self, n):
+        pos = self.pos
+        end = pos + n
+        if end > self.size:
+            self.fill(n)
+            pos = 0
+            end = min(n, self.size)
+        self.pos = end
+        return self.buf[pos:end]
+
+    def seek(self, offset):
+        if self.base <= offset <= self.base + self.size:
+            self.pos = offset - self.base
+            return
+        self.inp.seek(offset)
+        self.base = offset
+        self.buf = ''
+        self.pos = 0
+        self.size = 0
+
+    def release(self):
+        """Leave the underlying stream right after the bytes consumed"""
+        if self.pos != self.size:
+            self.inp.seek(self.tell())
+            self.base = self.tell()
+            self.buf = ''
+            self.pos = 0
+            self.size = 0
+
+
+def get_reader(inp):
+    """Return a reader over inp with read(), tell() and seek().
+
+    Regular files are memory mapped so that the kernel pages them in and
+    out as they are decoded. Other streams are read in large chunks.
+    """
+    if isinstance(inp, str):
+        return StringIO(inp)
+    if isinstance(inp, CanonicalReader) or not hasattr(inp, 'fileno'):
+        return inp
+    try:
+        fileno = inp.fileno()
+        offset = inp.tell()
+        st = fstat(fileno)
+    except (IOError, OSError, ValueError):
+        return CanonicalReader(inp)
+    if not S_ISREG(st.st_mode) or st.st_size == 0:
+        return CanonicalReader(inp)
+    reader = mmap(fileno, 0, access=ACCESS_READ)
+    reader.seek(offset)
+    return reader
+
+
+def release_reader(inp, reader):
+    if reader is inp or isinstance(inp, str):
+        return
+    if isinstance(reader, CanonicalReader):
+        reader.release()
+        return
+    inp.seek(reader.tell())
+    reader.close()
 
-            if s == '}\x0a':
-                return obj
 
-            if s != ',\x0a':
-                m = ("byte %d: illegal token '%s' in dict instead of ',\\n'"
-                    % (inp.tell(), s))
-                raise ValueError(m)
+def read_scalar(reader, s, unicode_strings=0, decode=True):
+    read = reader.read
+    if s == 'nu':
+        s += read(2)
+        if s == 'null':
+            return None
+        else:
+            m = ("byte %d: invalid token '%s' instead of 'null'"
+                % (reader.tell(), s))
+            raise ValueError(m)
+
+    if len(s) != 2:
+        m = "byte %d: eof while reading object" % reader.tell()
+        raise ValueError(m)
 
     w = int(s, 16)
     s = read(w)
     if len(s) != w:
-        m = "byte %d: eof while reading header size %d" % (inp.tell(), w)
+        m = "byte %d: eof while reading header size %d" % (reader.tell(), w)
         raise ValueError(m)
 
     z = int(s, 16)
     c = read(1)
     if not c:
-        m = "byte %d: eof while reading object tag" % inp.tell()
+        m = "byte %d: eof while reading object tag" % reader.tell()
         raise ValueError(m)
 
     s = read(z)
     if len(s) != z:
-        m = "byte %d: eof while reading object size %d" % (inp.tell(), z)
+        m = "byte %d: eof while reading object size %d" % (reader.tell(), z)
         raise ValueError(m)
 
     if c == '_':
-        if unicode_strings:
+        if unicode_strings and decode:
             try:
                 s = s.decode('utf-8')
             except UnicodeDecodeError:
                 pass
         return s
     elif c == '0':
-        num = int(s, 16)
-        return num
+        return int(s, 16) if decode else None
     else:
-        m = "byte %d: invalid object tag '%d'" % (inp.tell()-z, c)
+        m = "byte %d: invalid object tag '%s'" % (reader.tell()-z, c)
         raise ValueError(m)
 
 
-#class Empty(Exception):
-#    pass
-#class Full(Exception):
-#    pass
-class EOF(Exception):
-    pass
+def read_key(reader, s, unicode_strings=0):
+    if not s:
+        m = "byte %d: eof within dict" % reader.tell()
+        raise ValueError(m)
 
-MV_ASYNCARGS = '=ASYNCARGS='
-MV_EXCEPTION = '=EXCEPTION='
+    key = read_scalar(reader, s, unicode_strings=unicode_strings)
+    s = reader.read(2)
+    if s != KEY_SEPARATOR:
+        m = ("byte %d: invalid token '%s' instead of ': '"
+            % (reader.tell(), s))
+        raise ValueError(m)
+    return key
+
+
+def read_canonical(reader, unicode_strings=0, s=''):
+    """Decode the canonical value at the current position of reader.
+
+    Containers are kept on an explicit stack, so nesting depth is not
+    limited by Python recursion.
+    """
+    read = reader.read
+    if not s:
+        s = read(2)
 
-def wait_read(fd, block=True, timeout=0):
-    if block:
-        timeout = None
+    stack = []
+    obj = None
+    key = None
     while 1:
-        r, w, x = select([fd], [], [], timeout)
-        if not r:
-            if not block:
-                raise Empty()
-            else:
-                raise EOF("Select Error")
-        if block:
-            st = fstat(fd)
-            if not st.st_size:
-                sleep(0.01)
+        if s == LIST_START:
+            s = read(2)
+            if s != LIST_END:
+                if not s:
+                    m = "byte %d: eof within a list" % reader.tell()
+                    raise ValueError(m)
+                stack.append((obj, key))
+                obj = []
+                key = None
                 continue
+            value = []
 
-def read_all(fd, size):
-    got = 0
-    s = ''
-    while got < size:
-        r = read(fd, size-got)
-        if not r:
-            break
-        got += len(r)
-        s += r
-    return s
+        elif s == DICT_START:
+            s = read(2)
+            if s != DICT_END:
+                stack.append((obj, key))
+                obj = {}
+                key = read_key(reader, s, unicode_strings=unicode_strings)
+                s = read(2)
+                continue
+            value = {}
+
+        elif s == 'nu' or len(s) != 2:
+            value = read_scalar(reader, s)
 
-def wait_write(fd, block=True, timeout=0):
-    if block:
-        timeout = None
-    r, w, x = select([], [fd], [], timeout)
-    if not w:
-        if not block:
-            raise Full()
         else:
-            raise EOF("Write Error")
+            w = int(s, 16)
+            s = read(w)
+            if len(s) != w:
+                m = ("byte %d: eof while reading header size %d"
+                    % (reader.tell(), w))
+                raise ValueError(m)
+            z = int(s, 16)
+            c = read(1)
+            value = read(z)
+            if len(value) != z:
+                m = ("byte %d: eof while reading object size %d"
+                    % (reader.tell(), z))
+                raise ValueError(m)
+            if c == '0':
+                value = int(value, 16)
+            elif c == '_':
+                if unicode_strings:
+                    try:
+                        value = value.decode('utf-8')
+                    except UnicodeDecodeError:
+                        pass
+            elif not c:
+                m = "byte %d: eof while reading object tag" % reader.tell()
+                raise ValueError(m)
+            else:
+                m = ("byte %d: invalid object tag '%s'"
+                    % (reader.tell()-z, c))
+                raise ValueError(m)
 
-def write_all(fd, data):
-    size = len(data)
-    written = 0
-    while written < size:
-        w = write(fd, buffer(data, written, size-written))
-        if not w:
-            m = "Write EOF"
-            raise EOF(m)
-        written += w
-    return written
+        while 1:
+            if obj is None:
+                return value
+            if type(obj) is list:
+                obj.append(value)
+                end = LIST_END
+            else:
+                obj[key] = value  # allow key TypeError rise through
+                end = DICT_END
 
+            s = read(2)
+            if s == ITEM_SEPARATOR:
+                if end == DICT_END:
+                    key = read_key(reader, read(2),
+                                   unicode_strings=unicode_strings)
+                s = read(2)
+                break
 
-class CheapQueue(object):
-    _initpid = None
-    _pid = _initpid
-    _serial = 0
+            if s == end:
+                value = obj
+                obj, key = stack.pop()
+                continue
 
-    @classmethod
-    def atfork(cls):
-        cls._pid = getpid()
+            if not s:
+                m = "byte %d: eof inside %s" % (
+                    reader.tell(), 'list' if end == LIST_END else 'dict')
+            else:
+                m = ("byte %d: illegal token '%s' instead of ',\\n'"
+                    % (reader.tell(), s))
+            raise ValueError(m)
 
-    def __init__(self):
-        pid = getpid()
-        self._initpid = pid
-        self._pid = None
-        serial = CheapQueue._serial + 1
-        CheapQueue._serial = serial
-        self.serial = serial
-        self.frontfile = '/dev/shm/cheapQ.%s.%s.front' % (pid, serial)
-        self.backfile = '/dev/shm/cheapQ.%s.%s.back' % (pid, serial)
-        self.front_fd = None
-        self.back_fd = None
-        self.front_sem = Semaphore(0)
-        self.back_sem = Semaphore(0)
-        self.getcount = 0
-        self.putcount = 0
-        self.get_input = self.init_input
-        self.get_output = self.init_output
-
-    def init(self):
-        frontfile = self.frontfile
-        self.front_fd = os_open(frontfile, O_RDWR|O_CREAT|O_APPEND, 0600)
-        backfile = self.backfile
-        self.back_fd = os_open(backfile, O_RDWR|O_CREAT|O_APPEND, 0600)
-        self._pid = getpid()
-        del self.get_output
-        del self.get_input
 
-    def __del__(self):
-        try:
-            close(self.front_fd)
-            close(self.back_fd)
-            unlink(self.frontfile)
-            unlink(self.backfile)
-        except:
-            pass
-
-    def init_input(self):
-        self.init()
-        return self.get_input()
-
-    def init_output(self):
-        self.init()
-        return self.get_output()
-
-    def get_input(self):
-        if self._pid == self._initpid:
-            return self.front_sem, self.front_fd
-        else:
-            return self.back_sem, self.back_fd
+def from_canonical(inp, unicode_strings=0):
+    reader = get_reader(inp)
+    try:
+        return read_canonical(reader, unicode_strings=unicode_strings)
+    finally:
+        release_reader(inp, reader)
 
-    def get_output(self):
-        if self._pid == self._initpid:
-            return self.back_sem, self.back_fd
-        else:
-            return self.front_sem, self.front_fd
-
-    def down(self, sema, timeout=None):
-        #if timeout is None:
-        #    print ("REQ DOWN %d %d %d [%d %d]"
-        #            % (self.serial, getpid(), sema._semlock.handle,
-        #               self.front_sem._semlock.handle,
-        #               self.back_sem._semlock.handle))
-        ret = sema.acquire(True, timeout=timeout)
-        #if ret:
-        #    print "DOWN %d %d" % (self.serial, getpid())
-        return ret
-
-    def up(self, sema, timeout=None):
-        sema.release()
-        #print ("UP %d %d %d [%d %d]"
-        #        % (self.serial, getpid(), sema._semlock.handle,
-        #           self.front_sem._semlock.handle,
-        #           self.back_sem._semlock.handle))
-
-    def put(self, obj, block=True, timeout=0):
-        data = marshal_dumps(obj)
-        sema, fd = self.get_output()
-        #if self._pid == self._initpid:
-        #    print "> PUT  ", getpid(), self.serial, self.putcount, '-'
-        #else:
-        #    print "  PUT <", getpid(), self.serial, self.putcount, '-'
-        chk = sha256(data).digest()
-        flock(fd, LOCK_EX)
-        try:
-            write_all(fd, "%016x%s" % (len(data), chk))
-            write_all(fd, data)
-        finally:
-            flock(fd, LOCK_UN)
-            self.up(sema)
-        self.putcount += 1
-
-    def get(self, block=True, timeout=0):
-        if block:
-            timeout=None
-        sema, fd = self.get_input()
-        #if self._pid == self._initpid:
-        #    print "< GET  ", getpid(), self.serial, self.getcount, '-'
-        #else:
-        #    print "  GET >", getpid(), self.serial, self.getcount, '-'
-        if not self.down(sema, timeout=timeout):
-            raise Empty()
-        flock(fd, LOCK_EX)
-        try:
-            header = read_all(fd, 48)
-            chk = header[16:]
-            header = header[:16]
-            size = int(header, 16)
-            data = read_all(fd, size)
-            pos = lseek(fd, 0, SEEK_CUR)
-            if pos > 1048576:
-                st = fstat(fd)
-                if pos >= st.st_size:
-                    ftruncate(fd, 0)
-                    lseek(fd, 0, SEEK_SET)
-        finally:
-            flock(fd, LOCK_UN)
-        _chk = sha256(data).digest()
-        if chk != _chk:
-            raise AssertionError("Corrupt Data!")
-        obj = marshal_loads(data)
-        self.getcount += 1
-        return obj
-
-#Queue = mpQueue
-Queue = CheapQueue
-
-def async_call(func, args, kw, channel):
-    argspec = inspect.getargspec(func)
-    if argspec.keywords or 'async_channel' in argspec.args:
-        kw['async_channel'] = channel
-    return func(*args, **kw)
-
-def async_worker(link):
+
+EXECUTOR_RESULT = '=RESULT='
+EXECUTOR_ERROR = '=ERROR='
+EXECUTOR_CHUNKS_PER_WORKER = 4
+EXECUTOR_MIN_CHUNK = 16
+
+def executor_worker(conn, shared):
     while 1:
-        inp = link.receive()
-        if inp is None:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
             break
+        func, args = task
         try:
-            if not isinstance(inp, tuple) and inp and inp[0] != MV_ASYNCARGS:
-                m = "%x: first input not in MV_ASYNCARGS format: '%s'" % (inp,)
-                raise ValueError(m)
-            mv, func, args, kw = inp
-            func = globals()[func]
-            ret = async_call(func, args, kw, link)
-            link.send(ret)
+            result = (EXECUTOR_RESULT, func(shared, *args))
         except Exception, e:
-            #import traceback
-            #traceback.print_exc()
-            e = (MV_EXCEPTION, str(e))
-            link.send_shared(e)
-            raise
-        finally:
-            link.disconnect()
-
-class AsyncWorkerLink(object):
-    def __init__(self, pool, index):
-        self.pool = pool
-        self.index = index
-
-    def send(self, data, wait=1):
-        self.pool.master_queue.put((self.index, data), block=wait)
-
-    def receive(self, wait=1):
-        ret = self.pool.worker_queues[self.index].get(block=wait)
-        if isinstance(ret, tuple) and ret and ret[0] == MV_EXCEPTION:
-            raise Exception(ret[1])
-        return ret
-
-    def send_shared(self, data, wait=1):
-        self.pool.master_queue.put((0, data), block=wait)
-
-    def disconnect(self, wait=1):
-        self.pool.master_queue.put((self.index, None), block=wait)
-
-class AsyncWorkerPool(object):
-    def __init__(self, nr_parallel, worker_func):
-        master_queue = Queue()
-        self.master_queue = master_queue
-        self.worker_queues = [master_queue] + [
-                              Queue() for _ in xrange(nr_parallel)]
-        worker_pids = []
-        self.worker_pids = worker_pids
-        append = worker_pids.append
-
-        for i in xrange(nr_parallel):
-            pid = fork()
-            Random.atfork()
-            CheapQueue.atfork()
-            if not pid:
-                try:
-                    worker_link = AsyncWorkerLink(self, i+1)
-                    worker_func(worker_link)
-                finally:
-                    try:
-                        kill(getpid(), SIGKILL)
-                    except:
-                        pass
-                    while 1:
-                        print "PLEASE KILL ME"
-                        sleep(1)
-            append(pid)
+            result = (EXECUTOR_ERROR, e)
+        try:
+            conn.send(result)
+        except (PicklingError, TypeError):
+            e = ZeusError("%s: %s" % (result[1].__class__.__name__,
+                                      result[1]))
+            conn.send((EXECUTOR_ERROR, e))
+    conn.close()
 
-    def kill(self):
-        for pid in self.worker_pids:
-            try:
-                kill(pid, SIGKILL)
-                waitpid(pid, 0)
-            except OSError, e:
-                if e.errno != ESRCH:
-                    raise
-
-    def send(self, worker, data):
-        if not worker:
-            m = "Controller attempt to write to master link"
-            raise AssertionError(m)
-        self.worker_queues[worker].put(data)
 
-    def receive(self, wait=1):
-        try:
-            val = self.master_queue.get(block=wait)
-        except Empty:
-            val = None
-        return val
-
-class AsyncChannel(object):
-    def __init__(self, controller):
-        self.controller = controller
-        self.channel_no = controller.get_channel()
-
-    def send(self, data):
-        return self.controller.send(self.channel_no, data)
-
-    def receive(self, wait=1):
-        data = self.controller.receive(self.channel_no, wait=wait)
-        if isinstance(data, tuple) and data and data[0] == MV_EXCEPTION:
-            raise Exception(data[1])
-        return data
-
-class AsyncFunc(object):
-    def __init__(self, controller, func, args, kw):
-        self.controller = controller
-        self.func = func
-        self.args = args
-        self.kw = kw
-
-    def __call__(self, *args, **kw):
-        call_kw = dict(self.kw)
-        call_kw.update(kw)
-        call_args = self.args + args
-        call_func = self.func
-        controller = self.controller
-        async_args = (MV_ASYNCARGS, call_func.__name__, call_args, call_kw)
-        channel = AsyncChannel(controller)
-        controller.submit(channel.channel_no, async_args)
-        return channel
-
-class AsyncController(object):
-    serial = 0
-    parallel = 0
-    channel_queue = None
-    shared_queue = None
-
-    def __new__(cls, *args, **kw):
-        parallel = int(kw.get('parallel', 2))
-        self = object.__new__(cls)
-        master_link = AsyncWorkerPool(parallel, async_worker)
-        self.master_link = master_link
-        self.idle_workers = set(xrange(1, parallel + 1))
-        self.worker_to_channel = [0] + [None] * (parallel)
-        self.channel_to_worker = {0: 0}
-        self.pending = deque()
-        self.channels = {0: deque()}
-        self.parallel = parallel
+class SerialExecutor(object):
+    """
+    Run tasks in the current process.
+
+    Tasks are argument tuples; each is run as func(shared, *args),
+    where shared is the read-only input given at creation.
+    """
+
+    def __init__(self, nr_parallel=0, shared=None):
+        self.nr_parallel = 0
+        self.shared = shared
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(terminate=exc_type is not None)
+
+    def imap(self, func, tasks):
+        shared = self.shared
+        for args in tasks:
+            yield func(shared, *args)
+
+    def shutdown(self, terminate=False):
+        pass
+
+
+class ProcessExecutor(SerialExecutor):
+    """
+    Run tasks in a pool of forked worker processes.
+
+    The shared input is inherited by the workers through fork()
+    and is never serialized. Only the task arguments and results
+    travel through the pipes. A worker that dies is detected as EOF
+    on its pipe and aborts the whole computation.
+    """
+
+    def __init__(self, nr_parallel=2, shared=None):
+        self.nr_parallel = nr_parallel
+        self.shared = shared
+        self.workers = []
+        append = self.workers.append
+        for _ in xrange(nr_parallel):
+            conn, worker_conn = Pipe()
+            process = Process(target=executor_worker,
+                              args=(worker_conn, shared))
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            append((process, conn))
+
     def __del__(self):
-        self.shutdown()
-
-    def shutdown(self):
-        master_link = self.master_link
-        for i in xrange(1, self.parallel + 1):
-            master_link.send(i, None)
-        sleep(0.3)
-        self.master_link.kill()
-
-    def get_channel(self):
-        channel = self.serial + 1
-        self.serial = channel
-        return channel
-
-    def process(self, wait=0):
-        master_link = self.master_link
-        idle_workers = self.idle_workers
-        pending = self.pending
-        channel_to_worker = self.channel_to_worker
-        worker_to_channel = self.worker_to_channel
-        channels = self.channels
-
-        _wait = wait
-        while 1:
-            blocked = []
-            while pending:
-                channel, data = pending.pop()
-                if channel in channel_to_worker:
-                    worker = channel_to_worker[channel]
-                    master_link.send(worker, data)
-                elif not idle_workers:
-                    blocked.append((channel, data))
-                else:
-                    worker = idle_workers.pop()
-                    channel_to_worker[channel] = worker
-                    worker_to_channel[worker] = channel
-                    master_link.send(worker, data)
-            for b in blocked:
-                pending.appendleft(b)
-
-            data = master_link.receive(wait=_wait)
-            if data is None:
-                break
-            _wait = 0
+        self.shutdown(terminate=True)
 
-            worker, data = data
-            channel = worker_to_channel[worker]
-            if channel is None:
-                continue
+    def imap(self, func, tasks):
+        workers = self.workers
+        if not workers:
+            m = "Executor has been shut down"
+            raise ZeusError(m)
 
-            if data is None:
-                if worker > 0:
-                    worker_to_channel[worker] = None
-                else:
-                    m = "Attempt to disconnect master link"
-                    raise AssertionError(m)
-                if channel > 0:
-                    del channel_to_worker[channel]
+        tasks = enumerate(tasks)
+        idle = list(workers)
+        busy = {}
+        results = {}
+        next_index = 0
+        exhausted = False
+
+        while 1:
+            while idle and not exhausted:
+                for index, args in tasks:
+                    worker = idle.pop()
+                    process, conn = worker
+                    conn.send((func, tuple(args)))
+                    busy[conn.fileno()] = (worker, index)
+                    break
                 else:
-                    m = "Attempt to close master channel"
-                    raise AssertionError(m)
+                    exhausted = True
 
-                idle_workers.add(worker)
-            else:
-                channels[channel].appendleft(data)
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
 
-    def send(self, channel_no, data):
-        channels = self.channels
-        channel_to_worker = self.channel_to_worker
-        if channel not in channel_to_worker:
-            return
-        worker = channel_to_worker[channel]
-        self.master_link.send(worker, data)
+            if not busy:
+                if exhausted:
+                    break
+                continue
 
-    def receive(self, channel_no, wait=1):
-        channels = self.channels
-        if channel_no not in channels:
-            return None
+            ready, w, x = select(busy.keys(), [], [])
+            for fd in ready:
+                worker, index = busy.pop(fd)
+                process, conn = worker
+                try:
+                    status, result = conn.recv()
+                except EOFError:
+                    self.shutdown(terminate=True)
+                    m = "Worker process %d died" % (process.pid,)
+                    raise ZeusError(m)
+                if status == EXECUTOR_ERROR:
+                    self.shutdown(terminate=True)
+                    raise result
+                results[index] = result
+                idle.append(worker)
+
+    def shutdown(self, terminate=False):
+        workers = self.workers
+        self.workers = []
+        for process, conn in workers:
+            try:
+                if not terminate:
+                    conn.send(None)
+                conn.close()
+            except (IOError, OSError):
+                pass
+        for process, conn in workers:
+            if terminate:
+                process.terminate()
+            process.join()
 
-        self.process(wait=0)
-        while 1:
-            if not channels[channel_no]:
-                if (channel_no is not None and
-                    channel_no not in self.channel_to_worker):
-                    del channels[channel_no]
-                    return None
 
-                if not wait:
-                    return None
+executor_class = ProcessExecutor
 
-                self.process(wait=1)
-            else:
-                val = channels[channel_no].pop()
-                return val
-
-    def receive_shared(self, wait=1):
-        val = self.receive(0, wait=wait)
-        if isinstance(val, tuple) and val and val[0] == MV_EXCEPTION:
-            raise Exception(val[1])
-        return val
-
-    def submit(self, channel_no, async_args):
-        channels = self.channels
-        if channel_no in channels:
-            m = "Channel already in use"
-            raise ValueError(m)
-        channels[channel_no] = deque()
-        self.pending.appendleft((channel_no, async_args))
-        if self.parallel <= 0:
-            async_worker
-        self.process(wait=0)
+def set_executor_class(cls):
+    global executor_class
+    executor_class = cls
+
+def get_executor(nr_parallel, shared=None):
+    if not nr_parallel or nr_parallel <= 0:
+        return SerialExecutor(shared=shared)
+    return executor_class(nr_parallel, shared=shared)
 
-    def make_async(self, func, *args, **kw):
-        return AsyncFunc(self, func, args, kw)
+def get_chunks(nr_items, nr_parallel):
+    nr_chunks = max(nr_parallel, 1) * EXECUTOR_CHUNKS_PER_WORKER
+    size = max(-(-nr_items // nr_chunks), EXECUTOR_MIN_CHUNK)
+    return [(i, min(i + size, nr_items)) for i in xrange(0, nr_items, size)]
 
 
 class TellerStream(object):
@@ -1419,6 +1478,56 @@ def selection_to_permutation(selection):
 def get_random_permutation(nr_elements):
     return selection_to_permutation(get_random_selection(nr_elements, full=1))
 
+RANDOM_WORD_CEILING = 2**32
+RANDOM_WORD_TYPE = 'I' if array('I').itemsize == 4 else 'L'
+
+def get_random_words():
+    """Yield random 32-bit words, read from the generator in blocks"""
+    read = _random_pool.read
+    while 1:
+        words = array(RANDOM_WORD_TYPE)
+        words.fromstring(read(RANDOM_BLOCK_SIZE))
+        for word in words:
+            yield word
+
+def get_random_permutation_fisher_yates(nr_elements):
+    if nr_elements > RANDOM_WORD_CEILING:
+        return get_random_permutation(nr_elements)
+
+    permutation = range(nr_elements)
+    ceiling = RANDOM_WORD_CEILING
+    words = get_random_words()
+    next_word = words.next
+    for i in xrange(nr_elements - 1, 0, -1):
+        bound = i + 1
+        limit = ceiling - ceiling % bound
+        word = next_word()
+        while word >= limit:
+            word = next_word()
+        j = word % bound
+        permutation[i], permutation[j] = permutation[j], permutation[i]
+
+    return permutation
+
+def get_random_permutation_from_gamma(nr_elements):
+    selection = get_random_permutation_gamma(nr_elements)
+    return selection_to_permutation(selection)
+
+PERMUTATION_GENERATORS = {
+    'selection': get_random_permutation,
+    'gamma': get_random_permutation_from_gamma,
+    'fisher-yates': get_random_permutation_fisher_yates,
+}
+DEFAULT_PERMUTATION = 'selection'
+
+def get_permutation_generator(name=None):
+    if name is None:
+        name = DEFAULT_PERMUTATION
+    if name not in PERMUTATION_GENERATORS:
+        m = "Unknown permutation generator '%s'" % (name,)
+        raise ValueError(m)
+    return PERMUTATION_GENERATORS[name]
+
 _terms = {}
 
 def get_term(n, k):
@@ -2203,13 +2312,19 @@ def strbin_to_int_mul(string):
 
     return s
 
+def strbin_to_int_hex(string):
+    # lsb, like strbin_to_int_mul
+    if not string:
+        return 0
+    return int(hexlify(string[::-1]), 16)
+
 def strbin_to_int_native(string):
-    return int.from_bytes(string)
+    return int.from_bytes(string, 'little')
 
 if PYTHON_MAJOR == 3:
     strbin_to_int = strbin_to_int_native
 else:
-    strbin_to_int = strbin_to_int_mul
+    strbin_to_int = strbin_to_int_hex
 
 def bit_iterator(nr, infinite=True):
     while nr:
@@ -2226,7 +2341,7 @@ def get_random_int(minimum, ceiling):
     top = ceiling - minimum
     nr_bits = bit_length(top)
     nr_bytes = (nr_bits - 1) / 8 + 1
-    strbin = _random_generator_file.read(nr_bytes)
+    strbin = _random_pool.read(nr_bytes)
     num = strbin_to_int(strbin)
     shift = bit_length(num) - nr_bits
     if shift > 0:
@@ -2244,6 +2359,199 @@ def validate_element(modulus, generator, order, element):
     legendre = pow(element, order, modulus)
     return legendre == 1
 
+FIXED_BASE_WINDOW = 7
+FIXED_BASE_MIN_USES = 16
+FIXED_BASE_MAX_TABLES = 16
+
+class FixedBase(object):
+    """Precomputed powers of a fixed base for fast exponentiation.
+
+    The exponent is split into windows of `window` bits and
+    table[i][d] holds base^(d * 2^(i*window)), so that an exponentiation
+    costs one modular multiplication per non-zero window and no squarings.
+    """
+
+    def __init__(self, modulus, base, nr_bits=None, window=FIXED_BASE_WINDOW):
+        if nr_bits is None:
+            nr_bits = bit_length(modulus)
+        self.modulus = modulus
+        self.base = base
+        self.window = window
+        self.nr_bits = nr_bits
+        self.mask = (1 << window) - 1
+
+        nr_windows = (nr_bits - 1) // window + 1
+        nr_digits = 1 << window
+        table = []
+        append = table.append
+        m = mpz(modulus)
+        b = mpz(base) % m
+        for i in xrange(nr_windows):
+            row = [mpz(1)] * nr_digits
+            x = b
+            for d in xrange(1, nr_digits):
+                row[d] = x
+                x = (x * b) % m
+            append(row)
+            b = x
+        self.table = table
+
+    def pow(self, exponent):
+        if exponent < 0 or bit_length(exponent) > self.nr_bits:
+            return pow(self.base, exponent, self.modulus)
+
+        modulus = self.modulus
+        window = self.window
+        mask = self.mask
+        result = mpz(1)
+        for row in self.table:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = (result * row[digit]) % modulus
+            exponent >>= window
+        return int(result)
+
+_fixed_bases = {}
+_fixed_base_uses = {}
+
+def get_fixed_base(modulus, base):
+    key = (modulus, base)
+    fixed_base = _fixed_bases.get(key)
+    if fixed_base is None:
+        if len(_fixed_bases) >= FIXED_BASE_MAX_TABLES:
+            _fixed_bases.clear()
+        fixed_base = FixedBase(modulus, base)
+        _fixed_bases[key] = fixed_base
+    return fixed_base
+
+def fixed_base_pow(base, exponent, modulus):
+    """pow() for bases that are used repeatedly, such as the generator
+    or an election public key. A precomputed table is built for the base
+    once it has been used FIXED_BASE_MIN_USES times."""
+    key = (modulus, base)
+    fixed_base = _fixed_bases.get(key)
+    if fixed_base is not None:
+        return fixed_base.pow(exponent)
+
+    uses = _fixed_base_uses.get(key, 0) + 1
+    if uses < FIXED_BASE_MIN_USES:
+        if len(_fixed_base_uses) >= FIXED_BASE_MAX_TABLES * 16:
+            _fixed_base_uses.clear()
+        _fixed_base_uses[key] = uses
+        return pow(base, exponent, modulus)
+
+    _fixed_base_uses.pop(key, None)
+    return get_fixed_base(modulus, base).pow(exponent)
+
+def fixed_base_precompute(modulus, *bases):
+    for base in bases:
+        get_fixed_base(modulus, base)
+
+MULTI_POW_WINDOW = 4
+MULTI_POW_WINDOW_FEW = 5
+MULTI_POW_FEW_BASES = 4
+
+def straus_pow(bases, exponents, modulus, window=MULTI_POW_WINDOW):
+    """Compute the product of base^exponent mod modulus for all pairs,
+    sharing the squarings among all bases (Straus' method)."""
+    mod = mpz(modulus)
+    nr_bits = 0
+    for e in exponents:
+        if e < 0:
+            m = "straus_pow: negative exponent"
+            raise ValueError(m)
+        if e > 0:
+            nr_bits = max(nr_bits, bit_length(e))
+    if not nr_bits:
+        return 1
+
+    nr_digits = 1 << window
+    mask = nr_digits - 1
+    tables = []
+    append = tables.append
+    for b in bases:
+        b = mpz(b) % mod
+        row = [mpz(1), b]
+        x = b
+        for d in xrange(2, nr_digits):
+            x = (x * b) % mod
+            row.append(x)
+        append(row)
+
+    pairs = zip(tables, exponents)
+    result = mpz(1)
+    for shift in xrange(((nr_bits - 1) // window) * window, -1, -window):
+        if result != 1:
+            for _ in xrange(window):
+                result = (result * result) % mod
+        for row, e in pairs:
+            digit = (e >> shift) & mask
+            if digit:
+                result = (result * row[digit]) % mod
+    return int(result)
+
+def multi_pow(bases, exponents, modulus, window=None, fixed=0):
+    """
+    Compute the product of base^exponent mod modulus for all pairs.
+
+    The first `fixed` bases are ones used repeatedly, such as the
+    generator, and go through fixed_base_pow. The rest share their
+    squarings, unless plain pow() is cheaper: for a single base,
+    or for two bases with exponents of very different lengths.
+    """
+    result = 1
+    variable_bases = []
+    variable_exponents = []
+    for i, (base, exponent) in enumerate(izip(bases, exponents)):
+        if exponent < 0:
+            m = "multi_pow: negative exponent"
+            raise ValueError(m)
+        if not exponent:
+            continue
+        if i < fixed:
+            power = fixed_base_pow(base, exponent, modulus)
+            result = (result * power) % modulus
+            continue
+        variable_bases.append(base)
+        variable_exponents.append(exponent)
+
+    nr_variable = len(variable_bases)
+    if nr_variable == 2:
+        short_bits, long_bits = sorted(bit_length(e)
+                                       for e in variable_exponents)
+        separate = 2 * short_bits < long_bits
+    else:
+        separate = nr_variable == 1
+
+    if separate:
+        for base, exponent in izip(variable_bases, variable_exponents):
+            result = (result * pow(base, exponent, modulus)) % modulus
+    elif nr_variable:
+        if window is None:
+            window = (MULTI_POW_WINDOW_FEW
+                      if nr_variable <= MULTI_POW_FEW_BASES
+                      else MULTI_POW_WINDOW)
+        power = straus_pow(variable_bases, variable_exponents, modulus,
+                           window=window)
+        result = (result * power) % modulus
+    return result
+
+def verify_power_commitment(modulus, base, power, commitment,
+                            challenge, response, fixed=1):
+    """
+    Check base^response == commitment * power^challenge,
+    computed as the multi-exponentiation base^response * power^-challenge.
+    """
+    try:
+        power_inverse = mod_inverse(power, modulus)
+    except ValueError:
+        return 0
+    left = multi_pow((base, power_inverse), (response, challenge), modulus,
+                     fixed=fixed)
+    return left == commitment % modulus
+
 def encrypt(message, modulus, generator, order, public, randomness=None):
     if randomness is None:
         randomness = get_random_int(1, order)
@@ -2252,32 +2560,90 @@ def encrypt(message, modulus, generator, order, public, randomness=None):
         m = "message is too large"
         raise ValueError(m)
 
-    legendre = pow(message, order, modulus)
-    if legendre != 1:
+    # The Legendre symbol, i.e. pow(message, order, modulus) == 1
+    if jacobi(message, modulus) != 1:
         message = -message % modulus
-    alpha = pow(generator, randomness, modulus)
-    beta = (message * pow(public, randomness, modulus)) % modulus
+    alpha = fixed_base_pow(generator, randomness, modulus)
+    beta = (message * fixed_base_pow(public, randomness, modulus)) % modulus
     return [alpha, beta, randomness]
 
 def decrypt_with_randomness(modulus, generator, order, public,
                             beta, secret):
     encoded = pow(public, secret, modulus)
-    encoded = inverse(encoded, modulus)
+    encoded = mod_inverse(encoded, modulus)
     encoded = (encoded * beta) % modulus
     if encoded >= order:
         encoded = -encoded % modulus
     return encoded - 1
 
-def decrypt_with_decryptor(modulus, generator, order, beta, decryptor):
-    decryptor = inverse(decryptor, modulus)
-    message = (decryptor * beta) % modulus
+def decode_element(modulus, order, message):
+    if message >= order:
+        message = -message % modulus
+    return message - 1
+
+def decode_decrypted(modulus, order, message):
     legendre = pow(message, order, modulus)
     if legendre not in (0, 1, -1 % modulus):
         m = "This should be impossible. Invalid encryption."
         raise AssertionError(m)
-    if message >= order:
-        message = -message % modulus
-    return message - 1
+    return decode_element(modulus, order, message)
+
+def decrypt_with_decryptor(modulus, generator, order, beta, decryptor):
+    decryptor = mod_inverse(decryptor, modulus)
+    message = (decryptor * beta) % modulus
+    return decode_decrypted(modulus, order, message)
+
+def batch_inverse(elements, modulus):
+    """Invert all elements with a single modular inversion
+    and 3(N-1) multiplications (Montgomery's trick)."""
+    nr_elements = len(elements)
+    if not nr_elements:
+        return []
+    mod = mpz(modulus)
+    products = list([None]) * nr_elements
+    product = mpz(1)
+    for i in xrange(nr_elements):
+        product = (product * elements[i]) % mod
+        products[i] = product
+
+    product_inverse = mod_inverse(product, modulus)
+    inverses = list([None]) * nr_elements
+    for i in xrange(nr_elements - 1, 0, -1):
+        inverses[i] = int((product_inverse * products[i - 1]) % mod)
+        product_inverse = (product_inverse * elements[i]) % mod
+    inverses[0] = int(product_inverse)
+    return inverses
+
+def iter_decrypt_with_decryptors(modulus, generator, order, betas,
+                                 decryptors, teller=None, report_thresh=128):
+    """
+    Yield decrypt_with_decryptor for many ciphers,
+    inverting all decryptors at once with batch_inverse.
+
+    The Legendre symbol check of decode_decrypted is skipped:
+    with a prime modulus every element passes it, and it costs
+    a full exponentiation per message.
+    """
+    inverses = batch_inverse(decryptors, modulus)
+    count = 0
+    for beta, decryptor in izip(betas, inverses):
+        message = (decryptor * beta) % modulus
+        yield decode_element(modulus, order, message)
+        count += 1
+        if count >= report_thresh:
+            if teller:
+                teller.advance(count)
+            count = 0
+
+    if count and teller:
+        teller.advance(count)
+
+def decrypt_with_decryptors(modulus, generator, order, betas, decryptors,
+                            teller=None, report_thresh=128):
+    return list(iter_decrypt_with_decryptors(modulus, generator, order,
+                                             betas, decryptors,
+                                             teller=teller,
+                                             report_thresh=report_thresh))
 
 def decrypt(modulus, generator, order, secret, alpha, beta):
     decryptor = pow(alpha, secret, modulus)
@@ -2324,7 +2690,7 @@ def element_from_elements_hash(modulus, generator, order, *elements):
 def prove_dlog_zeus(modulus, generator, order, power, dlog,
                     *extra_challenge_input):
     randomness = get_random_int(2, order)
-    commitment = pow(generator, randomness, modulus)
+    commitment = fixed_base_pow(generator, randomness, modulus)
     challenge = element_from_elements_hash(modulus, generator, order,
                                            power, commitment,
                                            *extra_challenge_input)
@@ -2339,12 +2705,12 @@ def verify_dlog_power_zeus(modulus, generator, order, power,
                                             *extra_challenge_input)
     if _challenge != challenge:
         return 0
-    return (pow(generator, response, modulus)
-            == ((commitment * pow(power, challenge, modulus)) % modulus))
+    return verify_power_commitment(modulus, generator, power, commitment,
+                                   challenge, response)
 
 def prove_dlog_helios(modulus, generator, order, power, dlog):
     randomness = get_random_int(2, order)
-    commitment = pow(generator, randomness, modulus)
+    commitment = fixed_base_pow(generator, randomness, modulus)
     challenge = int(sha1(str(commitment)).hexdigest(), 16) % order
     response = (randomness + challenge * dlog) % order
     return [commitment, challenge, response]
@@ -2354,8 +2720,8 @@ def verify_dlog_power_helios(modulus, generator, order, power,
     _challenge = int(sha1(str(commitment)).hexdigest(), 16) % order
     if _challenge != challenge:
         return 0
-    return (pow(generator, response, modulus)
-            == ((commitment * pow(power, challenge, modulus)) % modulus))
+    return verify_power_commitment(modulus, generator, power, commitment,
+                                   challenge, response)
 
 prove_dlog = prove_dlog_zeus
 verify_dlog_power = verify_dlog_power_zeus
@@ -2384,7 +2750,7 @@ def prove_ddh_tuple_zeus(modulus, generator, order,
                     message, base_power, message_power, exponent):
     randomness = get_random_int(2, order)
 
-    base_commitment = pow(generator, randomness, modulus)
+    base_commitment = fixed_base_pow(generator, randomness, modulus)
     message_commitment = pow(message, randomness, modulus)
 
     args = (modulus, generator, order, base_power, base_commitment,
@@ -2403,12 +2769,13 @@ def verify_ddh_tuple_zeus(modulus, generator, order,
     if _challenge != challenge:
         return 0
 
-    b = (base_commitment * pow(base_power, challenge, modulus)) % modulus
-    if b != pow(generator, response, modulus):
+    if not verify_power_commitment(modulus, generator, base_power,
+                                   base_commitment, challenge, response):
         return 0
 
-    m = (message_commitment * pow(message_power, challenge, modulus)) % modulus
-    if m != pow(message, response, modulus):
+    if not verify_power_commitment(modulus, message, message_power,
+                                   message_commitment, challenge, response,
+                                   fixed=0):
         return 0
 
     return 1
@@ -2417,7 +2784,7 @@ def prove_ddh_tuple_helios(modulus, generator, order,
                     message, base_power, message_power, exponent):
     randomness = get_random_int(2, order)
 
-    base_commitment = pow(generator, randomness, modulus)
+    base_commitment = fixed_base_pow(generator, randomness, modulus)
     message_commitment = pow(message, randomness, modulus)
 
     args = (str(base_commitment), str(message_commitment))
@@ -2434,12 +2801,13 @@ def verify_ddh_tuple_helios(modulus, generator, order,
     if _challenge != challenge:
         return 0
 
-    b = (base_commitment * pow(base_power, challenge, modulus)) % modulus
-    if b != pow(generator, response, modulus):
+    if not verify_power_commitment(modulus, generator, base_power,
+                                   base_commitment, challenge, response):
         return 0
 
-    m = (message_commitment * pow(message_power, challenge, modulus)) % modulus
-    if m != pow(message, response, modulus):
+    if not verify_power_commitment(modulus, message, message_power,
+                                   message_commitment, challenge, response,
+                                   fixed=0):
         return 0
 
     return 1
@@ -2447,12 +2815,140 @@ def verify_ddh_tuple_helios(modulus, generator, order,
 prove_ddh_tuple = prove_ddh_tuple_helios
 verify_ddh_tuple = verify_ddh_tuple_helios
 
+BATCH_VERIFY_BITS = 128
+BATCH_VERIFY_SIZE = 256
+
+def verify_ddh_tuples_batch_helios(modulus, generator, order,
+                                   base_power, tuples):
+    """
+    Verify many helios DDH proofs sharing the same generator and
+    base_power at once, using the small exponents test.
+
+    tuples is a list of
+    (message, message_power, base_commitment, message_commitment,
+     challenge, response).
+
+    Each proof equation is raised to a random BATCH_VERIFY_BITS exponent
+    and all of them are multiplied together, so that a single
+    multi-exponentiation replaces four exponentiations per proof.
+    The test is only sound in a group of prime order, therefore
+    all elements must be quadratic residues. Tuples for which this does
+    not hold are verified one by one.
+
+    Returns 1 if all proofs are valid. If 0 is returned at least one
+    proof is invalid, but which one is left to the caller to find out.
+    """
+    if jacobi(base_power, modulus) != 1:
+        for t in tuples:
+            if not verify_ddh_tuple_helios(modulus, generator, order,
+                                           t[0], base_power, t[1],
+                                           *t[2:]):
+                return 0
+        return 1
+
+    base_exponent = 0
+    power_exponent = 0
+    base_commitments = []
+    messages = []
+    message_exponents = []
+    rhs_bases = []
+    rhs_exponents = []
+    small_exponents = []
+
+    for t in tuples:
+        (message, message_power, base_commitment, message_commitment,
+         challenge, response) = t
+
+        args = (str(base_commitment), str(message_commitment))
+        _challenge = int(sha1(','.join(args)).hexdigest(), 16) % order
+        if _challenge != challenge:
+            return 0
+
+        residues = (jacobi(message, modulus) == 1 and
+                    jacobi(message_power, modulus) == 1 and
+                    jacobi(base_commitment, modulus) == 1 and
+                    jacobi(message_commitment, modulus) == 1)
+        if not residues:
+            if not verify_ddh_tuple_helios(modulus, generator, order,
+                                           message, base_power,
+                                           message_power, base_commitment,
+                                           message_commitment,
+                                           challenge, response):
+                return 0
+            continue
+
+        e = get_random_int(1, 2**BATCH_VERIFY_BITS)
+        base_exponent += e * response
+        power_exponent += e * challenge
+        base_commitments.append(base_commitment)
+        small_exponents.append(e)
+        messages.append(message)
+        message_exponents.append((e * response) % order)
+        rhs_bases.append(message_commitment)
+        rhs_exponents.append(e)
+        rhs_bases.append(message_power)
+        rhs_exponents.append(e * challenge)
+
+    if not small_exponents:
+        return 1
+
+    # g^(sum e*r) == prod(A^e) * y^(sum e*c)
+    left = fixed_base_pow(generator, base_exponent % order, modulus)
+    right = straus_pow(base_commitments, small_exponents, modulus)
+    right = (right * fixed_base_pow(base_power, power_exponent % order,
+                                    modulus))
+    if left != right % modulus:
+        return 0
+
+    # prod(m^(e*r)) == prod(B^e * f^(e*c))
+    left = straus_pow(messages, message_exponents, modulus)
+    right = straus_pow(rhs_bases, rhs_exponents, modulus)
+    if left != right:
+        return 0
+
+    return 1
+
+verify_ddh_tuples_batch = verify_ddh_tuples_batch_helios
+
 def prove_encryption(modulus, generator, order, alpha, beta, secret):
     """Prove ElGamal encryption"""
     ret = prove_dlog(modulus, generator, order, alpha, secret, beta)
     commitment, challenge, response = ret
     return [commitment, challenge, response]
 
+def encrypt_and_prove_some(shared, start, end):
+    modulus, generator, order, public, messages = shared
+    encrypted = []
+    append = encrypted.append
+    for message in messages[start:end]:
+        alpha, beta, secret = encrypt(message, modulus, generator, order,
+                                      public)
+        proof = prove_encryption(modulus, generator, order,
+                                 alpha, beta, secret)
+        append([alpha, beta] + proof)
+    return encrypted
+
+def encrypt_and_prove_many(modulus, generator, order, public, messages,
+                           teller=None, nr_parallel=0):
+    """
+    Encrypt messages to public and prove each encryption.
+    Returns a list of [alpha, beta, commitment, challenge, response].
+    """
+    nr_messages = len(messages)
+    # Build the tables before forking so that workers inherit them
+    if nr_messages >= FIXED_BASE_MIN_USES:
+        fixed_base_precompute(modulus, generator, public)
+    shared = (modulus, generator, order, public, messages)
+    chunks = get_chunks(nr_messages, nr_parallel)
+
+    encrypted = []
+    with get_executor(nr_parallel, shared=shared) as executor:
+        for r in executor.imap(encrypt_and_prove_some, chunks):
+            encrypted.extend(r)
+            if teller:
+                teller.advance(len(r))
+    return encrypted
+
 def verify_encryption(modulus, generator, order, alpha, beta,
                       commitment, challenge, response):
     """Verify ElGamal encryption"""
@@ -2460,20 +2956,25 @@ def verify_encryption(modulus, generator, order, alpha, beta,
                             commitment, challenge, response, beta)
     return ret
 
-def reencrypt(modulus, generator, order, public, alpha, beta, secret=None):
+def reencrypt(modulus, generator, order, public, alpha, beta, secret=None,
+              powers=None):
     key = get_random_int(3, order) if secret is None else secret
-    new_alpha = (alpha * pow(generator, key, modulus)) % modulus
-    new_beta = (beta * pow(public, key, modulus)) % modulus
+    if powers is None:
+        powers = (fixed_base_pow(generator, key, modulus),
+                  fixed_base_pow(public, key, modulus))
+    generator_power, public_power = powers
+    new_alpha = (alpha * generator_power) % modulus
+    new_beta = (beta * public_power) % modulus
     if secret is None:
-        return [alpha, beta, key]
-    return [alpha, beta]
+        return [new_alpha, new_beta, key]
+    return [new_alpha, new_beta]
 
 def prove_reencryption(modulus, generator, order, public,
                        a0, b0, a1, b1, secret):
     base = generator
     base_power = a0
     message = public
-    message_power = (b1 * inverse(b0, modulus)) % modulus
+    message_power = (b1 * mod_inverse(b0, modulus)) % modulus
     args = (modulus, generator, order, public,
             base, base_power, message, message_power, secret)
     return prove_ddh_tuple(*args)
@@ -2484,7 +2985,7 @@ def verify_reencryption(modulus, generator, order, public,
     base = generator
     base_power = a0
     message = public
-    message_power = (b1 * inverse(b0, modulus)) % modulus
+    message_power = (b1 * mod_inverse(b0, modulus)) % modulus
     args = (modulus, generator, order, public,
             base, base_power, message, message_power,
             a_commitment, b_commitment, challenge, response)
@@ -2520,8 +3021,8 @@ def verify_element_signature(signature, modulus, generator, order, public):
     if r <= 0 or r >= modulus:
         return 0
 
-    x0 = (pow(public, r, modulus) * pow(r, s, modulus)) % modulus
-    x1 = pow(generator, e, modulus)
+    x0 = multi_pow((public, r), (r, s), modulus, fixed=1)
+    x1 = fixed_base_pow(generator, e, modulus)
     if x0 != x1:
         return 0
 
@@ -2730,7 +3231,7 @@ def to_absolute_answers(choices, nr_candidates):
     return absolute_choices
 
 
-def compute_mix_challenge(cipher_mix):
+def mix_challenge_hasher(cipher_mix):
     hasher = sha256()
     update = hasher.update
 
@@ -2749,14 +3250,291 @@ def compute_mix_challenge(cipher_mix):
         update("%x" % cipher[ALPHA])
         update("%x" % cipher[BETA])
 
+    return hasher
+
+def update_mix_challenge(hasher, ciphers):
+    update = hasher.update
+    for cipher in ciphers:
+        update("%x" % cipher[ALPHA])
+        update("%x" % cipher[BETA])
+
+def compute_mix_challenge(cipher_mix):
+    hasher = mix_challenge_hasher(cipher_mix)
     for ciphers in cipher_mix['cipher_collections']:
-        for cipher in ciphers:
-            update("%x" % cipher[ALPHA])
-            update("%x" % cipher[BETA])
+        update_mix_challenge(hasher, ciphers)
 
     challenge = hasher.hexdigest()
     return challenge
 
+
+class MixStore(object):
+    """
+    Holds the per-round collections of a mix proof in memory.
+    """
+
+    def __init__(self):
+        self.cipher_collections = []
+        self.offset_collections = []
+        self.random_collections = []
+
+    def __len__(self):
+        return len(self.cipher_collections)
+
+    def append_round(self, ciphers, offsets, randoms):
+        self.cipher_collections.append(ciphers)
+        self.offset_collections.append(offsets)
+        self.random_collections.append(randoms)
+
+    def get_round(self, i):
+        return [self.cipher_collections[i],
+                self.offset_collections[i],
+                self.random_collections[i]]
+
+    def set_answer(self, i, offsets, randoms):
+        self.offset_collections[i] = offsets
+        self.random_collections[i] = randoms
+
+    def get_collections(self):
+        return [self.cipher_collections,
+                self.offset_collections,
+                self.random_collections]
+
+    def finish(self, cipher_mix):
+        pass
+
+
+MIX_STORE_CHUNK = 4096
+MIX_STORE_FIELDS = ('modulus', 'generator', 'order', 'public',
+                    'challenge', 'original_ciphers', 'mixed_ciphers')
+
+class StoredCollection(object):
+    """
+    A read-only list of rounds of one kind, loaded from a FileMixStore
+    one round at a time.
+    """
+
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.store.read(self.kind, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class FileMixStore(MixStore):
+    """
+    Keeps the per-round collections of a mix proof in a directory,
+    each round in its own files written in chunks of MIX_STORE_CHUNK
+    items, so that only one round at a time needs to be in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.nr_rounds = 0
+        self.cache = {}
+        if not isdir(path):
+            makedirs(path)
+
+    def __len__(self):
+        return self.nr_rounds
+
+    def filename(self, kind, i):
+        return path_join(self.path, '%s.%d' % (kind, i))
+
+    def write(self, kind, i, items):
+        self.cache.pop(kind, None)
+        with open(self.filename(kind, i), 'wb') as f:
+            for k in xrange(0, len(items), MIX_STORE_CHUNK):
+                marshal_dump(items[k:k+MIX_STORE_CHUNK], f)
+
+    def read(self, kind, i):
+        cached = self.cache.get(kind)
+        if cached is not None and cached[0] == i:
+            return cached[1]
+        items = []
+        with open(self.filename(kind, i), 'rb') as f:
+            while 1:
+                try:
+                    items.extend(marshal_load(f))
+                except EOFError:
+                    break
+        self.cache[kind] = (i, items)
+        return items
+
+    def append_round(self, ciphers, offsets, randoms):
+        i = self.nr_rounds
+        self.write('ciphers', i, ciphers)
+        self.write('offsets', i, offsets)
+        self.write('randoms', i, randoms)
+        self.nr_rounds = i + 1
+
+    def get_round(self, i):
+        return [self.read('ciphers', i),
+                self.read('offsets', i),
+                self.read('randoms', i)]
+
+    def set_answer(self, i, offsets, randoms):
+        self.write('offsets', i, offsets)
+        self.write('randoms', i, randoms)
+
+    def get_collections(self):
+        return [StoredCollection(self, 'ciphers'),
+                StoredCollection(self, 'offsets'),
+                StoredCollection(self, 'randoms')]
+
+    def finish(self, cipher_mix):
+        header = dict((k, cipher_mix[k]) for k in MIX_STORE_FIELDS)
+        header['nr_rounds'] = self.nr_rounds
+        with open(path_join(self.path, 'mix'), 'wb') as f:
+            marshal_dump(header, f)
+
+    @classmethod
+    def load_cipher_mix(cls, path):
+        """Open a stored mix with its collections read back lazily"""
+        with open(path_join(path, 'mix'), 'rb') as f:
+            header = marshal_load(f)
+        store = cls(path)
+        store.nr_rounds = header.pop('nr_rounds')
+        cipher_mix = header
+        collections = store.get_collections()
+        cipher_collections, offset_collections, random_collections = \
+            collections
+        cipher_mix['cipher_collections'] = cipher_collections
+        cipher_mix['offset_collections'] = offset_collections
+        cipher_mix['random_collections'] = random_collections
+        return cipher_mix
+
+def compute_reencryption_factors(modulus, generator, order, public,
+                                 nr_factors):
+    factors = []
+    append = factors.append
+    for _ in xrange(nr_factors):
+        secret = get_random_int(3, order)
+        append([secret,
+                fixed_base_pow(generator, secret, modulus),
+                fixed_base_pow(public, secret, modulus)])
+    return factors
+
+def compute_some_reencryption_factors(shared, start, end):
+    modulus, generator, order, public = shared
+    return compute_reencryption_factors(modulus, generator, order, public,
+                                        end - start)
+
+PRIVATE_FILE_MODE = 0600
+
+def open_private(path, append=False):
+    """
+    Open path for writing, readable by its owner only.
+    Re-encryption factors link the inputs of a mix to its outputs.
+    """
+    flags = O_WRONLY | O_CREAT | (O_APPEND if append else O_TRUNC)
+    fd = os_open(path, flags, PRIVATE_FILE_MODE)
+    try:
+        # The mode given above only applies to a newly created file
+        fchmod(fd, PRIVATE_FILE_MODE)
+        return fdopen(fd, 'ab' if append else 'wb')
+    except:
+        os_close(fd)
+        raise
+
+def precompute_reencryption_factors(path, modulus, generator, order, public,
+                                    nr_factors, teller=_teller,
+                                    nr_parallel=0):
+    """
+    Append nr_factors re-encryption factors
+    (secret, generator^secret, public^secret) to the file at path,
+    to be consumed later by mix_ciphers through PrecomputedFactors.
+    """
+    header = {'modulus': modulus, 'generator': generator,
+              'order': order, 'public': public}
+    if exists(path):
+        with open(path, 'rb') as f:
+            stored = marshal_load(f)
+        if stored != header:
+            m = "Precomputed factors in '%s' are for other parameters" % path
+            raise ZeusError(m)
+    else:
+        with open_private(path) as f:
+            marshal_dump(header, f)
+
+    fixed_base_precompute(modulus, generator, public)
+    chunks = [(k, min(k + MIX_STORE_CHUNK, nr_factors))
+              for k in xrange(0, nr_factors, MIX_STORE_CHUNK)]
+    with teller.task("Precomputing re-encryption factors", total=nr_factors):
+        with get_executor(nr_parallel,
+                          shared=(modulus, generator, order, public)) as ex:
+            with open_private(path, append=True) as f:
+                for factors in ex.imap(compute_some_reencryption_factors,
+                                       chunks):
+                    marshal_dump(factors, f)
+                    teller.advance(len(factors))
+
+class PrecomputedFactors(object):
+    """
+    Re-encryption factors read back from a precomputed file.
+
+    Every factor is handed out only once, even across runs:
+    the number of factors consumed is recorded next to the file
+    before they are returned.
+    """
+
+    def __init__(self, path, modulus, generator, order, public):
+        self.path = path
+        self.used_path = path + '.used'
+        self.file = open(path, 'rb')
+        header = marshal_load(self.file)
+        expected = {'modulus': modulus, 'generator': generator,
+                    'order': order, 'public': public}
+        if header != expected:
+            self.file.close()
+            m = "Precomputed factors in '%s' are for other parameters" % path
+            raise ZeusError(m)
+
+        self.nr_used = 0
+        if exists(self.used_path):
+            with open(self.used_path) as f:
+                self.nr_used = int(f.read())
+        self.buffer = []
+        self.fill(self.nr_used)
+        del self.buffer[:self.nr_used]
+
+    def fill(self, nr_factors):
+        buf = self.buffer
+        while len(buf) < nr_factors:
+            try:
+                buf.extend(marshal_load(self.file))
+            except EOFError:
+                break
+
+    def record_used(self):
+        tmp_path = self.used_path + '.tmp'
+        with open_private(tmp_path) as f:
+            f.write('%d' % self.nr_used)
+        rename(tmp_path, self.used_path)
+
+    def take(self, nr_factors):
+        """Return up to nr_factors unused factors"""
+        self.fill(nr_factors)
+        factors = self.buffer[:nr_factors]
+        del self.buffer[:nr_factors]
+        self.nr_used += len(factors)
+        self.record_used()
+        return factors
+
+    def close(self):
+        self.file.close()
+
 def get_random_permutation_gamma(nr_elements):
     if nr_elements <= 0:
         return []
@@ -2768,38 +3546,107 @@ def get_random_permutation_gamma(nr_elements):
     selection = gamma_decode(rand, nr_elements)
     return selection
 
-def shuffle_ciphers(modulus, generator, order, public, ciphers,
-                    teller=None, report_thresh=128, async_channel=None):
+def reencrypt_ciphers(modulus, generator, order, public, ciphers,
+                      teller=None, report_thresh=128, factors=()):
     nr_ciphers = len(ciphers)
-    mixed_offsets = get_random_permutation(nr_ciphers)
-    mixed_ciphers = list([None]) * nr_ciphers
-    mixed_randoms = list([None]) * nr_ciphers
+    nr_factors = len(factors)
+    reencrypted = list([None]) * nr_ciphers
+    randoms = list([None]) * nr_ciphers
     count = 0
 
     for i in xrange(nr_ciphers):
         alpha, beta = ciphers[i]
-        alpha, beta, secret = reencrypt(modulus, generator, order,
-                                        public, alpha, beta)
-        mixed_randoms[i] = secret
-        o = mixed_offsets[i]
-        mixed_ciphers[o] = [alpha, beta]
+        if i < nr_factors:
+            secret, generator_power, public_power = factors[i]
+            alpha, beta = reencrypt(modulus, generator, order, public,
+                                    alpha, beta, secret=secret,
+                                    powers=(generator_power, public_power))
+        else:
+            alpha, beta, secret = reencrypt(modulus, generator, order,
+                                            public, alpha, beta)
+        randoms[i] = secret
+        reencrypted[i] = [alpha, beta]
         count += 1
         if count >= report_thresh:
             if teller:
                 teller.advance(count)
-            if async_channel:
-                async_channel.send_shared(count, wait=1)
             count = 0
 
     if count:
         if teller:
             teller.advance(count)
-        if async_channel:
-            async_channel.send_shared(count, wait=1)
+    return [reencrypted, randoms]
+
+def shuffle_ciphers(modulus, generator, order, public, ciphers,
+                    teller=None, report_thresh=128, permutation=None,
+                    factors=None):
+    nr_ciphers = len(ciphers)
+    precomputed = factors.take(nr_ciphers) if factors is not None else ()
+    if nr_ciphers - len(precomputed) >= FIXED_BASE_MIN_USES:
+        fixed_base_precompute(modulus, generator, public)
+    get_permutation = get_permutation_generator(permutation)
+    mixed_offsets = get_permutation(nr_ciphers)
+    reencrypted, mixed_randoms = reencrypt_ciphers(modulus, generator, order,
+                                                   public, ciphers,
+                                                   teller=teller,
+                                                   report_thresh=report_thresh,
+                                                   factors=precomputed)
+    mixed_ciphers = list([None]) * nr_ciphers
+    for i in xrange(nr_ciphers):
+        mixed_ciphers[mixed_offsets[i]] = reencrypted[i]
+
     return [mixed_ciphers, mixed_offsets, mixed_randoms]
 
+def reencrypt_some_ciphers(shared, start, end):
+    modulus, generator, order, public, ciphers = shared
+    return reencrypt_ciphers(modulus, generator, order, public,
+                             ciphers[start:end])
+
+def shuffle_ciphers_many(executor, modulus, generator, order, public,
+                         ciphers, nr_shuffles, teller=None, permutation=None):
+    """
+    Generate nr_shuffles independent shuffles of ciphers,
+    with re-encryption distributed in chunks over executor.
+    executor must have been created with
+    (modulus, generator, order, public, ciphers) as its shared input.
+    """
+    nr_ciphers = len(ciphers)
+    get_permutation = get_permutation_generator(permutation)
+    chunks = get_chunks(nr_ciphers, executor.nr_parallel)
+    tasks = [chunk for _ in xrange(nr_shuffles) for chunk in chunks]
+    results = executor.imap(reencrypt_some_ciphers, tasks)
+
+    for _ in xrange(nr_shuffles):
+        mixed_offsets = get_permutation(nr_ciphers)
+        mixed_ciphers = list([None]) * nr_ciphers
+        mixed_randoms = list([None]) * nr_ciphers
+        for start, end in chunks:
+            reencrypted, randoms = next(results)
+            mixed_randoms[start:end] = randoms
+            for i in xrange(start, end):
+                mixed_ciphers[mixed_offsets[i]] = reencrypted[i - start]
+            if teller:
+                teller.advance(end - start)
+        yield [mixed_ciphers, mixed_offsets, mixed_randoms]
+
 def mix_ciphers(ciphers_for_mixing, nr_rounds=MIN_MIX_ROUNDS,
-                teller=_teller, nr_parallel=0):
+                teller=_teller, nr_parallel=0, store=None, permutation=None,
+                factors=None):
+    """
+    Mix ciphers and prove it with nr_rounds shuffles.
+
+    The per-round collections of the proof are kept in store,
+    by default a MixStore in memory. With a FileMixStore each round is
+    written to disk as soon as it is produced and the challenge is
+    computed incrementally, so that only one round is held in memory.
+
+    permutation names one of PERMUTATION_GENERATORS
+    and defaults to DEFAULT_PERMUTATION.
+
+    factors is an optional PrecomputedFactors source. Re-encryption
+    then costs two multiplications per cipher and is done in-process,
+    falling back to fresh randomness if the source runs out.
+    """
     p = ciphers_for_mixing['modulus']
     g = ciphers_for_mixing['generator']
     q = ciphers_for_mixing['order']
@@ -2808,59 +3655,68 @@ def mix_ciphers(ciphers_for_mixing, nr_rounds=MIN_MIX_ROUNDS,
     original_ciphers = ciphers_for_mixing['mixed_ciphers']
     nr_ciphers = len(original_ciphers)
 
-    if nr_parallel > 0:
-        Random.atfork()
-        async = AsyncController(parallel=nr_parallel)
-        async_shuffle_ciphers = async.make_async(shuffle_ciphers)
+    if store is None:
+        store = MixStore()
+
+    parallel = nr_parallel > 0 and factors is None
+
+    # Build the tables before forking so that workers inherit them
+    if nr_ciphers * (nr_rounds + 1) >= FIXED_BASE_MIN_USES:
+        fixed_base_precompute(p, g, y)
 
     teller.task('Mixing %d ciphers for %d rounds' % (nr_ciphers, nr_rounds))
 
     cipher_mix = {'modulus': p, 'generator': g, 'order': q, 'public': y}
     cipher_mix['original_ciphers'] = original_ciphers
 
-    with teller.task('Producing final mixed ciphers', total=nr_ciphers):
-        shuffled = shuffle_ciphers(p, g, q, y, original_ciphers, teller=teller)
-        mixed_ciphers, mixed_offsets, mixed_randoms = shuffled
-        cipher_mix['mixed_ciphers'] = mixed_ciphers
-
-    total = nr_ciphers * nr_rounds
-    with teller.task('Producing ciphers for proof', total=total):
-        if nr_parallel > 0:
-            channels = [async_shuffle_ciphers(p, g, q, y, original_ciphers,
-                                              teller=None)
-                        for _ in xrange(nr_rounds)]
-
-            count = 0
-            while count < total:
-                nr = async.receive_shared()
-                teller.advance(nr)
-                count += nr
-
-            collections = [channel.receive(wait=1) for channel in channels]
-            async.shutdown()
-        else:
-            collections = [shuffle_ciphers(p, g, q, y,
-                                           original_ciphers, teller=teller)
-                           for _ in xrange(nr_rounds)]
-
-        unzipped = [list(x) for x in zip(*collections)]
-        cipher_collections, offset_collections, random_collections = unzipped
-        cipher_mix['cipher_collections'] = cipher_collections
-        cipher_mix['random_collections'] = random_collections
-        cipher_mix['offset_collections'] = offset_collections
+    # Serial mixing runs in-process, so the executor has no workers then
+    executor = get_executor(nr_parallel if parallel else 0,
+                            shared=(p, g, q, y, original_ciphers))
+    with executor:
+        with teller.task('Producing final mixed ciphers', total=nr_ciphers):
+            if parallel:
+                shuffled, = shuffle_ciphers_many(executor, p, g, q, y,
+                                                 original_ciphers, 1,
+                                                 teller=teller,
+                                                 permutation=permutation)
+            else:
+                shuffled = shuffle_ciphers(p, g, q, y, original_ciphers,
+                                           teller=teller,
+                                           permutation=permutation,
+                                           factors=factors)
+            mixed_ciphers, mixed_offsets, mixed_randoms = shuffled
+            cipher_mix['mixed_ciphers'] = mixed_ciphers
+
+        hasher = mix_challenge_hasher(cipher_mix)
+
+        total = nr_ciphers * nr_rounds
+        with teller.task('Producing ciphers for proof', total=total):
+            if parallel:
+                collections = shuffle_ciphers_many(executor, p, g, q, y,
+                                                   original_ciphers,
+                                                   nr_rounds, teller=teller,
+                                                   permutation=permutation)
+            else:
+                collections = (shuffle_ciphers(p, g, q, y,
+                                               original_ciphers,
+                                               teller=teller,
+                                               permutation=permutation,
+                                               factors=factors)
+                               for _ in xrange(nr_rounds))
+
+            for ciphers, offsets, randoms in collections:
+                update_mix_challenge(hasher, ciphers)
+                store.append_round(ciphers, offsets, randoms)
+                del ciphers, offsets, randoms
 
     with teller.task('Producing cryptographic hash challenge'):
-        challenge = compute_mix_challenge(cipher_mix)
+        challenge = hasher.hexdigest()
         cipher_mix['challenge'] = challenge
 
     bits = bit_iterator(int(challenge, 16))
 
     with teller.task('Answering according to challenge', total=nr_rounds):
         for i, bit in zip(xrange(nr_rounds), bits):
-            ciphers = cipher_collections[i]
-            offsets = offset_collections[i]
-            randoms = random_collections[i]
-
             if bit == 0:
                 # Nothing to do, we just publish our offsets and randoms
                 pass
@@ -2872,6 +3728,7 @@ def mix_ciphers(ciphers_for_mixing, nr_rounds=MIN_MIX_ROUNDS,
                 # original_ciphers -> image
                 # original_ciphers -> mixed_ciphers
                 # Provide image -> mixed_ciphers
+                ciphers, offsets, randoms = store.get_round(i)
                 new_offsets = list([None]) * nr_ciphers
                 new_randoms = list([None]) * nr_ciphers
 
@@ -2885,31 +3742,43 @@ def mix_ciphers(ciphers_for_mixing, nr_rounds=MIN_MIX_ROUNDS,
                     new_random = (mixed_random - cipher_random) % q
                     new_randoms[cipher_offset] = new_random
 
-                offset_collections[i] = new_offsets
-                random_collections[i] = new_randoms
+                store.set_answer(i, new_offsets, new_randoms)
                 del ciphers, offsets, randoms
             else:
                 m = "This should be impossible. Something is broken."
                 raise AssertionError(m)
 
             teller.advance()
+
+    cipher_collections, offset_collections, random_collections = \
+        store.get_collections()
+    cipher_mix['cipher_collections'] = cipher_collections
+    cipher_mix['random_collections'] = random_collections
+    cipher_mix['offset_collections'] = offset_collections
+    store.finish(cipher_mix)
     teller.finish('Mixing')
 
     return cipher_mix
 
 
-def verify_mix_round(i, bit, original_ciphers, mixed_ciphers,
+def verify_mix_round(modulus, generator, order, public,
+                     i, bit, original_ciphers, mixed_ciphers,
                      ciphers, randoms, offsets,
-                     teller=None, report_thresh=128, async_channel=None):
+                     teller=None, report_thresh=128, start=0, end=None):
     nr_ciphers = len(original_ciphers)
+    if end is None:
+        end = nr_ciphers
+    if end - start >= FIXED_BASE_MIN_USES:
+        fixed_base_precompute(modulus, generator, public)
     count = 0
     if bit == 0:
-        for j in xrange(nr_ciphers):
+        for j in xrange(start, end):
             original_cipher = original_ciphers[j]
             a = original_cipher[ALPHA]
             b = original_cipher[BETA]
             r = randoms[j]
-            new_a, new_b = reencrypt(p, g, q, y, a, b, r)
+            new_a, new_b = reencrypt(modulus, generator, order, public,
+                                     a, b, r)
             o = offsets[j]
             cipher = ciphers[o]
             if new_a != cipher[ALPHA] or new_b != cipher[BETA]:
@@ -2918,28 +3787,25 @@ def verify_mix_round(i, bit, original_ciphers, mixed_ciphers,
                 raise AssertionError(m)
             count += 1
             if count >= report_thresh:
-                if async_channel:
-                    async_channel.send_shared(count)
                 if teller:
                     teller.advance(count)
                 count = 0
     elif bit == 1:
-        for j in xrange(nr_ciphers):
+        for j in xrange(start, end):
             cipher = ciphers[j]
             a = cipher[ALPHA]
             b = cipher[BETA]
             r = randoms[j]
-            new_a, new_b = reencrypt(p, g, q, y, a, b, r)
+            new_a, new_b = reencrypt(modulus, generator, order, public,
+                                     a, b, r)
             o = offsets[j]
             mixed_cipher = mixed_ciphers[o]
-            if new_a != mixed_cipher[ALPHA] or new_b != cipher[BETA]:
+            if new_a != mixed_cipher[ALPHA] or new_b != mixed_cipher[BETA]:
                 m = ('MIXING VERIFICATION FAILED AT '
                      'ROUND %d CIPHER %d' % (i, j))
                 raise AssertionError(m)
             count += 1
             if count >= report_thresh:
-                if async_channel:
-                    async_channel.send_shared(count)
                 if teller:
                     teller.advance(count)
                 count = 0
@@ -2948,11 +3814,20 @@ def verify_mix_round(i, bit, original_ciphers, mixed_ciphers,
         raise AssertionError(m)
 
     if count:
-        if async_channel:
-            async_channel.send_shared(count)
         if teller:
             teller.advance(count)
 
+def verify_some_mix_round(cipher_mix, i, bit, start, end):
+    verify_mix_round(cipher_mix['modulus'], cipher_mix['generator'],
+                     cipher_mix['order'], cipher_mix['public'],
+                     i, bit, cipher_mix['original_ciphers'],
+                     cipher_mix['mixed_ciphers'],
+                     cipher_mix['cipher_collections'][i],
+                     cipher_mix['random_collections'][i],
+                     cipher_mix['offset_collections'][i],
+                     start=start, end=end)
+    return end - start
+
 
 def verify_cipher_mix(cipher_mix, teller=_teller, nr_parallel=0):
     try:
@@ -2985,40 +3860,28 @@ def verify_cipher_mix(cipher_mix, teller=_teller, nr_parallel=0):
     #    m = "Invalid cryptosystem"
     #    raise AssertionError(m)
 
-    if nr_parallel > 0:
-        async = AsyncController(parallel=nr_parallel)
-        async_verify_mix_round = async.make_async(verify_mix_round)
+    if nr_ciphers * nr_rounds >= FIXED_BASE_MIN_USES:
+        fixed_base_precompute(p, g, y)
 
     total = nr_rounds * nr_ciphers
     with teller.task('Verifying ciphers', total=total):
-        channels = []
-        append = channels.append
-        for i, bit in zip(xrange(nr_rounds), bit_iterator(int(challenge, 16))):
-            ciphers = cipher_collections[i]
-            randoms = random_collections[i]
-            offsets = offset_collections[i]
-            if nr_parallel <= 0:
-                verify_mix_round(i, bit, original_ciphers,
+        bits = zip(xrange(nr_rounds), bit_iterator(int(challenge, 16)))
+        if nr_parallel <= 0:
+            for i, bit in bits:
+                ciphers = cipher_collections[i]
+                randoms = random_collections[i]
+                offsets = offset_collections[i]
+                verify_mix_round(p, g, q, y, i, bit, original_ciphers,
                                  mixed_ciphers, ciphers,
                                  randoms, offsets,
                                  teller=teller)
-            else:
-                append(async_verify_mix_round(i, bit,
-                                              original_ciphers,
-                                              mixed_ciphers,
-                                              ciphers, randoms, offsets,
-                                              teller=None))
-        if nr_parallel > 0:
-            count = 0
-            while count < total:
-                nr = async.receive_shared(wait=1)
-                teller.advance(nr)
-                count += nr
-
-            for channel in channels:
-                channel.receive(wait=1)
-
-            async.shutdown()
+        else:
+            chunks = get_chunks(nr_ciphers, nr_parallel)
+            tasks = [(i, bit, start, end)
+                     for i, bit in bits for start, end in chunks]
+            with get_executor(nr_parallel, shared=cipher_mix) as executor:
+                for nr in executor.imap(verify_some_mix_round, tasks):
+                    teller.advance(nr)
 
     teller.finish('Verifying mixing')
     return 1
@@ -3039,32 +3902,16 @@ def compute_decryption_factors1(modulus, generator, order, secret, ciphers,
             teller.advance()
     return factors
 
-def compute_some_decryption_factors(modulus, generator, order,
-                                    secret, public, ciphers,
-                                    teller=None, async_channel=None,
-                                    report_thresh=16):
-    count = 0
+def compute_some_decryption_factors(shared, start, end):
+    modulus, generator, order, secret, public, ciphers = shared
     factors = []
     append = factors.append
 
-    for alpha, beta in ciphers:
+    for alpha, beta in ciphers[start:end]:
         factor = pow(alpha, secret, modulus)
         proof = prove_ddh_tuple(modulus, generator, order,
                                 alpha, public, factor, secret)
         append([factor, proof])
-        count += 1
-        if count >= report_thresh:
-            if teller is not None:
-                teller.advance(count)
-            if async_channel is not None:
-                async_channel.send_shared(count)
-            count = 0
-
-    if count:
-        if teller is not None:
-            teller.advance(count)
-        if async_channel is not None:
-            async_channel.send_shared(count)
 
     return factors
 
@@ -3076,114 +3923,113 @@ def compute_decryption_factors(modulus, generator, order, secret, ciphers,
 
     public = pow(generator, secret, modulus)
     nr_ciphers = len(ciphers)
-    async = AsyncController(parallel=nr_parallel)
-    compute_some = async.make_async(compute_some_decryption_factors)
+    shared = (modulus, generator, order, secret, public, ciphers)
+    chunks = get_chunks(nr_ciphers, nr_parallel)
 
-    d, q = divmod(nr_ciphers, nr_parallel)
-    if not d:
-        d = nr_ciphers
-    index = range(0, nr_ciphers, d)
+    factors = []
     with teller.task("Computing decryption factors", total=nr_ciphers):
-        channels = [compute_some(modulus, generator, order,
-                                 secret, public, ciphers[i:i+d])
-                    for i in index]
-        count = 0
-        while count < nr_ciphers:
-            nr = async.receive_shared(wait=1)
-            teller.advance(nr)
-            count += nr
-
-        factors = []
-        for c in channels:
-            r = c.receive(wait=1)
-            factors.extend(r)
+        with get_executor(nr_parallel, shared=shared) as executor:
+            for r in executor.imap(compute_some_decryption_factors, chunks):
+                factors.extend(r)
+                teller.advance(len(r))
 
-    async.shutdown()
     return factors
 
-def verify_decryption_factors1(modulus, generator, order, public,
-                               ciphers, factors, teller=_teller):
-    nr_ciphers = len(ciphers)
-    if nr_ciphers != len(factors):
-        return 0
-
-    with teller.task("Verifying decryption factors", total=nr_ciphers):
-        for cipher, factor in izip(ciphers, factors):
-            alpha, beta = cipher
-            factor, proof = factor
-            if not verify_ddh_tuple(modulus, generator, order, alpha, public,
-                                    factor, *proof):
-                teller.fail()
-                return 0
-            teller.advance()
-    return 1
+def compute_some_decryptors(shared, start, end):
+    modulus, secret, ciphers = shared
+    return [pow(alpha, secret, modulus) for alpha, beta in ciphers[start:end]]
 
-def verify_some_decryption_factors(modulus, generator, order,
-                                   public, ciphers, factors,
-                                   teller=None, async_channel=None,
-                                   report_thresh=16):
-    count = 0
+def decrypt_ciphers(modulus, generator, order, secret, ciphers,
+                    teller=_teller, nr_parallel=0):
+    """Decrypt ciphers with the full secret key,
+    inverting all decryptors at once with batch_inverse"""
+    nr_ciphers = len(ciphers)
+    shared = (modulus, secret, ciphers)
+    chunks = get_chunks(nr_ciphers, nr_parallel)
+
+    decryptors = []
+    with teller.task("Decrypting ciphers", total=nr_ciphers):
+        with get_executor(nr_parallel, shared=shared) as executor:
+            for r in executor.imap(compute_some_decryptors, chunks):
+                decryptors.extend(r)
+                teller.advance(len(r))
+
+    betas = [beta for alpha, beta in ciphers]
+    return decrypt_with_decryptors(modulus, generator, order,
+                                   betas, decryptors)
+
+def verify_decryption_factors_batch(modulus, generator, order, public,
+                                    ciphers, factors):
+    if len(ciphers) > 1:
+        tuples = [[cipher[ALPHA], factor] + list(proof)
+                  for cipher, (factor, proof) in izip(ciphers, factors)]
+        if verify_ddh_tuples_batch(modulus, generator, order,
+                                   public, tuples):
+            return 1
+
+    # Either a single factor or the batch failed; check one by one
     for cipher, factor in izip(ciphers, factors):
         alpha, beta = cipher
         factor, proof = factor
         if not verify_ddh_tuple(modulus, generator, order, alpha, public,
                                 factor, *proof):
-            if async_channel is not None:
-                async_channel.send_shared(-1)
-            if teller is not None:
-                teller.fail()
             return 0
+    return 1
 
-        count += 1
-        if count >= report_thresh:
-            if teller is not None:
-                teller.advance(count)
-            if async_channel is not None:
-                async_channel.send_shared(count)
-            count = 0
-
-    if count:
-        if teller is not None:
-            teller.advance(count)
-        if async_channel is not None:
-            async_channel.send_shared(count)
+def verify_decryption_factors1(modulus, generator, order, public,
+                               ciphers, factors, teller=_teller,
+                               batch_size=BATCH_VERIFY_SIZE):
+    nr_ciphers = len(ciphers)
+    if nr_ciphers != len(factors):
+        return 0
 
+    batch_size = max(batch_size, 1)
+    with teller.task("Verifying decryption factors", total=nr_ciphers):
+        for i in xrange(0, nr_ciphers, batch_size):
+            batch_ciphers = ciphers[i:i+batch_size]
+            batch_factors = factors[i:i+batch_size]
+            if not verify_decryption_factors_batch(modulus, generator, order,
+                                                   public, batch_ciphers,
+                                                   batch_factors):
+                teller.fail()
+                return 0
+            teller.advance(len(batch_ciphers))
     return 1
 
+def verify_some_decryption_factors(shared, start, end):
+    modulus, generator, order, public, ciphers, factors, batch_size = shared
+    batch_size = max(batch_size, 1)
+    for i in xrange(start, end, batch_size):
+        j = min(i + batch_size, end)
+        if not verify_decryption_factors_batch(modulus, generator, order,
+                                               public, ciphers[i:j],
+                                               factors[i:j]):
+            return -1
+    return end - start
+
 def verify_decryption_factors(modulus, generator, order, public,
                               ciphers, factors, teller=_teller,
-                              nr_parallel=1):
+                              nr_parallel=1, batch_size=BATCH_VERIFY_SIZE):
     if nr_parallel <= 0:
         return verify_decryption_factors1(modulus, generator, order, public,
-                                          ciphers, factors, teller=teller)
+                                          ciphers, factors, teller=teller,
+                                          batch_size=batch_size)
 
     nr_ciphers = len(ciphers)
     if nr_ciphers != len(factors):
         return 0
 
-    async = AsyncController(parallel=nr_parallel)
-    verify_some = async.make_async(verify_some_decryption_factors)
-
-    d, q = divmod(nr_ciphers, nr_parallel)
-    if not d:
-        d = nr_ciphers
-    index = range(0, nr_ciphers, d)
+    shared = (modulus, generator, order, public, ciphers, factors, batch_size)
+    chunks = get_chunks(nr_ciphers, nr_parallel)
     with teller.task("Verifying decryption factors", total=nr_ciphers):
-        channels = [verify_some(modulus, generator, order,
-                                public, ciphers[i:i+d], factors[i:i+d])
-                    for i in index]
-
-        count = 0
-        while count < nr_ciphers:
-            nr = async.receive_shared(wait=1)
-            if nr < 0:
-                async.shutdown()
-                teller.fail()
-                return 0
-            teller.advance(nr)
-            count += nr
+        with get_executor(nr_parallel, shared=shared) as executor:
+            for nr in executor.imap(verify_some_decryption_factors, chunks):
+                if nr < 0:
+                    executor.shutdown(terminate=True)
+                    teller.fail()
+                    return 0
+                teller.advance(nr)
 
-    async.shutdown()
     return 1
 
 def combine_decryption_factors(modulus, factor_collection):
@@ -4487,7 +5333,6 @@ class ZeusCoreElection(object):
         teller.finish()
 
     def compute_zeus_factors(self):
-        Random.atfork()
         teller = self.teller
         mixed_ballots = self.get_mixed_ballots()
         modulus, generator, order = self.do_get_cryptosystem()
@@ -4509,15 +5354,12 @@ class ZeusCoreElection(object):
         all_factors = self.do_get_all_trustee_factors().values()
         all_factors.append(zeus_factors)
         decryption_factors = combine_decryption_factors(modulus, all_factors)
-        plaintexts = []
-        append = plaintexts.append
+        betas = [ballot[BETA] for ballot in mixed_ballots]
 
         with teller.task("Decrypting ballots", total=len(mixed_ballots)):
-            for ballot, factor in izip(mixed_ballots, decryption_factors):
-                plaintext = decrypt_with_decryptor(modulus, generator, order,
-                                                   ballot[BETA], factor)
-                append(plaintext)
-                teller.advance()
+            plaintexts = decrypt_with_decryptors(modulus, generator, order,
+                                                 betas, decryption_factors,
+                                                 teller=teller)
 
         self.do_store_results(plaintexts)
         return plaintexts
@@ -4555,7 +5397,7 @@ class ZeusCoreElection(object):
 
         finished = self.export_decrypting()
         finished['results'] = self.do_get_results()
-        fingerprint = sha256(to_canonical(finished)).hexdigest()
+        fingerprint = hash_canonical(finished)
         finished['election_fingerprint'] = fingerprint
 
         report = ''
@@ -4588,7 +5430,7 @@ class ZeusCoreElection(object):
         self.do_store_results(finished['results'])
         finished.pop('election_report', None)
         fingerprint = finished.pop('election_fingerprint', None)
-        _fingerprint = sha256(to_canonical(finished)).hexdigest()
+        _fingerprint = hash_canonical(finished)
         if fingerprint is not None:
             if fingerprint != _fingerprint:
                 m = "Election fingerprint mismatch!"
@@ -5003,6 +5845,11 @@ def main():
         help=("Buffer output newlines according to --oms "
               "instead of sending them out immediately"))
 
+    parser.add_argument('--benchmark-permutations', nargs='*', type=int,
+        metavar='size',
+        help=("Time the random permutation generators "
+              "for the given sizes (default 10000 100000 1000000)"))
+
     args = parser.parse_args()
 
     def do_extract_signatures(election, prefix='counted', teller=_teller):
@@ -5195,7 +6042,10 @@ def main():
     if args.nr_procs > 0:
         nr_parallel = int(args.nr_procs)
 
-    if args.generate is not None:
+    if args.benchmark_permutations is not None:
+        sizes = args.benchmark_permutations or PERMUTATION_BENCHMARK_SIZES
+        return benchmark_permutations(sizes)
+    elif args.generate is not None:
         return main_generate(args, teller=teller, nr_parallel=nr_parallel)
     elif args.verify_signatures:
         return main_verify_signature(args, teller=teller,
@@ -5260,6 +6110,39 @@ def test_decryption():
     if sorted(pts) != sorted(texts):
         raise AssertionError("ZZ")
 
+PERMUTATION_BENCHMARK_SIZES = (10000, 100000, 1000000)
+
+def benchmark_permutations(sizes=PERMUTATION_BENCHMARK_SIZES, names=None,
+                           max_seconds=60, outstream=sys.stdout):
+    if names is None:
+        names = sorted(PERMUTATION_GENERATORS)
+    sizes = sorted(sizes)
+    timings = {}
+    for name in names:
+        get_permutation = PERMUTATION_GENERATORS[name]
+        elapsed = 0
+        last_size = 0
+        for nr_elements in sizes:
+            if last_size:
+                # Assume quadratic growth to skip hopelessly long runs
+                estimate = elapsed * (nr_elements / last_size) ** 2
+                if estimate > max_seconds:
+                    outstream.write("%-14s %9d    skipped (~%ds)\n"
+                                    % (name, nr_elements, estimate))
+                    continue
+            last_size = float(nr_elements)
+            t0 = time()
+            permutation = get_permutation(nr_elements)
+            elapsed = time() - t0
+            if sorted(permutation) != range(nr_elements):
+                m = "%s: invalid permutation of %d" % (name, nr_elements)
+                raise AssertionError(m)
+            timings[(name, nr_elements)] = elapsed
+            outstream.write("%-14s %9d %10.3fs\n" % (name, nr_elements,
+                                                       elapsed))
+            outstream.flush()
+    return timings
+
 retval = []
 
 if __name__ == '__main__':
@@ -0,0 +1,332 @@
+import struct
+from mmap import mmap, ACCESS_READ
+from binascii import hexlify, unhexlify
+from itertools import izip
+
+from panoramix import canonical
+
+# The panoramix and consensus_client packages keep identical copies of
+# this module, apart from the package name in imports.
+
+# Compact binary container for documents dominated by big integers,
+# such as cipher mixes and decryption factor lists.
+#
+# Layout:
+#   preamble   magic, version, flags, number of sections, params width
+#   params     modulus, generator, order as fixed-width integers; when
+#              they are taken from the document's top-level dict they are
+#              stored here only, and FLAG_PARAMS_MOVED is set
+#   index      offset, number of items, item width, item arity per section
+#   sections   section 0 is the canonical encoding of the document with
+#              every large list of integers replaced by a reference to
+#              a section that stores it as fixed-width big-endian integers.
+
+MAGIC = 'ZBIN'
+VERSION = 2
+# Version 1 containers never move params out of the document
+SUPPORTED_VERSIONS = (1, 2)
+FLAG_PARAMS_MOVED = 0x01
+PREAMBLE = struct.Struct('>4sBBHI')
+INDEX_ENTRY = struct.Struct('>QQHH')
+PARAM_NAMES = ('modulus', 'generator', 'order')
+SECTION_KEY = '__binary_section__'
+SHAPE_KEY = 'shape'
+SECTION_MIN_ITEMS = 16
+
+NOSHAPE = None
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def int_shape(obj):
+    if isinstance(obj, (int, long)) and not isinstance(obj, bool):
+        return 0 if obj >= 0 else NOSHAPE
+    if isinstance(obj, (list, tuple)):
+        shape = []
+        for item in obj:
+            s = int_shape(item)
+            if s is NOSHAPE:
+                return NOSHAPE
+            shape.append(s)
+        return shape
+    return NOSHAPE
+
+
+def shape_arity(shape):
+    if shape == 0:
+        return 1
+    return sum(shape_arity(s) for s in shape)
+
+
+def is_shape(shape):
+    if shape == 0:
+        return type(shape) is int
+    # An empty list has no integers, so a section could not rebuild it
+    return (isinstance(shape, list) and len(shape) > 0 and
+            all(is_shape(s) for s in shape))
+
+
+def list_shape(obj):
+    if len(obj) < SECTION_MIN_ITEMS:
+        return NOSHAPE
+    shape = int_shape(obj[0])
+    if shape is NOSHAPE or not is_shape(shape) or shape_arity(shape) > 0xffff:
+        return NOSHAPE
+    for item in obj:
+        if int_shape(item) != shape:
+            return NOSHAPE
+    return shape
+
+
+def flatten(item, shape):
+    if shape == 0:
+        return [item]
+    leaves = []
+    for sub, s in izip(item, shape):
+        if s == 0:
+            leaves.append(sub)
+        else:
+            leaves.extend(flatten(sub, s))
+    return leaves
+
+
+def build(leaves, shape):
+    if shape == 0:
+        return next(leaves)
+    return [build(leaves, s) for s in shape]
+
+
+def int_width(num):
+    return max((num.bit_length() + 7) // 8, 1)
+
+
+def encode_ints(nums, width):
+    fmt = '%%0%dx' % (2 * width)
+    return unhexlify(''.join([fmt % num for num in nums]))
+
+
+def decode_ints(data, width):
+    h = hexlify(data)
+    w = 2 * width
+    return [int(h[i:i+w], 16) for i in xrange(0, len(h), w)]
+
+
+class Section(object):
+    """A list of integer items decoded on access from a buffer"""
+
+    def __init__(self, buf, offset, nr_items, width, shape):
+        self.buf = buf
+        self.offset = offset
+        self.nr_items = nr_items
+        self.width = width
+        self.shape = shape
+        self.item_size = width * shape_arity(shape)
+
+    def __len__(self):
+        return self.nr_items
+
+    def item(self, i):
+        start = self.offset + i * self.item_size
+        leaves = decode_ints(self.buf[start:start+self.item_size],
+                             self.width)
+        return build(iter(leaves), self.shape)
+
+    def __getitem__(self, i):
+        nr_items = self.nr_items
+        if isinstance(i, slice):
+            return [self.item(j) for j in xrange(*i.indices(nr_items))]
+        if i < 0:
+            i += nr_items
+        if not 0 <= i < nr_items:
+            raise IndexError(i)
+        return self.item(i)
+
+    def __iter__(self):
+        for i in xrange(self.nr_items):
+            yield self.item(i)
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        for a, b in izip(self, other):
+            if a != b:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def tolist(self):
+        end = self.offset + self.nr_items * self.item_size
+        leaves = iter(decode_ints(self.buf[self.offset:end], self.width))
+        shape = self.shape
+        return [build(leaves, shape) for _ in xrange(self.nr_items)]
+
+
+def extract_sections(obj, sections):
+    if isinstance(obj, dict):
+        if SECTION_KEY in obj:
+            m = "binary: reserved key '%s' in document" % (SECTION_KEY,)
+            raise ValueError(m)
+        return dict((k, extract_sections(v, sections))
+                    for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        shape = list_shape(obj)
+        if shape is NOSHAPE:
+            return [extract_sections(v, sections) for v in obj]
+        sections.append((obj, shape))
+        return {SECTION_KEY: len(sections), SHAPE_KEY: shape}
+    return obj
+
+
+def is_param(value):
+    return (isinstance(value, (int, long)) and not isinstance(value, bool)
+            and value >= 0)
+
+
+def split_params(obj, params):
+    """Return the header params, the document left and the flags.
+
+    Params found in the top-level dict are moved to the header, so that
+    they are not stored twice.
+    """
+    if isinstance(obj, dict) and all(name in obj for name in PARAM_NAMES):
+        values = [obj[name] for name in PARAM_NAMES]
+        if all(is_param(v) for v in values) and (
+                params is None or
+                values == [params[name] for name in PARAM_NAMES]):
+            rest = dict((k, v) for k, v in obj.iteritems()
+                        if k not in PARAM_NAMES)
+            return values, rest, FLAG_PARAMS_MOVED
+    if params is None:
+        return [], obj, 0
+    return [params[name] for name in PARAM_NAMES], obj, 0
+
+
+def iter_dump(obj, params=None):
+    params, obj, flags = split_params(obj, params)
+    sections = []
+    skeleton = canonical.to_canonical(extract_sections(obj, sections))
+    params_width = max(int_width(p) for p in params) if params else 0
+    nr_sections = len(sections) + 1
+
+    offset = (PREAMBLE.size + params_width * len(params) +
+              INDEX_ENTRY.size * nr_sections)
+    index = [INDEX_ENTRY.pack(offset, len(skeleton), 1, 0)]
+    offset += len(skeleton)
+    widths = []
+    for items, shape in sections:
+        if shape == 0:
+            leaves = items
+        else:
+            leaves = [leaf for item in items for leaf in flatten(item, shape)]
+        width = int_width(max(leaves))
+        widths.append((leaves, width))
+        index.append(INDEX_ENTRY.pack(offset, len(items), width,
+                                      shape_arity(shape)))
+        offset += len(leaves) * width
+
+    yield PREAMBLE.pack(MAGIC, VERSION, flags, nr_sections, params_width)
+    if params:
+        yield encode_ints(params, params_width)
+    yield ''.join(index)
+    yield skeleton
+    for leaves, width in widths:
+        yield encode_ints(leaves, width)
+
+
+def dumps(obj, params=None):
+    return ''.join(iter_dump(obj, params=params))
+
+
+def dump(obj, path, params=None):
+    with open(path, 'wb') as f:
+        for data in iter_dump(obj, params=params):
+            f.write(data)
+
+
+def read_header(buf):
+    magic, version, flags, nr_sections, params_width = \
+        PREAMBLE.unpack(buf[:PREAMBLE.size])
+    if magic != MAGIC:
+        m = "invalid binary container magic '%s'" % (magic,)
+        raise ValueError(m)
+    if version not in SUPPORTED_VERSIONS:
+        m = "unsupported binary container version %d" % (version,)
+        raise ValueError(m)
+    if flags & ~FLAG_PARAMS_MOVED or (flags and not params_width):
+        m = "invalid binary container flags %d" % (flags,)
+        raise ValueError(m)
+
+    offset = PREAMBLE.size
+    params = None
+    if params_width:
+        end = offset + params_width * len(PARAM_NAMES)
+        params = dict(zip(PARAM_NAMES,
+                          decode_ints(buf[offset:end], params_width)))
+        offset = end
+
+    index = []
+    for _ in xrange(nr_sections):
+        index.append(INDEX_ENTRY.unpack(buf[offset:offset+INDEX_ENTRY.size]))
+        offset += INDEX_ENTRY.size
+    return params, index, flags
+
+
+def read_params(buf):
+    params, index, flags = read_header(buf)
+    return params
+
+
+def get_section(ref, buf, index):
+    number = ref[SECTION_KEY]
+    shape = ref.get(SHAPE_KEY)
+    # Section 0 is the skeleton itself
+    if type(number) not in (int, long) or not 0 < number < len(index):
+        m = "binary: invalid section reference '%s'" % (number,)
+        raise ValueError(m)
+    offset, nr_items, width, arity = index[number]
+    if not is_shape(shape) or shape_arity(shape) != arity:
+        m = "binary: invalid shape for section %d" % (number,)
+        raise ValueError(m)
+    if offset + nr_items * width * arity > len(buf):
+        m = "binary: section %d is truncated" % (number,)
+        raise ValueError(m)
+    return Section(buf, offset, nr_items, width, shape)
+
+
+def insert_sections(obj, buf, index, lazy):
+    if isinstance(obj, dict):
+        if SECTION_KEY in obj:
+            section = get_section(obj, buf, index)
+            return section if lazy else section.tolist()
+        return dict((k, insert_sections(v, buf, index, lazy))
+                    for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [insert_sections(v, buf, index, lazy) for v in obj]
+    return obj
+
+
+def loads(buf, unicode_strings=0, lazy=False):
+    params, index, flags = read_header(buf)
+    offset, size, width, arity = index[0]
+    skeleton = canonical.from_canonical(buf[offset:offset+size],
+                                        unicode_strings=unicode_strings)
+    obj = insert_sections(skeleton, buf, index, lazy)
+    if flags & FLAG_PARAMS_MOVED:
+        if not isinstance(obj, dict):
+            m = "binary: params moved out of a document that is not a dict"
+            raise ValueError(m)
+        obj.update(params)
+    return obj
+
+
+def load(path, unicode_strings=0, lazy=True):
+    with open(path, 'rb') as f:
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+    return loads(buf, unicode_strings=unicode_strings, lazy=lazy)
@@ -11,6 +11,9 @@ ui_mods = {
     'ui_web': ui_web,
 }
 
+# Validation error of a bulk upload to a cycle that has been closed
+CYCLE_NOT_CURRENT = "Cycle is not current"
+
 ui_choice = os.environ.get('PANORAMIX_UI_MODULE', 'ui_term')
 ui = ui_mods.get(ui_choice, 'ui_term')
 
@@ -30,6 +33,11 @@ def abort(text=None):
     exit()
 
 
+def is_cycle_not_current(response):
+    return (response.status_code == 400 and
+            CYCLE_NOT_CURRENT in response.content)
+
+
 def join_urls(*args):
     """
     Join arguments into a url.
@@ -211,12 +219,15 @@ class SphinxmixClient(object):
             raise Exception(r.content)
         return r.json()
 
-    def cycle_bulk_upload(self, endpoint_id, cycle, messages):
+    def post_cycle_bulk_upload(self, endpoint_id, cycle, messages):
         keys = ['sender', 'recipient', 'text', 'state']
         data = [pick_subdict(keys, msg) for msg in messages]
         data = {'messages': data}
-        r = self.cycles.custom_post(
+        return self.cycles.custom_post(
             'bulk-upload', str(cycle), data, ref=endpoint_id)
+
+    def cycle_bulk_upload(self, endpoint_id, cycle, messages):
+        r = self.post_cycle_bulk_upload(endpoint_id, cycle, messages)
         if r.status_code != 201:
             raise Exception(r.content)
         return r.json()
@@ -261,6 +272,25 @@ class SphinxmixClient(object):
             raise Exception(r.content)
         return r.json()
 
+    def message_send_bulk(self, endpoint_id, messages):
+        """Upload prepared messages to the current cycle and return it"""
+        endpoint = self.endpoint_get(endpoint_id)
+        if not endpoint['public']:
+            raise Exception("Cannot post to a private endpoint")
+        cycle = endpoint['current_cycle']
+        if cycle is None:
+            raise Exception("No open cycle")
+        r = self.post_cycle_bulk_upload(endpoint_id, cycle, messages)
+        if is_cycle_not_current(r):
+            # The cycle was closed since we looked it up
+            cycle = self.endpoint_get(endpoint_id)['current_cycle']
+            if cycle is None:
+                raise Exception("No open cycle")
+            r = self.post_cycle_bulk_upload(endpoint_id, cycle, messages)
+        if r.status_code != 201:
+            raise Exception(r.content)
+        return cycle
+
 
 def set_key_wizard():
     default = "create"
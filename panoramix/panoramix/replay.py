@@ -0,0 +1,250 @@
+import os
+import math
+import struct
+
+# Replay filter for mix node packet tags.
+#
+# Tags seen under the current key epoch are kept in Bloom filters for
+# constant time lookups and appended to log files, from which the filters
+# are rebuilt on restart. Tags of earlier epochs are useless once the node
+# key has changed, so rotating to a new epoch drops them.
+#
+# A Bloom filter filled past its capacity quickly loses accuracy, and a
+# false positive silently drops a legitimate packet. Tags are therefore
+# kept in generations of a fixed capacity, each with its own filter and
+# log. Once the newest generation is full a new one is started, and only
+# the last max_generations are kept, which bounds memory, disk usage and
+# the false positive rate. Packets older than the retained generations
+# are no longer recognised, so node keys should be rotated well before
+# capacity * max_generations packets have been processed.
+
+TAG_SIZE = 32
+LOG_SUFFIX = '.tags'
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 1e-9
+DEFAULT_MAX_GENERATIONS = 8
+LOG_READ_SIZE = TAG_SIZE * 4096
+
+HASH_WORDS = struct.Struct('>III')
+
+
+def validate_tag(tag):
+    if len(tag) != TAG_SIZE:
+        m = "replay tag must be %d bytes, not %d" % (TAG_SIZE, len(tag))
+        raise ValueError(m)
+
+
+def is_prime(n):
+    if n < 2 or n % 2 == 0:
+        return n == 2
+    d = 3
+    while d * d <= n:
+        if n % d == 0:
+            return False
+        d += 2
+    return True
+
+
+def bloom_geometry(capacity, error_rate):
+    ln2 = math.log(2)
+    nr_bits = int(math.ceil(-capacity * math.log(error_rate) / ln2 ** 2))
+    # With a prime number of bits every double hashing step is coprime to
+    # it, so the probe positions of a digest never repeat
+    while not is_prime(nr_bits):
+        nr_bits += 1
+    nr_hashes = max(1, int(round(ln2 * nr_bits / capacity)))
+    return nr_bits, nr_hashes
+
+
+class BloomFilter(object):
+    """Set membership for uniformly random digests, with false positives"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.nr_bits, self.nr_hashes = bloom_geometry(capacity, error_rate)
+        self.bits = bytearray((self.nr_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, digest):
+        # Triple hashing over three 32-bit words of the digest. Plain
+        # double hashing makes two digests agreeing on their first two
+        # words modulo nr_bits collide on every probe, which raises the
+        # false positive rate of small filters well above error_rate.
+        h1, h2, h3 = HASH_WORDS.unpack_from(digest)
+        nr_bits = self.nr_bits
+        pos = h1 % nr_bits
+        step = h2 % nr_bits
+        positions = []
+        append = positions.append
+        for _ in xrange(self.nr_hashes):
+            append(pos)
+            pos = (pos + step) % nr_bits
+            step = (step + h3) % nr_bits
+        return positions
+
+    def __contains__(self, digest):
+        # Same positions as above, but stop at the first unset bit
+        h1, h2, h3 = HASH_WORDS.unpack_from(digest)
+        bits = self.bits
+        nr_bits = self.nr_bits
+        pos = h1 % nr_bits
+        step = h2 % nr_bits
+        for _ in xrange(self.nr_hashes):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+            pos = (pos + step) % nr_bits
+            step = (step + h3) % nr_bits
+        return True
+
+    def add(self, digest):
+        """Add digest, returning False if it was (probably) present"""
+        bits = self.bits
+        added = False
+        for pos in self.positions(digest):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ReplayFilter(object):
+    """Remember the packet tags a mix node has processed in a key epoch.
+
+    Log files are named after the epoch, so that several nodes or keys
+    can share a directory: only files of this filter's own epoch are
+    ever read or removed.
+    """
+
+    def __init__(self, directory, epoch, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE,
+                 max_generations=DEFAULT_MAX_GENERATIONS):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.capacity = capacity
+        self.max_generations = max_generations
+        # Split so that the retained generations together stay within it
+        self.generation_error_rate = error_rate / max_generations
+        self.epoch = None
+        self.generations = []
+        self.log = None
+        self.rotate(epoch)
+
+    def log_path(self, epoch, generation):
+        name = '%s.%d%s' % (epoch, generation, LOG_SUFFIX)
+        return os.path.join(self.directory, name)
+
+    def list_generations(self, epoch):
+        """Return the generations logged under epoch, oldest first"""
+        prefix = epoch + '.'
+        generations = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or not name.endswith(LOG_SUFFIX):
+                continue
+            number = name[len(prefix):-len(LOG_SUFFIX)]
+            if number.isdigit():
+                generations.append(int(number))
+        generations.sort()
+        return generations
+
+    def new_bloom(self):
+        return BloomFilter(self.capacity, self.generation_error_rate)
+
+    def load(self, path, bloom):
+        with open(path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            # Drop a tag left half written by a crash
+            if size % TAG_SIZE:
+                size -= size % TAG_SIZE
+                f.truncate(size)
+            add = bloom.add
+            while 1:
+                data = f.read(LOG_READ_SIZE)
+                if not data:
+                    break
+                for offset in xrange(0, len(data), TAG_SIZE):
+                    add(data[offset:offset+TAG_SIZE])
+
+    def remove_generation(self, generation):
+        os.remove(self.log_path(self.epoch, generation))
+
+    def open_generation(self, generation, bloom):
+        self.close()
+        self.generations.append((generation, bloom))
+        self.log = open(self.log_path(self.epoch, generation), 'ab')
+        while len(self.generations) > self.max_generations:
+            oldest, _ = self.generations.pop(0)
+            self.remove_generation(oldest)
+
+    def start_generation(self):
+        if self.log is not None:
+            self.sync()
+        generation = self.generations[-1][0] + 1 if self.generations else 0
+        self.open_generation(generation, self.new_bloom())
+
+    def rotate(self, epoch):
+        if epoch == self.epoch:
+            return
+        self.close()
+        if self.epoch is not None:
+            for generation in self.list_generations(self.epoch):
+                self.remove_generation(generation)
+
+        self.epoch = epoch
+        self.generations = []
+        logged = self.list_generations(epoch)
+        for generation in logged[:-self.max_generations]:
+            self.remove_generation(generation)
+        logged = logged[-self.max_generations:]
+        if not logged:
+            self.start_generation()
+            return
+
+        for generation in logged:
+            bloom = self.new_bloom()
+            self.load(self.log_path(epoch, generation), bloom)
+            self.generations.append((generation, bloom))
+        last, bloom = self.generations.pop()
+        self.open_generation(last, bloom)
+        if bloom.is_full():
+            self.start_generation()
+
+    def seen(self, tag):
+        """Return True if tag was (probably) recorded, without recording it"""
+        validate_tag(tag)
+        for generation, bloom in self.generations:
+            if tag in bloom:
+                return True
+        return False
+
+    def check(self, tag):
+        """Record tag and return True, or return False for a replay"""
+        if self.seen(tag):
+            return False
+        self.record(tag)
+        return True
+
+    def record(self, tag):
+        """Record tag; it is only durable after the next sync"""
+        validate_tag(tag)
+        bloom = self.generations[-1][1]
+        bloom.add(tag)
+        self.log.write(tag)
+        if bloom.is_full():
+            self.start_generation()
+
+    def sync(self):
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
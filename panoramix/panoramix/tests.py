@@ -0,0 +1,765 @@
+import base64
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from panoramix import binary, canonical, replay, utils
+from panoramix.backends import zeus_backend, zeus_crypto
+
+MIX_ROUNDS = 8
+NR_CIPHERS = 12
+
+
+def encrypt_texts(texts, public):
+    p, g, q = zeus_crypto.p, zeus_crypto.g, zeus_crypto.q
+    return [zeus_crypto.encrypt(text, p, g, q, public)[:2] for text in texts]
+
+
+def mix_for(ciphers, public):
+    return {'modulus': zeus_crypto.p,
+            'generator': zeus_crypto.g,
+            'order': zeus_crypto.q,
+            'public': public,
+            'original_ciphers': ciphers,
+            'mixed_ciphers': ciphers}
+
+
+def check_mix_reencrypts(factors=None):
+    p, q, g, x, y = zeus_crypto.c2048()
+    texts = range(NR_CIPHERS)
+    ciphers = encrypt_texts(texts, y)
+    mix = zeus_crypto.mix_ciphers(mix_for(ciphers, y), nr_rounds=MIX_ROUNDS,
+                                  factors=factors)
+    assert zeus_crypto.verify_cipher_mix(mix)
+
+    mixed = mix['mixed_ciphers']
+    assert not set(map(tuple, mixed)) & set(map(tuple, ciphers))
+    decrypted = zeus_crypto.decrypt_ciphers(p, g, q, x, mixed)
+    assert sorted(decrypted) == texts
+
+
+def test_mix_reencrypts():
+    check_mix_reencrypts()
+
+
+def test_mix_reencrypts_with_precomputed_factors():
+    p, q, g, x, y = zeus_crypto.c2048()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'factors')
+        nr_factors = NR_CIPHERS * (MIX_ROUNDS + 1)
+        zeus_crypto.precompute_reencryption_factors(path, p, g, q, y,
+                                                    nr_factors)
+        factors = zeus_crypto.PrecomputedFactors(path, p, g, q, y)
+        check_mix_reencrypts(factors=factors)
+        factors.close()
+        # Factors are secret: they link the mix inputs to its outputs
+        for name in ('factors', 'factors.used'):
+            mode = os.stat(os.path.join(tmpdir, name)).st_mode
+            assert mode & 0777 == 0600
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_file_mix_store_round_trip():
+    p, q, g, x, y = zeus_crypto.c2048()
+    ciphers = encrypt_texts(range(NR_CIPHERS), y)
+    tmpdir = tempfile.mkdtemp()
+    chunk = zeus_crypto.MIX_STORE_CHUNK
+    # Several chunks per round
+    zeus_crypto.MIX_STORE_CHUNK = 5
+    try:
+        path = os.path.join(tmpdir, 'mix')
+        store = zeus_crypto.FileMixStore(path)
+        mix = zeus_crypto.mix_ciphers(mix_for(ciphers, y),
+                                      nr_rounds=MIX_ROUNDS, store=store)
+        assert len(store) == MIX_ROUNDS
+        assert zeus_crypto.verify_cipher_mix(mix)
+        assert zeus_crypto.compute_mix_challenge(mix) == mix['challenge']
+
+        # A mix reopened from disk has the same contents and verifies
+        loaded = zeus_crypto.FileMixStore.load_cipher_mix(path)
+        for key in ('modulus', 'generator', 'order', 'public',
+                    'original_ciphers', 'mixed_ciphers', 'challenge'):
+            assert loaded[key] == mix[key]
+        for key in ('cipher_collections', 'offset_collections',
+                    'random_collections'):
+            assert len(loaded[key]) == MIX_ROUNDS
+            assert list(loaded[key]) == list(mix[key])
+        assert zeus_crypto.verify_cipher_mix(loaded)
+        assert zeus_crypto.verify_cipher_mix(loaded, nr_parallel=2)
+        decrypted = zeus_crypto.decrypt_ciphers(p, g, q, x,
+                                                loaded['mixed_ciphers'])
+        assert sorted(decrypted) == range(NR_CIPHERS)
+    finally:
+        zeus_crypto.MIX_STORE_CHUNK = chunk
+        shutil.rmtree(tmpdir)
+
+class FailingStore(zeus_crypto.MixStore):
+    def append_round(self, ciphers, offsets, randoms):
+        raise ValueError("store failed")
+
+
+def test_mix_shuts_down_executor_on_error():
+    executors = []
+
+    class RecordingExecutor(zeus_crypto.ProcessExecutor):
+        def __init__(self, *args, **kwargs):
+            zeus_crypto.ProcessExecutor.__init__(self, *args, **kwargs)
+            executors.append(self)
+
+    p, q, g, x, y = zeus_crypto.c2048()
+    ciphers = encrypt_texts(range(NR_CIPHERS), y)
+    zeus_crypto.set_executor_class(RecordingExecutor)
+    try:
+        assert_raises(ValueError, zeus_crypto.mix_ciphers,
+                      mix_for(ciphers, y), nr_rounds=MIX_ROUNDS,
+                      nr_parallel=2, store=FailingStore())
+    finally:
+        zeus_crypto.set_executor_class(zeus_crypto.ProcessExecutor)
+    [executor] = executors
+    assert not executor.workers
+
+def test_verify_mix_uses_mix_parameters():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    public = pow(g, 12345, p)
+    ciphers = encrypt_texts(range(NR_CIPHERS), public)
+    mix = zeus_crypto.mix_ciphers(mix_for(ciphers, public),
+                                  nr_rounds=MIX_ROUNDS)
+    assert zeus_crypto.verify_cipher_mix(mix)
+    assert zeus_crypto.verify_cipher_mix(mix, nr_parallel=2)
+
+    # Checked against the module key the same proof must not verify
+    mix['public'] = zeus_crypto.y
+    try:
+        zeus_crypto.verify_cipher_mix(mix)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("mix verified under the wrong public key")
+
+
+def read_in_child(pool, nr_bytes):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(rfd)
+            os.write(wfd, pool.read(nr_bytes))
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    data = ''
+    while len(data) < nr_bytes:
+        chunk = os.read(rfd, nr_bytes)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return data
+
+
+def test_random_pool_reseeds_after_fork():
+    pool = zeus_crypto.RandomPool(block_size=4096)
+    first = pool.read(16)
+    assert len(first) == 16 and len(pool.buffer) == 4096
+    buffered = pool.buffer[pool.offset:]
+
+    child_bytes = read_in_child(pool, 64)
+    assert len(child_bytes) == 64
+    assert child_bytes not in buffered
+    # The parent goes on with its own buffer
+    assert pool.read(64) == buffered[:64]
+    assert pool.read(8192) != pool.read(8192)
+
+def naive_multi_pow(bases, exponents, modulus):
+    result = 1
+    for base, exponent in zip(bases, exponents):
+        result = (result * pow(base, exponent, modulus)) % modulus
+    return result
+
+
+def test_multi_pow_matches_naive_product():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    rand = zeus_crypto.get_random_int
+    for nr_bases in (1, 2, 3, 8, 20):
+        bases = [pow(g, rand(2, q), p) for _ in xrange(nr_bases)]
+        exponents = [rand(0, q) for _ in xrange(nr_bases)]
+        # Short exponents, zeros and ones, as in batch verification
+        exponents[0] = rand(1, 2 ** 128)
+        if nr_bases > 2:
+            exponents[1] = 0
+            exponents[2] = 1
+        expected = naive_multi_pow(bases, exponents, p)
+        for window in (2, 4, 6):
+            assert zeus_crypto.straus_pow(bases, exponents, p,
+                                          window=window) == expected
+        assert zeus_crypto.multi_pow(bases, exponents, p) == expected
+        assert zeus_crypto.multi_pow(bases, exponents, p,
+                                     fixed=1) == expected
+    assert zeus_crypto.straus_pow([g, g], [0, 0], p) == 1
+    assert zeus_crypto.multi_pow([], [], p) == 1
+    assert_raises(ValueError, zeus_crypto.multi_pow, [g], [-1], p)
+    assert_raises(ValueError, zeus_crypto.straus_pow, [g], [-1], p)
+
+def test_permutation_generators():
+    assert (zeus_crypto.get_permutation_generator() is
+            zeus_crypto.get_random_permutation)
+    for name in sorted(zeus_crypto.PERMUTATION_GENERATORS):
+        get_permutation = zeus_crypto.get_permutation_generator(name)
+        for nr_elements in (1, 2, 100):
+            permutation = get_permutation(nr_elements)
+            assert sorted(permutation) == range(nr_elements)
+    assert_raises(ValueError, zeus_crypto.get_permutation_generator, 'none')
+
+    p, q, g, x, y = zeus_crypto.c2048()
+    ciphers = encrypt_texts(range(NR_CIPHERS), y)
+    mix = zeus_crypto.mix_ciphers(mix_for(ciphers, y), nr_rounds=MIX_ROUNDS,
+                                  permutation='fisher-yates')
+    assert zeus_crypto.verify_cipher_mix(mix)
+
+def make_binary_document():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    ciphers = encrypt_texts(range(20), zeus_crypto.y)
+    return {'modulus': p, 'generator': g, 'order': q,
+            'mixed_ciphers': ciphers,
+            'offsets': range(20),
+            'factors': [[c[0], [c[1], 1, 2, 3]] for c in ciphers],
+            'short': [1, 2, 3],
+            'name': 'mix', 'nested': {'list': [[1, 2]] * 16}}
+
+
+def test_binary_round_trip():
+    doc = make_binary_document()
+    data = binary.dumps(doc)
+    assert binary.is_binary(data)
+    assert binary.read_params(data) == dict(
+        (name, doc[name]) for name in binary.PARAM_NAMES)
+    assert binary.loads(data) == doc
+    lazy = binary.loads(data, lazy=True)
+    assert isinstance(lazy['mixed_ciphers'], binary.Section)
+    assert lazy == doc
+    assert lazy['mixed_ciphers'][-1] == doc['mixed_ciphers'][-1]
+    assert lazy['mixed_ciphers'][2:5] == doc['mixed_ciphers'][2:5]
+
+    # The params are stored in the header only
+    params, index, flags = binary.read_header(data)
+    offset, size, width, arity = index[0]
+    skeleton = canonical.from_canonical(data[offset:offset+size])
+    assert not set(binary.PARAM_NAMES) & set(skeleton)
+    other = dict(params, order=params['order'] - 1)
+    data = binary.dumps(doc, params=other)
+    assert binary.read_params(data) == other
+    assert binary.loads(data) == doc
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'doc')
+        binary.dump(doc, path)
+        assert binary.load(path) == doc
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_binary_round_trip_empty_lists():
+    nr_items = binary.SECTION_MIN_ITEMS
+    for doc in [[[[], 1]] * nr_items, {'data': [[1, [[]]]] * nr_items},
+                [[]] * nr_items, [[[5, 6], 7]] * nr_items]:
+        assert binary.loads(binary.dumps(doc)) == doc
+        assert binary.loads(binary.dumps(doc), lazy=True) == doc
+
+
+def test_binary_rejects_bad_sections():
+    doc = make_binary_document()
+    assert_raises(ValueError, binary.dumps,
+                  {'data': {binary.SECTION_KEY: 1}})
+
+    data = binary.dumps(doc)
+    params, index, flags = binary.read_header(data)
+    bad_refs = [{binary.SECTION_KEY: 0, binary.SHAPE_KEY: [0, 0]},
+                {binary.SECTION_KEY: len(index), binary.SHAPE_KEY: [0, 0]},
+                {binary.SECTION_KEY: '1', binary.SHAPE_KEY: [0, 0]},
+                {binary.SECTION_KEY: 1, binary.SHAPE_KEY: [0, 0, 0]},
+                {binary.SECTION_KEY: 1, binary.SHAPE_KEY: 'x'},
+                {binary.SECTION_KEY: 1}]
+    for ref in bad_refs:
+        assert_raises(ValueError, binary.insert_sections, ref, data, index,
+                      False)
+    assert_raises(ValueError, binary.loads, data[:-1])
+    assert_raises(ValueError, binary.loads, 'XBIN' + data[4:])
+    # Params restored into a document that is not a dict
+    data = binary.dumps([1, 2], params=params)
+    preamble = list(binary.PREAMBLE.unpack_from(data))
+    preamble[2] = binary.FLAG_PARAMS_MOVED
+    moved = binary.PREAMBLE.pack(*preamble)
+    assert_raises(ValueError, binary.loads, moved + data[len(moved):])
+    preamble[2] = 0x80
+    bad_flags = binary.PREAMBLE.pack(*preamble)
+    assert_raises(ValueError, binary.loads, bad_flags + data[len(moved):])
+
+def make_tags(nr_tags):
+    return [os.urandom(replay.TAG_SIZE) for _ in xrange(nr_tags)]
+
+
+def test_replay_filter_generations():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        replays = replay.ReplayFilter(tmpdir, 'key', capacity=1000,
+                                      error_rate=1e-6, max_generations=3)
+        tags = make_tags(9500)
+        # A false positive now and then is expected; those tags are
+        # not recorded
+        recorded = [tag for tag in tags if replays.check(tag)]
+        assert len(recorded) > 9490
+        assert len(replays.generations) == 3
+        assert sorted(os.listdir(tmpdir)) == [
+            'key.%d.tags' % n for n in (7, 8, 9)]
+        # The retained generations still catch recent replays
+        assert not any(replays.check(tag) for tag in recorded[-2000:])
+
+        replays.sync()
+        replays.close()
+        replays = replay.ReplayFilter(tmpdir, 'key', capacity=1000,
+                                      error_rate=1e-6, max_generations=3)
+        assert not any(replays.check(tag) for tag in recorded[-2000:])
+        assert all(replays.check(tag) for tag in make_tags(10))
+        replays.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_replay_filter_rotate_keeps_other_logs():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        other = replay.ReplayFilter(tmpdir, 'other', capacity=100)
+        other.check(make_tags(1)[0])
+        other.close()
+
+        replays = replay.ReplayFilter(tmpdir, 'old', capacity=100)
+        tag = make_tags(1)[0]
+        assert replays.check(tag)
+        assert not replays.check(tag)
+        replays.rotate('new')
+        assert replays.check(tag)
+        replays.close()
+        assert sorted(os.listdir(tmpdir)) == ['new.0.tags', 'other.0.tags']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def assert_raises(exception, func, *args, **kwargs):
+    try:
+        func(*args, **kwargs)
+    except exception:
+        return
+    raise AssertionError("%s not raised" % exception.__name__)
+
+
+def test_decrypt_rejects_non_invertible_decryptor():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    alpha, beta = encrypt_texts([7], zeus_crypto.y)[0]
+    decryptor = pow(alpha, zeus_crypto.x, p)
+    assert zeus_crypto.decrypt_with_decryptor(p, g, q, beta, decryptor) == 7
+    assert_raises(ValueError, zeus_crypto.decrypt_with_decryptor,
+                  p, g, q, beta, 0)
+    assert_raises(ValueError, zeus_crypto.decrypt_with_decryptor,
+                  p, g, q, beta, p)
+    assert_raises(ValueError, zeus_crypto.batch_inverse,
+                  [decryptor, 0, decryptor], p)
+
+
+def test_combine_matches_unbatched_decryption():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    secrets = [zeus_crypto.get_random_int(2, q) for _ in xrange(3)]
+    public = 1
+    for secret in secrets:
+        public = (public * pow(g, secret, p)) % p
+    texts = range(NR_CIPHERS)
+    ciphers = encrypt_texts(texts, public)
+    betas = [beta for _, beta in ciphers]
+
+    factors_collection = [
+        zeus_crypto.compute_decryption_factors(p, g, q, secret, ciphers,
+                                               nr_parallel=0)
+        for secret in secrets]
+    messages = [zeus_backend.encode_message(zip(factors, betas),
+                                            use_binary=(i == 1))
+                for i, factors in enumerate(factors_collection)]
+
+    combined = zeus_crypto.combine_decryption_factors(p, factors_collection)
+    expected = [zeus_crypto.decrypt_with_decryptor(p, g, q, beta, factor)
+                for beta, factor in zip(betas, combined)]
+    assert expected == texts
+
+    params = zeus_backend.make_zeus_params(
+        {'modulus': p, 'generator': g, 'order': q})
+    results, _ = zeus_backend.combine(messages, params)
+    assert results == map(zeus_backend.encode_message, expected)
+    assert list(zeus_backend.iter_combine(messages, params)) == results
+    assert list(zeus_backend.iter_combine([], params)) == []
+
+
+def make_decryption_factors(nr_ciphers):
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    secret = zeus_crypto.get_random_int(2, q)
+    public = pow(g, secret, p)
+    ciphers = encrypt_texts(range(nr_ciphers), zeus_crypto.y)
+    factors = zeus_crypto.compute_decryption_factors(p, g, q, secret, ciphers,
+                                                     nr_parallel=0)
+    return secret, public, ciphers, factors
+
+
+def verify_factors(public, ciphers, factors, **kwargs):
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    return zeus_crypto.verify_decryption_factors(p, g, q, public, ciphers,
+                                                 factors, **kwargs)
+
+
+def test_batch_verify_decryption_factors():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    secret, public, ciphers, factors = make_decryption_factors(NR_CIPHERS)
+    tuples = [[alpha, factor] + proof
+              for (alpha, _), (factor, proof) in zip(ciphers, factors)]
+    assert zeus_crypto.verify_ddh_tuples_batch(p, g, q, public, tuples)
+    for batch_size in (1, 5, NR_CIPHERS):
+        assert verify_factors(public, ciphers, factors, nr_parallel=0,
+                              batch_size=batch_size)
+    assert verify_factors(public, ciphers, factors, nr_parallel=2)
+
+    # Factors of another key do not verify, in a batch or one by one
+    other = pow(g, secret + 1, p)
+    assert not zeus_crypto.verify_ddh_tuples_batch(p, g, q, other, tuples)
+    assert not verify_factors(other, ciphers, factors, nr_parallel=0)
+
+
+def test_batch_verify_finds_single_bad_factor():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    secret, public, ciphers, factors = make_decryption_factors(NR_CIPHERS)
+    for index in (0, NR_CIPHERS // 2, NR_CIPHERS - 1):
+        bad = [list(f) for f in factors]
+        bad[index][0] = (bad[index][0] * g) % p
+        tuples = [[alpha, factor] + proof
+                  for (alpha, _), (factor, proof) in zip(ciphers, bad)]
+        assert not zeus_crypto.verify_ddh_tuples_batch(p, g, q, public,
+                                                       tuples)
+        assert not zeus_crypto.verify_decryption_factors_batch(
+            p, g, q, public, ciphers, bad)
+        for batch_size in (1, 5):
+            assert not verify_factors(public, ciphers, bad, nr_parallel=0,
+                                      batch_size=batch_size)
+        # Batches before the bad factor still verify on their own
+        assert verify_factors(public, ciphers[:index], bad[:index],
+                              nr_parallel=0, batch_size=5)
+
+
+def verify_factors_one_by_one(public, ciphers, factors):
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    return all(zeus_crypto.verify_ddh_tuple(p, g, q, alpha, public,
+                                            factor, *proof)
+               for (alpha, _), (factor, proof) in zip(ciphers, factors))
+
+
+def test_batch_verify_non_residues():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    secret, public, ciphers, factors = make_decryption_factors(NR_CIPHERS)
+    # -alpha is not a quadratic residue, so its proof is checked alone.
+    # Such a proof only verifies when the response did not wrap around
+    # an odd multiple of the order.
+    alpha, beta = ciphers[0]
+    alpha = -alpha % p
+    assert zeus_crypto.jacobi(alpha, p) == -1
+    factor = pow(alpha, secret, p)
+    ciphers[0] = [alpha, beta]
+    for _ in xrange(64):
+        proof = zeus_crypto.prove_ddh_tuple(p, g, q, alpha, public, factor,
+                                            secret)
+        factors[0] = [factor, proof]
+        if verify_factors_one_by_one(public, ciphers, factors):
+            break
+    assert verify_factors(public, ciphers, factors, nr_parallel=0)
+
+    # Whatever the residues, the verdict is that of the one by one check
+    variants = [(public, 0, -factor % p),
+                (public, 1, -factors[1][0] % p),
+                (-public % p, 1, factors[1][0])]
+    for key, index, bad_factor in variants:
+        bad = [list(f) for f in factors]
+        bad[index][0] = bad_factor
+        expected = verify_factors_one_by_one(key, ciphers, bad)
+        assert verify_factors(key, ciphers, bad, nr_parallel=0) == expected
+
+
+def test_encrypt_many_decrypts_to_inputs():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    params = zeus_backend.make_zeus_params(
+        {'modulus': p, 'generator': g, 'order': q})
+    secret = zeus_crypto.get_random_int(2, q)
+    public = pow(g, secret, p)
+    values = [str(n) for n in [0, 1, 7, 12345, q - 2]]
+    for nr_parallel in (0, 2):
+        messages = zeus_backend.encrypt_many(values, public, params,
+                                             nr_parallel=nr_parallel)
+        assert len(set(messages)) == len(values)
+        for message in messages:
+            alpha, beta, commitment, challenge, response = \
+                zeus_backend.decode_message(message)
+            assert zeus_crypto.verify_encryption(p, g, q, alpha, beta,
+                                                 commitment, challenge,
+                                                 response)
+        decrypted, _ = zeus_backend.decrypt(messages, params, secret)
+        assert decrypted == values
+    single = zeus_backend.encrypt(values[3], public, params)
+    assert zeus_backend.decrypt([single], params, secret)[0] == values[3:4]
+
+def test_registry_keeps_mode_and_rereads():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'registry')
+        registry = zeus_backend.Registry(path)
+        registry.register_key(u'1234')
+        key_id = zeus_backend.get_key_id_from_key_data(u'1234')
+        assert registry.get_key(key_id) == u'1234'
+
+        os.chmod(path, 0640)
+        registry.register_key(u'5678')
+        assert os.stat(path).st_mode & 0777 == 0640
+        assert os.listdir(tmpdir) == ['registry']
+
+        # A key dropped by another writer is no longer served from cache
+        with open(path, 'w') as f:
+            f.write('{}')
+        assert_raises(KeyError, registry.get_key, key_id)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def import_sphinxmix_backend():
+    return pytest.importorskip('panoramix.backends.sphinxmix_backend')
+
+
+def make_sphinx_node(sphinxmix):
+    crypto_params = sphinxmix.get_default_crypto_params()
+    params = sphinxmix.make_sphinxmix_params(crypto_params)
+    secret, public = sphinxmix.create_key(params)
+    return crypto_params, params, secret, str(public)
+
+
+def encrypt_sphinx(sphinxmix, params, public, texts, use_binary=False):
+    recipients = [public, 'recipient']
+    return [{'text': sphinxmix.encrypt(text, recipients, params,
+                                       use_binary=use_binary)}
+            for text in texts]
+
+
+def test_sphinx_parallel_processing_matches_serial():
+    sphinxmix = import_sphinxmix_backend()
+    crypto_params, params, secret, public = make_sphinx_node(sphinxmix)
+    texts = ['message %d' % i
+             for i in xrange(3 * sphinxmix.PROCESS_MIN_CHUNK)]
+    messages = encrypt_sphinx(sphinxmix, params, public, texts)
+
+    # Chunks come back in order, so the shuffle is kept
+    packets = [sphinxmix.read_sphinx_packet(m['text']) for m in messages]
+    serial = [sphinxmix.process_sphinx_packet(packet, params, secret)
+              for packet in packets]
+    parallel = sphinxmix.process_sphinxmix_parallel(
+        packets, crypto_params, secret, 2)
+    assert parallel == serial
+
+    expected = sorted(('recipient', text) for text in texts)
+    processed, _ = sphinxmix.process_sphinxmix(
+        messages, params, secret, crypto_params=crypto_params,
+        nr_parallel=2)
+    assert sorted(processed) == expected
+    processed, _ = sphinxmix.process_sphinxmix(messages, params, secret)
+    assert sorted(processed) == expected
+
+
+def test_sphinx_binary_packets():
+    sphinxmix = import_sphinxmix_backend()
+    _, params, secret, public = make_sphinx_node(sphinxmix)
+    [message] = encrypt_sphinx(sphinxmix, params, public, ['hello'],
+                               use_binary=True)
+    text = message['text']
+    assert sphinxmix.is_binary_packet(text)
+
+    # Both wire formats carry the same fields
+    fields = sphinxmix.read_packet(text)
+    header, delta = sphinxmix.decode_packet(text, params)
+    assert sphinxmix.read_packet(
+        sphinxmix.encode_packet(header, delta)) == fields
+    assert sphinxmix.read_packet(
+        sphinxmix.encode_packet(header, delta, use_binary=True)) == fields
+    assert sphinxmix.process_sphinxmix([message], params, secret) == \
+        ([('recipient', 'hello')], None)
+
+    data = sphinxmix.pack_packet(header, delta)
+    assert sphinxmix.unpack_packet_fields(data) == fields
+    size = sphinxmix.PACKET_HEADER.size
+    assert_raises(ValueError, sphinxmix.unpack_packet_fields, data[:size-1])
+    assert_raises(ValueError, sphinxmix.unpack_packet_fields, data[:-1])
+    assert_raises(ValueError, sphinxmix.unpack_packet_fields, data + 'x')
+    assert_raises(ValueError, sphinxmix.unpack_packet_fields,
+                  chr(sphinxmix.PACKET_VERSION + 1) + data[1:])
+
+
+def test_sphinx_route_cache():
+    sphinxmix = import_sphinxmix_backend()
+    crypto_params = sphinxmix.get_default_crypto_params()
+    params = sphinxmix.make_sphinxmix_params(crypto_params)
+    assert sphinxmix.make_sphinxmix_params(dict(crypto_params)) is params
+
+    publics = [str(sphinxmix.create_key(params)[1]) for _ in xrange(3)]
+    routes = sphinxmix.RouteCache(params, size=2)
+    route = routes.get(publics[:2])
+    assert routes.get(list(publics[:2])) is route
+    assert route == sphinxmix.make_route(publics[:2], params)
+
+    # The least recently used route is evicted and rebuilt on demand
+    other = routes.get(publics[1:])
+    routes.get(publics[:2])
+    routes.get(publics[:1])
+    assert len(routes.entries) == 2
+    assert routes.get(publics[:2]) is route
+    assert routes.get(publics[1:]) is not other
+    assert routes.get(publics[1:]) == other
+
+
+def test_sphinx_replays_recorded_after_processing():
+    sphinxmix = import_sphinxmix_backend()
+    crypto_params, params, secret, public = make_sphinx_node(sphinxmix)
+    texts = ['message %d' % i for i in xrange(4)]
+    messages = encrypt_sphinx(sphinxmix, params, public, texts)
+    expected = sorted(('recipient', text) for text in texts)
+    # A packet whose point cannot be imported fails the whole batch
+    data = sphinxmix.PACKET_HEADER.pack(
+        sphinxmix.PACKET_VERSION, 4, 1, 1, 1) + '\x05bad' + 'bgd'
+    bad = {'text': sphinxmix.BINARY_PREFIX + base64.b64encode(data)}
+    endpoint = {'endpoint_type': 'SPHINXMIX'}
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = sphinxmix.Client(crypto_params, public,
+                                  sphinxmix.bn_encode(secret),
+                                  replay_dir=tmpdir)
+        assert_raises(Exception, client.process, endpoint, messages + [bad])
+        client.record_processed()
+        # The failed batch is retried in full, without its duplicates
+        processed, _ = client.process(endpoint, messages + messages[:1])
+        assert sorted(processed) == expected
+        processed, _ = client.process(endpoint, messages)
+        assert sorted(processed) == expected
+
+        client.record_processed()
+        assert client.process(endpoint, messages) == ([], None)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_decrypt_ciphers_matches_single_decryption():
+    p, q, g, x, y = zeus_crypto.c2048()
+    ciphers = encrypt_texts(range(NR_CIPHERS), y)
+    expected = [zeus_crypto.decrypt(p, g, q, x, alpha, beta)
+                for alpha, beta in ciphers]
+    assert expected == range(NR_CIPHERS)
+    for nr_parallel in (0, 2):
+        assert zeus_crypto.decrypt_ciphers(
+            p, g, q, x, ciphers, nr_parallel=nr_parallel) == expected
+    assert zeus_crypto.decrypt_ciphers(p, g, q, x, []) == []
+
+
+def to_messages(processed):
+    return [{'recipient': recipient, 'text': text}
+            for recipient, text in processed]
+
+
+def test_client_settings_reach_endpoints():
+    p, q, g = zeus_crypto.p, zeus_crypto.q, zeus_crypto.g
+    crypto_params = {'modulus': p, 'generator': g, 'order': q}
+    params = zeus_backend.make_zeus_params(crypto_params)
+    secret, public = zeus_backend.create_key(params)
+    values = [str(n) for n in range(NR_CIPHERS)]
+    messages = to_messages(utils.with_recipient(
+        zeus_backend.encrypt_many(values, public, params), 'next'))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        factors_path = os.path.join(tmpdir, 'factors')
+        nr_factors = NR_CIPHERS * (zeus_crypto.MIN_MIX_ROUNDS + 1)
+        zeus_backend.precompute_factors(factors_path, params, public,
+                                        nr_factors)
+        client = zeus_backend.get_client({
+            'CRYPTO_PARAMS': crypto_params,
+            'KEY': {'PUBLIC': public, 'SECRET': secret},
+            'REGISTRY_PATH': os.path.join(tmpdir, 'registry'),
+            'NR_PARALLEL': 2,
+            'PRECOMPUTED_FACTORS_PATH': factors_path,
+        })
+        assert client.nr_parallel == 2
+        assert client.factors_path == factors_path
+
+        endpoint_params = {'election_public': utils.int_to_unicode(public)}
+        endpoint = {'endpoint_type': 'ZEUS_SK_MIX',
+                    'endpoint_params': canonical.to_canonical(
+                        endpoint_params)}
+        mixed, proof = client.process(endpoint, messages)
+        mixed = to_messages(mixed)
+        assert sorted(proof) == ['challenge', 'cipher_collections',
+                                 'offset_collections', 'random_collections']
+        # The mix drew its re-encryption factors from the file
+        with open(factors_path + '.used') as f:
+            assert int(f.read()) == nr_factors
+
+        endpoint = {'endpoint_type': 'ZEUS_SK_DECRYPT'}
+        decrypted, proof = client.process(endpoint, mixed)
+        assert sorted(text for _, text in decrypted) == sorted(values)
+        assert proof == [None] * NR_CIPHERS
+
+        endpoint = {'endpoint_type': 'ZEUS_SK_PARTIAL_DECRYPT'}
+        assert client.process(endpoint, mixed)[1] is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=''):
+        self.status_code = status_code
+        self.content = content
+
+
+def make_bulk_client(common, responses):
+    """A client whose gateway moves to a new cycle on every lookup"""
+    class BulkClient(common.SphinxmixClient):
+        def __init__(self):
+            self.nr_lookups = 0
+            self.uploads = []
+
+        def endpoint_get(self, endpoint_id):
+            self.nr_lookups += 1
+            return {'public': True, 'current_cycle': self.nr_lookups}
+
+        def post_cycle_bulk_upload(self, endpoint_id, cycle, messages):
+            self.uploads.append(cycle)
+            return responses.pop(0)
+
+    return BulkClient()
+
+
+def test_send_bulk_retries_once_on_closed_cycle():
+    common = pytest.importorskip('panoramix.common')
+    closed = FakeResponse(400, '{"cycle": ["%s"]}' % common.CYCLE_NOT_CURRENT)
+
+    client = make_bulk_client(common, [closed, FakeResponse(201)])
+    assert client.message_send_bulk('gateway', []) == 2
+    assert client.uploads == [1, 2]
+
+    client = make_bulk_client(common, [closed, closed])
+    assert_raises(Exception, client.message_send_bulk, 'gateway', [])
+    assert client.uploads == [1, 2]
+
+    client = make_bulk_client(common, [FakeResponse(400, 'invalid')])
+    assert_raises(Exception, client.message_send_bulk, 'gateway', [])
+    assert client.uploads == [1]
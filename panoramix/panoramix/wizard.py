@@ -110,6 +110,7 @@ def run_mix_endpoint(endpoint_spec):
     if endpoint_type == "SPHINXMIX":
         messages, proof = client.crypto_client.process(endpoint_spec, messages)
         messages = format_accepted_messages(messages)
+        client.crypto_client.record_processed()
 
     print 'New cycle'
     client.cycle_bulk_upload(endpoint_id, current_cycle, messages)
@@ -287,7 +287,7 @@ class PeerOperation(object):
         print "RECORD %s (user: %s)" % (stage_instance, self.username)
         document = spec_to_position(analysis['candidate_spec'])
         document = convert_special(document)
-        consensus_id = utils.hash_string(canonical.to_canonical(document))
+        consensus_id = utils.hash_with_canonical(document)
         doc = dict(document)
         doc.pop('')
         completed = None not in doc.values()